@@ -0,0 +1,389 @@
+import functools
+import math
+
+import numpy as np
+
+from metering import to_db
+from wavfile import read_wav_info, decode_samples
+
+# a sample at or above this (linear, full scale = 1.0) counts as clipped
+CLIP_THRESHOLD = 0.999
+# this many clipped frames in a row make a clip
+CLIP_MIN_FRAMES = 3
+# clips closer together than this are merged into one region, in seconds
+CLIP_MERGE_SECONDS = 0.05
+
+# EBU R128 (ITU-R BS.1770) gating: blocks of 400 ms every 100 ms, an absolute gate in LUFS and a relative one in LU
+LOUDNESS_BLOCK_SECONDS = 0.4
+LOUDNESS_STEP_SECONDS = 0.1
+LOUDNESS_ABSOLUTE_GATE = -70.0
+LOUDNESS_RELATIVE_GATE = -10.0
+# the K-weighting filter's impulse response is cut off after this long, its tail is below -120 dB by then
+K_WEIGHTING_SECONDS = 0.06
+# true peak is measured on the audio oversampled to at least this rate (4x at 48 kHz), with this many taps per phase
+TRUE_PEAK_RATE = 192000
+TRUE_PEAK_TAPS = 12
+# the noise floor is the RMS level of the quietest stretch of the take this long, digital silence aside
+NOISE_FLOOR_SECONDS = 0.5
+
+# speech is looked for in windows of this many seconds. a window is speech when it is within
+# TRIM_SPEECH_RANGE_DB of the take's loud level (its 95th percentile window) and at least
+# TRIM_NOISE_MARGIN_DB above its noise (its 10th percentile window)
+TRIM_WINDOW_SECONDS = 0.01
+TRIM_SPEECH_RANGE_DB = 24.0
+TRIM_NOISE_MARGIN_DB = 10.0
+# gaps in speech shorter than this are bridged, and speech has to go on for at least this long,
+# so a key click or a short breath does not count
+TRIM_GAP_SECONDS = 0.05
+TRIM_MIN_SPEECH_SECONDS = 0.12
+# kept before the first and after the last speech
+TRIM_PAD_IN_SECONDS = 0.15
+TRIM_PAD_OUT_SECONDS = 0.35
+# frames decoded at a time when a file is scanned
+TRIM_SCAN_FRAMES = 1 << 18
+
+# ACX audiobook submission requirements, in dBFS
+ACX_RMS_MIN_DB = -23.0
+ACX_RMS_MAX_DB = -18.0
+ACX_PEAK_MAX_DB = -3.0
+ACX_NOISE_FLOOR_MAX_DB = -60.0
+
+
+class ClipDetector:
+    """ Streaming clip detector.
+
+    Finds runs of consecutive clipped frames (any channel at or over the threshold) and
+    merges nearby runs into regions. Regions are [start_frame, end_frame, clipped_frames]
+    with frames counted from the start of the take.
+    """
+
+    name = 'clips'
+
+    def __init__(self, sample_rate, channels, threshold=CLIP_THRESHOLD, min_frames=CLIP_MIN_FRAMES, merge_seconds=CLIP_MERGE_SECONDS):
+        self.channels = channels
+        self.threshold = threshold
+        self.min_frames = min_frames
+        self.merge_frames = int(merge_seconds * sample_rate)
+        self.regions = []
+        # run still open at the end of the last block
+        self._run_start = None
+        self._end_frame = 0
+
+    @property
+    def count(self):
+        return len(self.regions)
+
+    def process(self, samples, frame_offset):
+        # samples is float64 of shape (frames, channels), frame_offset is the take frame of its first row
+        frames = samples.shape[0]
+        if frames == 0:
+            return
+        self._end_frame = frame_offset + frames
+        clipped = (np.abs(samples) >= self.threshold).any(axis=1)
+
+        # +1 where a run starts, -1 one past where it ends
+        edges = np.diff(clipped.view(np.int8), prepend=np.int8(self._run_start is not None))
+        starts = (np.flatnonzero(edges == 1) + frame_offset).tolist()
+        ends = (np.flatnonzero(edges == -1) + frame_offset).tolist()
+        if self._run_start is not None:
+            starts.insert(0, self._run_start)
+
+        self._run_start = starts.pop() if clipped[-1] else None
+        for start, end in zip(starts, ends):
+            self._add_run(start, end)
+
+    def finish(self):
+        if self._run_start is not None:
+            # the take ended while clipping, close the run wherever we got to
+            self._add_run(self._run_start, self._end_frame)
+            self._run_start = None
+        return self.regions
+
+    def _add_run(self, start, end):
+        if end - start < self.min_frames:
+            return
+        if self.regions and start - self.regions[-1][1] <= self.merge_frames:
+            region = self.regions[-1]
+            region[1] = end
+            region[2] += end - start
+        else:
+            self.regions.append([start, end, end - start])
+
+
+class LevelStats:
+    """ Peak and RMS level of a whole take, in dBFS over all channels. """
+
+    name = 'levels'
+
+    def __init__(self):
+        self.peak = 0.0
+        self._sum_squares = 0.0
+        self._count = 0
+
+    def process(self, samples, frame_offset):
+        if samples.size == 0:
+            return
+        flat = samples.reshape(-1)
+        self.peak = max(self.peak, flat.max(), -flat.min())
+        self._sum_squares += np.dot(flat, flat)
+        self._count += flat.size
+
+    def finish(self):
+        rms = math.sqrt(self._sum_squares / self._count) if self._count else 0.0
+        return {'peak_db': round(to_db(self.peak), 2), 'rms_db': round(to_db(rms), 2)}
+
+
+class LoudnessStats:
+    """ Integrated loudness (EBU R128), true peak and noise floor of a whole take, in one pass.
+
+    The audio is K-weighted by FFT convolution with the filter's impulse response, carrying the
+    filter's history from block to block, and only the mean square of every 100 ms step is kept.
+    The gated loudness is worked out from those when the take ends. True peak is the highest
+    sample after polyphase oversampling to TRUE_PEAK_RATE. Every channel counts with weight 1.
+    """
+
+    name = 'loudness'
+
+    def __init__(self, sample_rate, channels):
+        self.channels = channels
+        self.step_frames = max(1, round(LOUDNESS_STEP_SECONDS * sample_rate))
+        self._fir_length, self._fir_spectrum, self._fft_size = k_weighting(sample_rate)
+        # both filters' histories are seeded from the take's first block, see process
+        self._history = None
+        self.oversampling = max(1, TRUE_PEAK_RATE // sample_rate)
+        self._phases = true_peak_phases(self.oversampling)
+        self._peak_history = None
+        self.true_peak = 0.0
+        # mean square of every full step: K-weighted summed over the channels, and plain averaged over them
+        self._weighted = []
+        self._plain = []
+        self._step_weighted = 0.0
+        self._step_plain = 0.0
+        self._step_fill = 0
+
+    def process(self, samples, frame_offset):
+        if samples.shape[0] == 0:
+            return
+        if self._history is None:
+            # the filters start as if the first frame had always been there: takes begin mid-signal, and
+            # a step up from silence would ring above the real peak and add energy that was never recorded
+            self._history = np.repeat(samples[:1], self._fir_length - 1, axis=0)
+            self._peak_history = np.repeat(samples[:1], TRUE_PEAK_TAPS - 1, axis=0)
+        self._measure_true_peak(samples)
+        weighted = self._k_weight(samples)
+        self._add_steps(np.einsum('ij,ij->i', weighted, weighted), np.einsum('ij,ij->i', samples, samples) / self.channels)
+
+    def finish(self):
+        return {
+            'integrated_lufs': self.integrated_loudness(),
+            'true_peak_dbtp': round(to_db(self.true_peak), 2),
+            'noise_floor_db': self.noise_floor(),
+        }
+
+    def integrated_loudness(self):
+        blocks_per_gate = round(LOUDNESS_BLOCK_SECONDS / LOUDNESS_STEP_SECONDS)
+        if len(self._weighted) < blocks_per_gate:
+            return None
+        blocks = np.convolve(self._weighted, np.ones(blocks_per_gate) / blocks_per_gate, 'valid')
+        loudness = -0.691 + 10 * np.log10(np.maximum(blocks, 1e-20))
+        gated = loudness > LOUDNESS_ABSOLUTE_GATE
+        if not gated.any():
+            return None
+        relative_gate = -0.691 + 10 * math.log10(blocks[gated].mean()) + LOUDNESS_RELATIVE_GATE
+        gated &= loudness > relative_gate
+        return round(-0.691 + 10 * math.log10(blocks[gated].mean()), 2)
+
+    def noise_floor(self):
+        steps = round(NOISE_FLOOR_SECONDS / LOUDNESS_STEP_SECONDS)
+        if len(self._plain) < steps:
+            return None
+        windows = np.convolve(self._plain, np.ones(steps) / steps, 'valid')
+        windows = windows[windows > 0]
+        if windows.size == 0:
+            return None
+        return round(to_db(math.sqrt(windows.min())), 2)
+
+    def _measure_true_peak(self, samples):
+        peak = max(samples.max(), -samples.min())
+        if self.oversampling > 1:
+            buffer = np.concatenate((self._peak_history, samples))
+            self._peak_history = buffer[-(TRUE_PEAK_TAPS - 1):].copy()
+            for channel in range(self.channels):
+                windows = np.lib.stride_tricks.sliding_window_view(buffer[:, channel], TRUE_PEAK_TAPS)
+                interpolated = windows @ self._phases
+                peak = max(peak, interpolated.max(), -interpolated.min())
+        self.true_peak = max(self.true_peak, peak)
+
+    def _k_weight(self, samples):
+        # overlap-save: each chunk is convolved together with the fir_length - 1 frames before it
+        buffer = np.concatenate((self._history, samples))
+        self._history = buffer[-(self._fir_length - 1):].copy()
+        weighted = np.empty_like(samples)
+        step = self._fft_size - self._fir_length + 1
+        for start in range(0, samples.shape[0], step):
+            chunk = buffer[start:start + step + self._fir_length - 1]
+            spectrum = np.fft.rfft(chunk, self._fft_size, axis=0) * self._fir_spectrum[:, np.newaxis]
+            frames = chunk.shape[0] - self._fir_length + 1
+            weighted[start:start + frames] = np.fft.irfft(spectrum, self._fft_size, axis=0)[self._fir_length - 1:self._fir_length - 1 + frames]
+        return weighted
+
+    def _add_steps(self, weighted, plain):
+        # per frame energies, summed into 100 ms steps that can straddle blocks
+        start = 0
+        while start < weighted.shape[0]:
+            end = min(start + self.step_frames - self._step_fill, weighted.shape[0])
+            self._step_weighted += weighted[start:end].sum()
+            self._step_plain += plain[start:end].sum()
+            self._step_fill += end - start
+            start = end
+            if self._step_fill == self.step_frames:
+                self._weighted.append(self._step_weighted / self.step_frames)
+                self._plain.append(self._step_plain / self.step_frames)
+                self._step_weighted = self._step_plain = 0.0
+                self._step_fill = 0
+
+
+@functools.lru_cache(maxsize=None)
+def k_weighting(sample_rate):
+    """ Returns (FIR length, FIR spectrum, FFT size) of the BS.1770 K-weighting filter at `sample_rate`.
+
+    The filter is the standard high shelf followed by the RLB high pass, designed for the
+    sample rate the way libebur128 does, and run once over an impulse to get its response.
+    """
+    f0, gain, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = math.tan(math.pi * f0 / sample_rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ((vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0), (2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    high_pass = (1.0, -2.0, 1.0), (2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+
+    response = [0.0] * max(2, int(K_WEIGHTING_SECONDS * sample_rate))
+    response[0] = 1.0
+    for (b0, b1, b2), (a1, a2) in (shelf, high_pass):
+        x1 = x2 = y1 = y2 = 0.0
+        for i, x in enumerate(response):
+            y = b0 * x + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2
+            x2, x1, y2, y1 = x1, x, y1, y
+            response[i] = y
+    fft_size = 1 << (4 * len(response) - 1).bit_length()
+    return len(response), np.fft.rfft(response, fft_size), fft_size
+
+
+@functools.lru_cache(maxsize=None)
+def true_peak_phases(oversampling):
+    # windowed sinc interpolator split into its phases, (TRUE_PEAK_TAPS, oversampling) with taps oldest first
+    length = TRUE_PEAK_TAPS * oversampling
+    t = (np.arange(length) - (length - 1) / 2) / oversampling
+    fir = np.sinc(t) * np.kaiser(length, 8.0)
+    phases = fir.reshape(TRUE_PEAK_TAPS, oversampling)[::-1]
+    # every phase passes DC unchanged
+    return phases / phases.sum(axis=0)
+
+
+class SpeechTrim:
+    """ Suggests where a take's speech starts and ends, leaving out the cue and breath at the
+    head and the reach for the key at the tail.
+
+    Only the mean square of every TRIM_WINDOW_SECONDS window is kept as the take streams in;
+    the thresholds come from the take's own level distribution once it ends. Windows are placed
+    by `frame_offset`, frames the analysis did not see count as neither speech nor noise. The
+    result is {'in_frame', 'out_frame'} counted from the start of the take, or None if no speech
+    was found.
+    """
+
+    name = 'trim'
+
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.window_frames = max(1, round(TRIM_WINDOW_SECONDS * sample_rate))
+        self.frames = 0
+        self._windows = []
+        self._carry = np.empty(0)
+
+    def process(self, samples, frame_offset):
+        if frame_offset < self.frames:
+            raise ValueError(f"frame {frame_offset} was already analysed, up to {self.frames}")
+        energy = np.einsum('ij,ij->i', samples, samples) / samples.shape[1]
+        if frame_offset > self.frames:
+            # frames the analysis did not see, NaN keeps them out of the levels
+            energy = np.concatenate((np.full(frame_offset - self.frames, np.nan), energy))
+        self.frames = frame_offset + samples.shape[0]
+        if self._carry.size:
+            energy = np.concatenate((self._carry, energy))
+        full = energy.size - energy.size % self.window_frames
+        self._carry = energy[full:].copy()
+        if full:
+            self._windows.append(energy[:full].reshape(-1, self.window_frames).mean(axis=1))
+
+    def finish(self):
+        if not self._windows:
+            return None
+        levels = 10 * np.log10(np.concatenate(self._windows) + 1e-20)
+        if np.isnan(levels).all():
+            return None
+        loud, noise = np.nanpercentile(levels, 95), np.nanpercentile(levels, 10)
+        if loud < noise + TRIM_NOISE_MARGIN_DB:
+            return None
+        # a window with unseen frames is NaN, and never speech
+        speech = levels >= max(loud - TRIM_SPEECH_RANGE_DB, noise + TRIM_NOISE_MARGIN_DB)
+
+        # runs of speech windows as [start, end) pairs, short gaps between them bridged
+        edges = np.diff(speech.view(np.int8), prepend=np.int8(0), append=np.int8(0))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        if starts.size == 0:
+            return None
+        gap_windows = TRIM_GAP_SECONDS / TRIM_WINDOW_SECONDS
+        keep = np.concatenate(([True], starts[1:] - ends[:-1] > gap_windows))
+        starts, ends = starts[keep], np.concatenate((ends[np.flatnonzero(keep)[1:] - 1], ends[-1:]))
+        long_enough = ends - starts >= TRIM_MIN_SPEECH_SECONDS / TRIM_WINDOW_SECONDS
+        if not long_enough.any():
+            return None
+        start, end = starts[long_enough][0], ends[long_enough][-1]
+        return {
+            'in_frame': max(0, int(start * self.window_frames - TRIM_PAD_IN_SECONDS * self.sample_rate)),
+            'out_frame': min(self.frames, int(end * self.window_frames + TRIM_PAD_OUT_SECONDS * self.sample_rate)),
+        }
+
+
+def detect_trim(file_path):
+    """ SpeechTrim over a WAV that was not analyzed while recording, e.g. a recovered take.
+
+    The file is memory mapped and decoded a chunk at a time, so memory use does not depend on its length.
+    """
+    info = read_wav_info(file_path)
+    frame_size = info.channels * info.sample_width
+    frames = info.data_size // frame_size
+    trim = SpeechTrim(info.sample_rate)
+    if frames == 0:
+        return None
+    data = np.memmap(file_path, np.uint8, 'r')
+    for start in range(0, frames, TRIM_SCAN_FRAMES):
+        count = min(TRIM_SCAN_FRAMES, frames - start)
+        samples = decode_samples(data, info.sample_width, info.format_tag, info.data_offset + start * frame_size, count * info.channels)
+        trim.process(samples.reshape(-1, info.channels), start)
+    return trim.finish()
+
+
+def acx_problems(analysis):
+    """ What keeps a take from meeting the ACX requirements, given its analysis results by analyzer name.
+
+    Returns short descriptions, none if the take meets them (or was not analyzed).
+    """
+    problems = []
+    levels = analysis.get(LevelStats.name)
+    if levels:
+        if levels['rms_db'] < ACX_RMS_MIN_DB:
+            problems.append(f"RMS {levels['rms_db']:.1f} dB, below {ACX_RMS_MIN_DB:g}")
+        elif levels['rms_db'] > ACX_RMS_MAX_DB:
+            problems.append(f"RMS {levels['rms_db']:.1f} dB, above {ACX_RMS_MAX_DB:g}")
+    loudness = analysis.get(LoudnessStats.name)
+    if loudness:
+        if loudness['true_peak_dbtp'] > ACX_PEAK_MAX_DB:
+            problems.append(f"Peak {loudness['true_peak_dbtp']:.1f} dBTP, above {ACX_PEAK_MAX_DB:g}")
+        if loudness['noise_floor_db'] is not None and loudness['noise_floor_db'] > ACX_NOISE_FLOOR_MAX_DB:
+            problems.append(f"Noise floor {loudness['noise_floor_db']:.1f} dB, above {ACX_NOISE_FLOOR_MAX_DB:g}")
+    return problems
@@ -0,0 +1,265 @@
+import threading
+import time
+
+import numpy as np
+
+from profiles import SAMPLE_FORMATS
+from wavfile import read_wav_info, decode_samples, encode_samples, WAVE_FORMAT_IEEE_FLOAT
+
+# what a stream callback returns next to its data, the same values as PyAudio's paContinue/paComplete
+STREAM_CONTINUE = 0
+STREAM_COMPLETE = 1
+
+# the synthetic source plays a tone at this frequency and level (linear, full scale = 1.0) over a little noise
+SYNTHETIC_TONE_HZ = 440.0
+SYNTHETIC_TONE_LEVEL = 0.25
+SYNTHETIC_NOISE_LEVEL = 0.001
+
+
+class PyAudioBackend:
+    """ Real input and output devices, through PortAudio.
+
+    Every backend offers the same few calls: `input_devices()` lists the inputs as dicts with
+    an `index` and a `name`, `is_format_supported(profile, device_index)`, `open_input(device_index,
+    profile, callback)` and `open_output(channels, sample_width, format_tag, sample_rate,
+    frames_per_buffer, callback)`. Streams have `start_stream`, `stop_stream`, `is_active` and
+    `close`, and callbacks have PyAudio's signature and return values.
+    """
+
+    def __init__(self):
+        self._pyaudio = None
+        self._audio = None
+        self._audio_lock = threading.Lock()
+
+    @property
+    def audio(self):
+        # PortAudio scans every host API and device when it starts, which can take seconds, so it
+        # is only started when first needed, e.g. by a device scan on a background thread
+        with self._audio_lock:
+            if self._audio is None:
+                # only imported here, so the other backends run where PortAudio is not installed
+                import pyaudio
+                self._pyaudio = pyaudio
+                self._audio = pyaudio.PyAudio()
+            return self._audio
+
+    def input_devices(self):
+        info = self.audio.get_host_api_info_by_index(0)
+        devices = []
+        for i in range(info.get('deviceCount')):
+            device_info = self.audio.get_device_info_by_host_api_device_index(0, i)
+            if device_info.get('maxInputChannels') > 0:
+                devices.append({'index': device_info.get('index'), 'name': device_info.get('name')})
+        return devices
+
+    def device_name(self, device_index):
+        return self.audio.get_device_info_by_index(device_index).get('name')
+
+    def is_format_supported(self, profile, device_index):
+        sample_format = SAMPLE_FORMATS[profile.sample_format]
+        try:
+            return self.audio.is_format_supported(profile.sample_rate, input_device=device_index, input_channels=profile.channels,
+                                                  input_format=self._format(sample_format.stream_width, sample_format.format_tag))
+        except ValueError:
+            return False
+
+    def open_input(self, device_index, profile, callback):
+        # opened stopped, so several streams can be started together
+        sample_format = SAMPLE_FORMATS[profile.sample_format]
+        return self.audio.open(
+            format=self._format(sample_format.stream_width, sample_format.format_tag),
+            channels=profile.channels,
+            rate=profile.sample_rate,
+            input=True,
+            input_device_index=device_index,
+            frames_per_buffer=profile.frames_per_buffer,
+            stream_callback=callback,
+            start=False
+        )
+
+    def open_output(self, channels, sample_width, format_tag, sample_rate, frames_per_buffer, callback):
+        return self.audio.open(
+            format=self._format(sample_width, format_tag),
+            channels=channels,
+            rate=sample_rate,
+            output=True,
+            frames_per_buffer=frames_per_buffer,
+            stream_callback=callback
+        )
+
+    def terminate(self):
+        if self._audio is not None:
+            self._audio.terminate()
+
+    def _format(self, sample_width, format_tag):
+        pyaudio = self._pyaudio
+        if format_tag == WAVE_FORMAT_IEEE_FLOAT:
+            return pyaudio.paFloat32
+        return {1: pyaudio.paUInt8, 2: pyaudio.paInt16, 3: pyaudio.paInt24, 4: pyaudio.paInt32}[sample_width]
+
+
+class GeneratedStream:
+    """ A stream run by a thread of its own instead of a sound card.
+
+    Input streams hand the blocks returned by `make_block(frames)` to the callback, output
+    streams pull blocks from the callback and drop them. With `speed` 1.0 blocks come at the
+    rate a device would deliver them, 10.0 is ten times faster, and None is as fast as the
+    callback returns (the capture ring can overflow then).
+    """
+
+    def __init__(self, callback, sample_rate, frames_per_buffer, make_block=None, frame_size=0, speed=1.0, on_close=None):
+        self.callback = callback
+        self.sample_rate = sample_rate
+        self.frames_per_buffer = frames_per_buffer
+        self.make_block = make_block
+        self.frame_size = frame_size
+        self.speed = speed
+        self.on_close = on_close
+        self.frames = 0
+        self._running = False
+        self._thread = None
+
+    def start_stream(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="generated-stream", daemon=True)
+        self._thread.start()
+
+    def stop_stream(self):
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def is_active(self):
+        return self._running
+
+    def close(self):
+        self.stop_stream()
+        if self.on_close is not None:
+            self.on_close()
+
+    def _run(self):
+        started = time.perf_counter()
+        start_frame = self.frames
+        while self._running:
+            if self.speed:
+                due = started + (self.frames - start_frame) / (self.sample_rate * self.speed)
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            now = time.perf_counter()
+            time_info = {'input_buffer_adc_time': now, 'output_buffer_dac_time': now, 'current_time': now}
+            if self.make_block is not None:
+                _, flag = self.callback(self.make_block(self.frames_per_buffer), self.frames_per_buffer, time_info, 0)
+            else:
+                data, flag = self.callback(None, self.frames_per_buffer, time_info, 0)
+                if len(data) < self.frames_per_buffer * self.frame_size:
+                    flag = STREAM_COMPLETE
+            self.frames += self.frames_per_buffer
+            if flag != STREAM_CONTINUE:
+                self._running = False
+
+
+class SyntheticBackend:
+    """ Made up input devices playing a steady tone over noise, and outputs that play nothing.
+
+    The noise is seeded (differently for each of the `devices`), so two runs record the same samples.
+    """
+
+    def __init__(self, speed=1.0, tone_hz=SYNTHETIC_TONE_HZ, tone_level=SYNTHETIC_TONE_LEVEL, noise_level=SYNTHETIC_NOISE_LEVEL, seed=0, devices=1):
+        self.speed = speed
+        self.devices = devices
+        self.tone_hz = tone_hz
+        self.tone_level = tone_level
+        self.noise_level = noise_level
+        self.seed = seed
+
+    def input_devices(self):
+        return [{'index': i, 'name': self.device_name(i)} for i in range(self.devices)]
+
+    def device_name(self, device_index):
+        return f"Synthetic tone {device_index}"
+
+    def is_format_supported(self, profile, device_index):
+        return True
+
+    def open_input(self, device_index, profile, callback):
+        sample_format = SAMPLE_FORMATS[profile.sample_format]
+        rng = np.random.default_rng(self.seed + device_index)
+        phase = [0]
+
+        def make_block(frames):
+            t = (np.arange(frames) + phase[0]) / profile.sample_rate
+            phase[0] += frames
+            tone = self.tone_level * np.sin(2 * np.pi * self.tone_hz * t)
+            samples = tone[:, np.newaxis] + self.noise_level * rng.standard_normal((frames, profile.channels))
+            return encode_samples(samples.reshape(-1), sample_format.stream_width, sample_format.format_tag)
+
+        return GeneratedStream(callback, profile.sample_rate, profile.frames_per_buffer, make_block, speed=self.speed)
+
+    def open_output(self, channels, sample_width, format_tag, sample_rate, frames_per_buffer, callback):
+        stream = GeneratedStream(callback, sample_rate, frames_per_buffer, frame_size=channels * sample_width, speed=self.speed)
+        stream.start_stream()
+        return stream
+
+    def terminate(self):
+        pass
+
+
+class FileBackend(SyntheticBackend):
+    """ One input device playing back a WAV file, converted to whatever the capture profile asks for.
+
+    The file has to be at the profile's sample rate. With `loop` it starts over at the end,
+    otherwise the device delivers silence from there on.
+    """
+
+    def __init__(self, file_path, loop=True, speed=1.0):
+        super().__init__(speed)
+        self.file_path = file_path
+        self.loop = loop
+        self.info = read_wav_info(file_path)
+
+    def input_devices(self):
+        return [{'index': 0, 'name': self.device_name(0)}]
+
+    def device_name(self, device_index):
+        return f"File: {self.file_path}"
+
+    def is_format_supported(self, profile, device_index):
+        return profile.sample_rate == self.info.sample_rate
+
+    def open_input(self, device_index, profile, callback):
+        if profile.sample_rate != self.info.sample_rate:
+            raise ValueError(f"'{self.file_path}' is {self.info.sample_rate} Hz, the capture profile is {profile.sample_rate} Hz")
+        info = self.info
+        sample_format = SAMPLE_FORMATS[profile.sample_format]
+        frame_size = info.channels * info.sample_width
+        total_frames = info.data_size // frame_size
+        f = open(self.file_path, 'rb')
+        position = [0]
+
+        def make_block(frames):
+            chunks = []
+            remaining = frames
+            while remaining > 0:
+                if position[0] >= total_frames:
+                    if not self.loop or total_frames == 0:
+                        break
+                    position[0] = 0
+                count = min(remaining, total_frames - position[0])
+                f.seek(info.data_offset + position[0] * frame_size)
+                chunks.append(f.read(count * frame_size))
+                position[0] += count
+                remaining -= count
+            samples = decode_samples(b''.join(chunks), info.sample_width, info.format_tag).reshape(-1, info.channels)
+            if samples.shape[0] < frames:
+                # past the end without looping, the device goes quiet
+                samples = np.concatenate([samples, np.zeros((frames - samples.shape[0], info.channels))])
+            if info.channels != profile.channels:
+                # mono is spread over every channel, anything else is mixed down to mono first
+                mono = samples.mean(axis=1, keepdims=True)
+                samples = np.repeat(mono, profile.channels, axis=1)
+            return encode_samples(samples.reshape(-1), sample_format.stream_width, sample_format.format_tag)
+
+        return GeneratedStream(callback, profile.sample_rate, profile.frames_per_buffer, make_block, speed=self.speed, on_close=f.close)
@@ -0,0 +1,198 @@
+""" Real-time benchmark of the capture path.
+
+Feeds synthetic blocks through the recorder's own audio callback (metering and the push into
+the capture ring) while its writer thread writes and analyses the take, for every combination
+of sample rate, channel count and frames per buffer asked for. Each combination runs in a
+fresh process so its peak RSS is its own.
+
+Reports, per combination: callback duration percentiles, headroom (how much of the block
+period the 99th percentile callback leaves free), callbacks that took longer than a block
+period, blocks dropped by the ring buffer, writer throughput and peak RSS. The results are
+written as JSON, and --compare prints how they moved against an earlier run, e.g.
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from backends import SyntheticBackend, SYNTHETIC_TONE_HZ, SYNTHETIC_TONE_LEVEL
+from engine import Recorder
+from profiles import CaptureProfile, SAMPLE_FORMATS, SAMPLE_INT32
+from wavfile import encode_samples
+
+try:
+    import resource
+except ImportError:
+    # not on Windows, peak RSS is left out there
+    resource = None
+
+BENCHMARK_SAMPLE_RATES = [48000, 96000, 192000]
+BENCHMARK_CHANNELS = [1, 2, 4, 8]
+BENCHMARK_FRAMES_PER_BUFFER = [128, 512, 2048]
+# seconds of audio fed per combination
+BENCHMARK_SECONDS = 3.0
+# --compare flags a combination whose 99th percentile callback got this much slower
+REGRESSION_THRESHOLD = 0.2
+# percentiles of the callback duration reported
+PERCENTILES = [50, 90, 99, 99.9]
+
+RESULTS_VERSION = 1
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def make_blocks(profile, count):
+    # a second or so of tone, encoded once up front so making audio is not part of the measurement
+    sample_format = SAMPLE_FORMATS[profile.sample_format]
+    frames = profile.frames_per_buffer * count
+    t = np.arange(frames) / profile.sample_rate
+    samples = np.repeat((SYNTHETIC_TONE_LEVEL * np.sin(2 * np.pi * SYNTHETIC_TONE_HZ * t))[:, np.newaxis], profile.channels, axis=1)
+    data = encode_samples(samples.reshape(-1), sample_format.stream_width, sample_format.format_tag)
+    block_size = len(data) // count
+    return [data[i * block_size:(i + 1) * block_size] for i in range(count)]
+
+
+def run_case(profile, seconds, speed):
+    """ Record one take of `seconds` of synthetic audio through the callback and measure it.
+
+    With `speed` 1.0 blocks arrive at the rate a device would deliver them, higher values feed
+    them faster (the writer then has to keep up with that rate too).
+    """
+    block_period = profile.frames_per_buffer / profile.sample_rate
+    block_count = max(1, int(seconds / block_period))
+    blocks = make_blocks(profile, max(1, min(block_count, int(1 / block_period) + 1)))
+    durations = np.empty(block_count)
+
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(sys.stderr):
+        # no device is selected, the benchmark plays the part of the stream
+        recorder = Recorder(SyntheticBackend(), directory, profile=profile)
+        recorder.start_session()
+        time_info = {}
+        started = time.perf_counter()
+        for i in range(block_count):
+            if speed:
+                delay = started + i * block_period / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            block = blocks[i % len(blocks)]
+            callback_started = time.perf_counter()
+            recorder.audio_callback(block, profile.frames_per_buffer, time_info, 0)
+            durations[i] = time.perf_counter() - callback_started
+        fed_seconds = time.perf_counter() - started
+        # the take is scrapped, ending the session waits for the writer to finish it
+        recorder.end_session()
+        recorder.wait()
+        recorder.close()
+        stats = recorder.capture.stats()
+
+    return {
+        'sample_format': profile.sample_format,
+        'sample_rate': profile.sample_rate,
+        'channels': profile.channels,
+        'frames_per_buffer': profile.frames_per_buffer,
+        'blocks': block_count,
+        'block_period_us': round(block_period * 1e6, 1),
+        'callback_us': {f"p{percentile:g}": round(float(np.percentile(durations, percentile)) * 1e6, 2) for percentile in PERCENTILES},
+        'callback_max_us': round(float(durations.max()) * 1e6, 2),
+        'headroom': round(1 - float(np.percentile(durations, 99)) / block_period, 4),
+        'late_callbacks': int(np.count_nonzero(durations > block_period)),
+        'dropped_blocks': stats['overflows'],
+        'max_backlog_frames': stats['max_backlog_frames'],
+        'writer_mb_per_second': round(stats['bytes_written'] / stats['busy_seconds'] / 1e6, 1) if stats['busy_seconds'] else None,
+        'realtime_factor': round(block_count * block_period / fed_seconds, 2),
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def case_key(result):
+    return f"{result['sample_format']}/{result['sample_rate']}/{result['channels']}ch/{result['frames_per_buffer']}"
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    # one line per combination in both runs, returns how many got slower than the threshold
+    old = {case_key(result): result for result in baseline['results']}
+    regressions = 0
+    for result in results['results']:
+        key = case_key(result)
+        if key not in old:
+            continue
+        before, after = old[key]['callback_us']['p99'], result['callback_us']['p99']
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > threshold or result['dropped_blocks'] > old[key]['dropped_blocks']:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{key:28} p99 {before:9.1f} -> {after:9.1f} us ({change:+.0%}), "
+              f"headroom {old[key]['headroom']:.3f} -> {result['headroom']:.3f}, "
+              f"dropped {old[key]['dropped_blocks']} -> {result['dropped_blocks']}{flag}", file=sys.stderr)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the capture path with synthetic audio")
+    parser.add_argument('--rates', type=int, nargs='+', default=BENCHMARK_SAMPLE_RATES)
+    parser.add_argument('--channels', type=int, nargs='+', default=BENCHMARK_CHANNELS)
+    parser.add_argument('--frames-per-buffer', type=int, nargs='+', default=BENCHMARK_FRAMES_PER_BUFFER)
+    parser.add_argument('--formats', nargs='+', default=[SAMPLE_INT32], choices=list(SAMPLE_FORMATS))
+    parser.add_argument('--seconds', type=float, default=BENCHMARK_SECONDS, help="seconds of audio per combination")
+    parser.add_argument('--speed', type=float, default=1.0, help="how much faster than real time blocks are fed, 0 for as fast as possible")
+    parser.add_argument('--label', default='', help="stored with the results, e.g. the version benchmarked")
+    parser.add_argument('--output', help="write the JSON results here instead of to stdout")
+    parser.add_argument('--compare', help="earlier results to compare against, exits with 1 on a regression")
+    args = parser.parse_args(argv)
+
+    profiles = [CaptureProfile(sample_format, rate, channels, frames_per_buffer) for sample_format, rate, channels, frames_per_buffer
+                in itertools.product(args.formats, args.rates, args.channels, args.frames_per_buffer)]
+    results = {
+        'version': RESULTS_VERSION,
+        'label': args.label,
+        'time': time.time(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'seconds': args.seconds,
+        'speed': args.speed,
+        'results': [],
+    }
+    # a fresh process per combination, so peak RSS and the writer threads do not carry over
+    context = multiprocessing.get_context('spawn')
+    for profile in profiles:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_case, (profile, args.seconds, args.speed))
+        print(f"{case_key(result):28} p99 {result['callback_us']['p99']:9.1f} us, headroom {result['headroom']:.3f}, "
+              f"dropped {result['dropped_blocks']}, writer {result['writer_mb_per_second']} MB/s", file=sys.stderr)
+        results['results'].append(result)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
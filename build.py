@@ -15,7 +15,9 @@ APP_NAME = 'Edit-as-you-go Sound Recorder'
 PyInstaller.__main__.run([
     './main.py',
     '--clean', # force a full rebuild
-    '--onefile', # contain everything in 1 exe file (will auto extract on run into temp dir)
+    # one folder rather than --onefile: a one-file exe extracts everything into a temp dir on every launch,
+    # which is most of its startup time
+    '--onedir',
     '--noconsole', # do not show the terminal console when running
     f'--icon={ICON_ICO}',
     f'--name={APP_NAME}',
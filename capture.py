@@ -0,0 +1,836 @@
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from wavfile import WavWriter, decode_samples, CONTAINER_WAV, HEADER_INTERVAL, FSYNC_ON_PATCH, WAVE_FORMAT_PCM
+from session import TakeIndex, take_index_path, VERDICT_GOOD, VERDICT_BAD
+
+# how often the writer thread wakes up to drain the ring buffer to disk
+FLUSH_INTERVAL = 0.5
+# how many seconds of audio the ring buffer can hold before the callback starts dropping blocks
+RING_SECONDS = 30
+# how many seconds of audio from before a take starts are put at the head of the take
+PRE_ROLL_SECONDS = 0
+# take analyzers are fed at most this many frames at a time
+ANALYSIS_BLOCK_FRAMES = 65536
+# samples converted per step when the file format differs from the stream's
+PACK_BLOCK_SAMPLES = 65536
+# how long a finished take waits for the files of its other devices, in seconds
+DEVICE_CLOSE_TIMEOUT = 10.0
+
+
+class RingBuffer:
+    """ Single producer / single consumer byte ring.
+
+    The audio callback is the only writer and the capture writer thread is the only reader.
+    Each side only ever moves its own position forward, so no lock is needed.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        # positions are the total number of bytes ever written/read, never wrapped
+        self.write_pos = 0
+        self.read_pos = 0
+        self.overflows = 0
+        self.dropped_bytes = 0
+
+    def available(self):
+        return self.write_pos - self.read_pos
+
+    def free(self):
+        return self.capacity - (self.write_pos - self.read_pos)
+
+    def write(self, data):
+        # producer side, called from the audio callback - must not block or allocate
+        data = memoryview(data).cast('B')
+        size = len(data)
+        if size > self.free():
+            self.overflows += 1
+            self.dropped_bytes += size
+            return False
+
+        start = self.write_pos % self.capacity
+        first = min(size, self.capacity - start)
+        self._view[start:start + first] = data[:first]
+        if first < size:
+            self._view[:size - first] = data[first:]
+        self.write_pos += size
+        return True
+
+    def peek(self, size):
+        # consumer side, returns up to two views covering the next `size` unread bytes
+        size = min(size, self.available())
+        start = self.read_pos % self.capacity
+        first = min(size, self.capacity - start)
+        views = [self._view[start:start + first]]
+        if first < size:
+            views.append(self._view[:size - first])
+        return views
+
+    def advance(self, size):
+        self.read_pos += size
+
+
+class PreRollBuffer:
+    """ Fixed size circular buffer holding the most recent audio that did not go to any file. """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._written = 0
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        size = len(data)
+        if size > self.capacity:
+            # only the newest audio fits
+            self._written += size - self.capacity
+            data = data[size - self.capacity:]
+            size = self.capacity
+
+        start = self._written % self.capacity
+        first = min(size, self.capacity - start)
+        self._view[start:start + first] = data[:first]
+        if first < size:
+            self._view[:size - first] = data[first:]
+        self._written += size
+
+    def tail(self, size):
+        # up to two views covering the last `size` bytes, oldest first
+        size = min(size, self._written, self.capacity)
+        start = (self._written - size) % self.capacity
+        first = min(size, self.capacity - start)
+        views = [self._view[start:start + first]]
+        if first < size:
+            views.append(self._view[:size - first])
+        return views
+
+    def clear(self):
+        self._written = 0
+
+
+# take transition states
+TAKE_IDLE = "idle"
+TAKE_RECORDING = "recording"
+TAKE_HELD = "held"
+
+
+class Take:
+    """ A single take, from the sample it was opened at to the sample it was closed at. """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        # absolute frame indexes in the input stream
+        self.start_frame = None
+        self.end_frame = None
+        # wall clock time of the first frame
+        self.start_time = None
+        # True for good, False for bad, None while undecided (or scrapped)
+        self.verdict = None
+        # number of the take within its session (session mode only)
+        self.take_id = None
+        # results of the take analyzers by name, filled in before `closed` is set
+        self.analysis = {}
+        # health of the capture while the take was recorded: writer backlog and dropped blocks from
+        # the writer, stream xruns from the recorder
+        self.telemetry = {}
+        # the same take recorded by the other devices of a CaptureGroup
+        self.device_takes = []
+        # for those device takes: the device's name, and its clock drift against the primary when the take ended
+        self.device = None
+        self.drift_ppm = None
+        # set by the writer thread once the file is complete on disk
+        self.closed = threading.Event()
+
+    @property
+    def frames(self):
+        if self.start_frame is None or self.end_frame is None:
+            return 0
+        return self.end_frame - self.start_frame
+
+
+class CaptureWriter:
+    """ Drains audio pushed by the stream callback to the open take file on its own thread.
+
+    Commands (open/close/rotate) are tagged with the ring position at the moment they were
+    issued, so the writer always applies them at the exact byte they refer to, no matter how
+    far behind the disk is. A command can also be given a stream frame to apply at instead;
+    if the stream has not got there yet, the writer holds the command until it has.
+
+    The writer keeps a clock of the stream: the time (perf_counter) the last pushed block
+    started at and its frame. `frame_at` converts a time to a stream frame, which is how
+    several writers cut a take on the same instant, and `drift_ppm` tells how fast the
+    device's sample clock runs against the computer's.
+
+    Audio pushed while no file is open goes to the pre-roll buffer, and a file opened from
+    that state starts with up to `pre_roll_seconds` of it. Rotated takes follow on from the
+    previous take and get no pre-roll.
+
+    With `file_sample_width` 3 and a 4 byte stream, the int32 samples of the stream are packed
+    to 24 bit on the way to disk by keeping their top three bytes. That is lossless for
+    interfaces that deliver 24 significant bits, and cuts what is written by a quarter.
+
+    Everything written for a take is also fed, on this thread, to the analyzers returned by
+    `make_analyzers(take)` for the take they analyze. Each analyzer has a `name`, `process(samples, frame_offset)` taking
+    float64 samples of shape (frames, channels), and `finish()` returning its result, which
+    ends up in `Take.analysis`.
+    """
+
+    def __init__(self, channels, sample_width, sample_rate, flush_interval=FLUSH_INTERVAL, ring_seconds=RING_SECONDS, on_file_opened=None,
+                 container=CONTAINER_WAV, header_interval=HEADER_INTERVAL, fsync=FSYNC_ON_PATCH, pre_roll_seconds=PRE_ROLL_SECONDS,
+                 make_analyzers=None, file_sample_width=None, format_tag=WAVE_FORMAT_PCM):
+        self.channels = channels
+        # sample width of the stream (and the ring buffer), and of the files written
+        self.sample_width = sample_width
+        self.file_sample_width = file_sample_width or sample_width
+        if self.file_sample_width != sample_width and (sample_width, self.file_sample_width) != (4, 3):
+            raise ValueError(f"Cannot write {sample_width} byte samples as {self.file_sample_width} byte samples")
+        self.frame_size = channels * sample_width
+        self.sample_rate = sample_rate
+        self.format_tag = format_tag
+        self.flush_interval = flush_interval
+        self.ring = RingBuffer(int(ring_seconds * sample_rate) * self.frame_size)
+        self.pre_roll = None
+        if pre_roll_seconds > 0:
+            self.pre_roll = PreRollBuffer(int(pre_roll_seconds * sample_rate) * self.frame_size)
+
+        self.max_backlog = 0
+        self.bytes_written = 0
+        # time the writer thread spent draining, so bytes_written / busy_seconds is how fast it can write
+        self.busy_seconds = 0.0
+        self.on_file_opened = on_file_opened
+        # output file settings, see WavWriter
+        self.container = container
+        self.header_interval = header_interval
+        self.fsync = fsync
+        self.make_analyzers = make_analyzers
+        # analyzers of the take currently (or last) being written, by name
+        self.analyzers = {}
+
+        self._analysis_take = None
+        self._analysis_frame = 0
+        # take whose writer backlog and dropped blocks are being counted, see _begin_analysis
+        self._telemetry_take = None
+        self._take_max_backlog = 0
+        self._take_overflows = 0
+        self._pack_scratch = None
+        self._file = None
+        self._take = None
+        self._commands = []
+        self._commands_lock = threading.Lock()
+        # where the last file was closed and whether one is open, as of the last command issued
+        self._last_close_pos = 0
+        self._open_issued = False
+        self._last_command_pos = 0
+        # (time, frame) at the start of the first and the last block pushed since reset_clock()
+        self._clock_origin = None
+        self._clock = None
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self._running:
+            return
+        # commands still waiting for audio that will never come are applied at the end of what there is
+        self.close(wait=False)
+        self._running = False
+        self._wake.set()
+        self._thread.join()
+
+    def push(self, in_data, timestamp=None):
+        # called from the audio callback, only copies into the preallocated ring.
+        # `timestamp` is when the block's first frame was captured, on the perf_counter clock
+        frame = self.ring.write_pos // self.frame_size
+        if timestamp is None:
+            timestamp = time.perf_counter() - len(in_data) / self.frame_size / self.sample_rate
+        self._clock = (timestamp, frame)
+        if self._clock_origin is None:
+            self._clock_origin = self._clock
+
+        self.ring.write(in_data)
+        backlog = self.ring.available()
+        if backlog > self.max_backlog:
+            self.max_backlog = backlog
+
+    def reset_clock(self):
+        # call when the stream is (re)started, a gap in the audio would read as drift
+        self._clock_origin = None
+        self._clock = None
+
+    def frame_at(self, timestamp):
+        # stream frame captured at `timestamp`, or None before any audio arrived
+        clock = self._clock
+        if clock is None:
+            return None
+        clock_time, clock_frame = clock
+        return clock_frame + round((timestamp - clock_time) * self.sample_rate)
+
+    def time_at(self, frame):
+        # when stream frame `frame` was (or will be) captured, the inverse of frame_at
+        clock = self._clock
+        if clock is None:
+            return None
+        clock_time, clock_frame = clock
+        return clock_time + (frame - clock_frame) / self.sample_rate
+
+    def drift_ppm(self):
+        # how much faster (+) or slower (-) than the perf_counter clock the device's sample clock runs,
+        # None until there is a second of audio to measure it over
+        origin, clock = self._clock_origin, self._clock
+        if origin is None or clock is None or clock[0] - origin[0] < 1.0:
+            return None
+        elapsed = clock[0] - origin[0]
+        return ((clock[1] - origin[1]) / self.sample_rate - elapsed) / elapsed * 1e6
+
+    @property
+    def position(self):
+        # current frame index of the input stream, as seen by the callback
+        return self.ring.write_pos // self.frame_size
+
+    @property
+    def pre_roll_frames(self):
+        if self.pre_roll is None:
+            return 0
+        return self.pre_roll.capacity // self.frame_size
+
+    def open(self, take, analysis_take=None, frame=None):
+        # `analysis_take` gets the analysis results instead of `take`, for files holding several takes
+        self._send("open", analysis_take or take, take, frame)
+
+    def close(self, wait=True, frame=None):
+        done = threading.Event()
+        self._send("close", done, frame=frame)
+        if wait:
+            done.wait()
+        return done
+
+    def rotate(self, take, frame=None):
+        # close the current take and open the next one at the same sample, nothing is lost in between
+        self._send("rotate", take, take, frame)
+
+    def split(self, finished, next_take=None, next_origin=None):
+        # for a file holding several takes: end the analysis of `finished` here, get it onto disk and set
+        # its `closed`, then start analysing `next_take`, whose first frame is stream frame `next_origin`
+        self._send("split", (finished, next_take, next_origin))
+
+    @property
+    def overflows(self):
+        return self.ring.overflows
+
+    @property
+    def dropped_frames(self):
+        return self.ring.dropped_bytes // self.frame_size
+
+    @property
+    def backlog_frames(self):
+        return self.ring.available() // self.frame_size
+
+    def stats(self):
+        return {
+            'overflows': self.overflows,
+            'dropped_frames': self.dropped_frames,
+            'backlog_frames': self.backlog_frames,
+            'max_backlog_frames': self.max_backlog // self.frame_size,
+            'bytes_written': self.bytes_written,
+            'busy_seconds': self.busy_seconds,
+        }
+
+    def _send(self, name, arg, take=None, frame=None):
+        with self._commands_lock:
+            position = self.ring.write_pos
+            if frame is not None:
+                # never before what the writer has already drained
+                position = max(frame * self.frame_size, self.ring.read_pos)
+            # commands are applied in order, none can go back before the last one
+            position = max(position, self._last_command_pos)
+            self._last_command_pos = position
+            pre_roll = 0
+            if name == "open":
+                if not self._open_issued and self.pre_roll is not None:
+                    # the pre-roll buffer holds everything since the last file was closed, up to its size
+                    pre_roll = min(self.pre_roll.capacity, position - self._last_close_pos)
+                self._open_issued = True
+            elif name == "close":
+                self._last_close_pos = position
+                self._open_issued = False
+            if take is not None:
+                take.start_frame = (position - pre_roll) // self.frame_size
+                take.start_time = time.time() - pre_roll // self.frame_size / self.sample_rate
+            self._commands.append((position, name, take, arg, pre_roll))
+        self._wake.set()
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            started = time.perf_counter()
+            self._drain()
+            self.busy_seconds += time.perf_counter() - started
+        self._drain(final=True)
+
+    def _drain(self, final=False):
+        # snapshot the end position together with the commands, anything issued after this
+        # point refers to audio at or beyond it. commands for audio that has not arrived yet
+        # wait for a later drain, unless this is the last one
+        with self._commands_lock:
+            end = self.ring.write_pos
+            ready = len(self._commands)
+            if not final:
+                ready = next((i for i, command in enumerate(self._commands) if command[0] > end), ready)
+            commands, self._commands = self._commands[:ready], self._commands[ready:]
+        # how far behind the writer is as it wakes up, the most it gets behind between drains
+        self._take_max_backlog = max(self._take_max_backlog, end - self.ring.read_pos)
+
+        for position, name, take, arg, pre_roll in commands:
+            if position > end:
+                position = end
+                if take is not None:
+                    take.start_frame = end // self.frame_size
+            self._write_until(position)
+            if name == "open":
+                self._open_file(take, position, pre_roll, arg)
+            elif name == "close":
+                self._close_file(position)
+                arg.set()
+            elif name == "rotate":
+                self._close_file(position)
+                self._open_file(take, position)
+            elif name == "split":
+                finished, next_take, origin = arg
+                self._end_analysis()
+                if self._file is not None:
+                    self._file.flush()
+                if finished is not None:
+                    finished.closed.set()
+                if next_take is not None:
+                    self._begin_split_analysis(next_take, position // self.frame_size - origin)
+
+        self._write_until(end)
+
+    def _write_until(self, position):
+        size = position - self.ring.read_pos
+        if size <= 0:
+            return
+        if self._file is not None:
+            for view in self.ring.peek(size):
+                self._write_file(view)
+                if self._analysis_take is not None:
+                    self._analyze(view)
+                elif self.pre_roll is not None:
+                    # a session file between takes: kept so the next take's analysis can start with its pre-roll
+                    self.pre_roll.write(view)
+        elif self.pre_roll is not None:
+            for view in self.ring.peek(size):
+                self.pre_roll.write(view)
+        # with no open file and no pre-roll the audio is simply skipped
+        self.ring.advance(size)
+
+    def _open_file(self, take, position, pre_roll=0, analysis_take=None):
+        self._close_file(position)
+        self._file = WavWriter(take.file_path, self.channels, self.file_sample_width, self.sample_rate, container=self.container,
+                               format_tag=self.format_tag, header_interval=self.header_interval, fsync=self.fsync)
+        self._take = take
+        self._begin_analysis(analysis_take or take, 0)
+        if pre_roll:
+            for view in self.pre_roll.tail(pre_roll):
+                self._write_file(view)
+                self._analyze(view)
+        if self.pre_roll is not None:
+            self.pre_roll.clear()
+        if self.on_file_opened is not None:
+            self.on_file_opened(take.file_path)
+
+    def _write_file(self, view):
+        if self.file_sample_width == self.sample_width:
+            self._file.write(view)
+            self.bytes_written += len(view)
+            return
+        # little endian, so the top three bytes of an int32 are bytes 1-3
+        samples = np.frombuffer(view, np.uint8).reshape(-1, 4)
+        if self._pack_scratch is None:
+            self._pack_scratch = np.empty((PACK_BLOCK_SAMPLES, 3), np.uint8)
+        for start in range(0, samples.shape[0], PACK_BLOCK_SAMPLES):
+            block = samples[start:start + PACK_BLOCK_SAMPLES]
+            packed = self._pack_scratch[:block.shape[0]]
+            np.copyto(packed, block[:, 1:])
+            self._file.write(packed)
+            self.bytes_written += packed.nbytes
+
+    def _close_file(self, position):
+        self._end_analysis()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._take is not None:
+            self._take.end_frame = position // self.frame_size
+            self._take.closed.set()
+            self._take = None
+
+    def _begin_analysis(self, take, frame_offset):
+        self._end_analysis()
+        self._telemetry_take = take
+        self._take_max_backlog = 0
+        self._take_overflows = self.ring.overflows
+        if self.make_analyzers is None:
+            return
+        self.analyzers = {analyzer.name: analyzer for analyzer in self.make_analyzers(take)}
+        self._analysis_take = take
+        self._analysis_frame = frame_offset
+
+    def _begin_split_analysis(self, take, written_frames):
+        # a take of a session file that starts `written_frames` before the split (its pre-roll after a hold),
+        # that audio is already in the file. it is analysed from the pre-roll buffer, from the take's first frame
+        views = self.pre_roll.tail(written_frames * self.frame_size) if self.pre_roll is not None and written_frames > 0 else []
+        self._begin_analysis(take, written_frames - sum(len(view) for view in views) // self.frame_size)
+        for view in views:
+            self._analyze(view)
+        if self.pre_roll is not None:
+            self.pre_roll.clear()
+
+    def _analyze(self, view):
+        if self._analysis_take is None:
+            return
+        block_size = ANALYSIS_BLOCK_FRAMES * self.frame_size
+        try:
+            for start in range(0, len(view), block_size):
+                samples = decode_samples(view[start:start + block_size], self.sample_width, self.format_tag).reshape(-1, self.channels)
+                for analyzer in self.analyzers.values():
+                    analyzer.process(samples, self._analysis_frame)
+                self._analysis_frame += samples.shape[0]
+        except Exception as e:
+            # a broken analyzer must never stop the recording
+            print(f"Take analysis failed: {e}")
+            self._analysis_take = None
+
+    def _end_analysis(self):
+        if self._telemetry_take is not None:
+            self._telemetry_take.telemetry.update(max_backlog_frames=self._take_max_backlog // self.frame_size,
+                                                  dropped_blocks=self.ring.overflows - self._take_overflows)
+            self._telemetry_take = None
+        if self._analysis_take is None:
+            return
+        try:
+            self._analysis_take.analysis = {name: analyzer.finish() for name, analyzer in self.analyzers.items()}
+        except Exception as e:
+            print(f"Take analysis failed: {e}")
+        self._analysis_take = None
+
+
+class CaptureGroup:
+    """ One CaptureWriter per input device, driven like a single writer.
+
+    Every writer has its own stream callback, ring buffer and thread, so a slow device or disk
+    only ever holds up its own file. Each command is issued to the first (primary) writer as
+    usual and to the others at the frame each of them captured at the same instant, going by
+    the writers' clocks, so take boundaries line up across devices to within the clocks'
+    accuracy.
+
+    Takes given to the group are recorded by the primary writer. For every other device the
+    group adds a Take to `take.device_takes`, writing to a file named after the take's with
+    `_dev<n>` appended. Analysis and session splits only apply to the primary.
+    """
+
+    def __init__(self, writers, device_names=None):
+        self.writers = writers
+        self.primary = writers[0]
+        self.device_names = device_names or [f"device {i}" for i in range(len(writers))]
+        # takes the other devices are recording right now
+        self._device_takes = []
+
+    @property
+    def sample_rate(self):
+        return self.primary.sample_rate
+
+    @property
+    def position(self):
+        return self.primary.position
+
+    @property
+    def pre_roll_frames(self):
+        return self.primary.pre_roll_frames
+
+    @property
+    def analyzers(self):
+        return self.primary.analyzers
+
+    def start(self):
+        for writer in self.writers:
+            writer.start()
+
+    def stop(self):
+        for writer in self.writers:
+            writer.stop()
+
+    def reset_clock(self):
+        for writer in self.writers:
+            writer.reset_clock()
+
+    def open(self, take, analysis_take=None):
+        frames = self._aligned_frames()
+        self._end_device_takes()
+        self.primary.open(take, analysis_take)
+        for i, (writer, frame) in enumerate(zip(self.writers[1:], frames), 1):
+            writer.open(self._device_take(take, i), frame=frame)
+
+    def close(self, wait=True):
+        frames = self._aligned_frames()
+        self._end_device_takes()
+        done = [self.primary.close(wait=False)]
+        for writer, frame in zip(self.writers[1:], frames):
+            done.append(writer.close(wait=False, frame=frame))
+        if wait:
+            for event in done:
+                event.wait()
+        return done[0]
+
+    def rotate(self, take):
+        frames = self._aligned_frames()
+        self._end_device_takes()
+        self.primary.rotate(take)
+        for i, (writer, frame) in enumerate(zip(self.writers[1:], frames), 1):
+            writer.rotate(self._device_take(take, i), frame=frame)
+
+    def split(self, finished, next_take=None, next_origin=None):
+        self.primary.split(finished, next_take, next_origin)
+
+    def drift_ppm(self):
+        # sample clock drift of every other device against the primary, by device name
+        return {name: self._drift_ppm(writer) for name, writer in zip(self.device_names[1:], self.writers[1:])}
+
+    def stats(self):
+        stats = self.primary.stats()
+        for writer in self.writers[1:]:
+            for key, value in writer.stats().items():
+                stats[key] = max(stats[key], value) if key.startswith('max_') else stats[key] + value
+        return stats
+
+    def _aligned_frames(self):
+        # frames of the other devices captured at the instant the primary is at right now
+        now = self.primary.time_at(self.primary.position)
+        if now is None:
+            return [None] * (len(self.writers) - 1)
+        return [writer.frame_at(now) for writer in self.writers[1:]]
+
+    def _device_take(self, take, device):
+        stem, extension = os.path.splitext(take.file_path)
+        device_take = Take(f"{stem}_dev{device}{extension}")
+        device_take.take_id = take.take_id
+        device_take.device = self.device_names[device]
+        take.device_takes.append(device_take)
+        self._device_takes.append((device_take, self.writers[device]))
+        return device_take
+
+    def _end_device_takes(self):
+        # the drift is measured over the whole stream so far, a longer run gives a steadier figure
+        for device_take, writer in self._device_takes:
+            device_take.drift_ppm = self._drift_ppm(writer)
+        self._device_takes = []
+
+    def _drift_ppm(self, writer):
+        primary_drift, drift = self.primary.drift_ppm(), writer.drift_ppm()
+        if primary_drift is None or drift is None:
+            return None
+        return round(drift - primary_drift, 2)
+
+
+class BackgroundWorker:
+    """ Runs queued jobs one at a time on a daemon thread. """
+
+    def __init__(self, name):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        self._queue.put((fn, args))
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def wait(self):
+        # block until every job submitted so far has run
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"Background job failed: {e}")
+            finally:
+                self._queue.task_done()
+
+
+class TakeSequencer:
+    """ Take transition state machine driving a CaptureWriter.
+
+    idle -> recording       start()
+    recording -> recording  mark(verdict), the next take starts on the very sample the last one ended
+    recording -> held       hold(), the take is closed but has no verdict yet (e.g. while replaying it)
+    held -> recording       mark(verdict)
+    recording/held -> idle  end(), whatever was not marked is scrapped
+
+    None of the transitions touch the disk, finished takes are handed to `finish_take` on a
+    background worker once the writer has closed them.
+    """
+
+    def __init__(self, writer, new_take_path, finish_take, worker=None):
+        self.writer = writer
+        self.state = TAKE_IDLE
+        self.current = None
+        self._new_take_path = new_take_path
+        self._finish_take = finish_take
+        self._worker = worker or BackgroundWorker("take-finisher")
+
+    def start(self):
+        if self.state != TAKE_IDLE:
+            return self.current
+        self.current = Take(self._new_take_path())
+        self.writer.open(self.current)
+        self.state = TAKE_RECORDING
+        return self.current
+
+    def mark(self, verdict):
+        if self.state == TAKE_IDLE:
+            return None
+
+        finished = self.current
+        finished.verdict = verdict
+        self.current = Take(self._new_take_path())
+        if self.state == TAKE_RECORDING:
+            self.writer.rotate(self.current)
+        else:
+            self.writer.open(self.current)
+        self.state = TAKE_RECORDING
+        self._finish(finished)
+        return finished
+
+    def hold(self):
+        if self.state == TAKE_RECORDING:
+            self.writer.close(wait=False)
+            self.state = TAKE_HELD
+        return self.current
+
+    def end(self):
+        if self.state == TAKE_IDLE:
+            return
+        if self.state == TAKE_RECORDING:
+            self.writer.close(wait=False)
+        scraps = self.current
+        scraps.verdict = None
+        self.current = None
+        self.state = TAKE_IDLE
+        self._finish(scraps)
+
+    def wait(self):
+        # block until every finished take has been handed off
+        self._worker.wait()
+
+    def _finish(self, take):
+        self._worker.submit(self._finish_when_closed, take)
+
+    def _finish_when_closed(self, take):
+        take.closed.wait()
+        for device_take in take.device_takes:
+            # a device that stopped delivering audio must not hold up the others
+            if not device_take.closed.wait(DEVICE_CLOSE_TIMEOUT):
+                print(f"Gave up waiting for '{device_take.file_path}' to be closed")
+        self._finish_take(take)
+
+
+class SessionSequencer(TakeSequencer):
+    """ Same transitions as TakeSequencer, but the whole session is captured to one file.
+
+    Marking a take never opens or closes a file, it only tells the writer where the take's
+    analysis ends and then appends the take's frame range, verdict and analysis results to
+    the session's TakeIndex. Takes handed out by this sequencer have frame offsets relative
+    to the capture file. `finish_session` gets the capture Take once the session ends
+    and its file is closed.
+    """
+
+    def __init__(self, writer, new_session_path, finish_session, worker=None):
+        super().__init__(writer, new_session_path, finish_session, worker)
+        self.capture = None
+        self.index = None
+        self._take_count = 0
+
+    def start(self):
+        if self.state != TAKE_IDLE:
+            return self.current
+        self.capture = Take(self._new_take_path())
+        self._take_count = 0
+        self.current = self._begin_take(None)
+        self.writer.open(self.capture, self.current)
+        self.current.start_frame = 0
+        self.current.start_time = self.capture.start_time
+        self.index = TakeIndex(take_index_path(self.capture.file_path))
+        self.state = TAKE_RECORDING
+        return self.current
+
+    def mark(self, verdict):
+        if self.state == TAKE_IDLE:
+            return None
+
+        position = self.writer.position
+        finished = self.current
+        if self.state == TAKE_RECORDING:
+            finished.end_frame = position - self.capture.start_frame
+            self.current = self._begin_take(position)
+            self.writer.split(finished, self.current, position)
+        else:
+            # capture kept running while held, so the pre-roll is already in the file
+            start = max(position - self.writer.pre_roll_frames, finished.end_frame + self.capture.start_frame)
+            self.current = self._begin_take(start)
+            self.writer.split(None, self.current, start)
+        finished.verdict = verdict
+        self.state = TAKE_RECORDING
+        self._worker.submit(self._record_when_closed, finished, self.index)
+        return finished
+
+    def hold(self):
+        if self.state == TAKE_RECORDING:
+            self.current.end_frame = self.writer.position - self.capture.start_frame
+            # capture keeps running, the take is complete on disk once the writer gets past it
+            self.writer.split(self.current)
+            self.state = TAKE_HELD
+        return self.current
+
+    def end(self):
+        if self.state == TAKE_IDLE:
+            return
+        self.writer.close(wait=False)
+        capture = self.capture
+        self.current = None
+        self.capture = None
+        self.state = TAKE_IDLE
+        self._finish(capture)
+
+    def _begin_take(self, position):
+        self._take_count += 1
+        take = Take(self.capture.file_path)
+        take.take_id = self._take_count
+        if position is not None:
+            take.start_frame = position - self.capture.start_frame
+            take.start_time = self.capture.start_time + take.start_frame / self.writer.sample_rate
+        return take
+
+    def _record_when_closed(self, take, index):
+        take.closed.wait()
+        verdict = VERDICT_GOOD if take.verdict else VERDICT_BAD
+        index.add(take.take_id, take.start_frame, take.end_frame, verdict, self.writer.sample_rate,
+                  start_time=take.start_time, telemetry=take.telemetry, **take.analysis)
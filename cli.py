@@ -0,0 +1,156 @@
+""" Headless recorder: the same engine as the window, driven from a terminal or a script.
+
+Interactive commands, one per line on stdin:
+    s   start the session, or end it if one is running
+    g   finish a good take
+    b   finish a bad take
+    r   replay the current take on repeat
+    t   replay the end of the current take
+    a   assemble the good takes
+    q   quit
+
+With --script the commands are taken from the argument instead, separated by spaces, and
+`wait:<seconds>` pauses in between, e.g. --script "s wait:5 g wait:3 b s". With --synthetic
+or --input-file no sound card is needed, and --speed runs the source faster than real time.
+With --osc-port or --http-port the same commands can also come from other devices, see control.py.
+"""
+import argparse
+import os
+import sys
+import time
+
+from backends import PyAudioBackend, SyntheticBackend, FileBackend
+from engine import Recorder, REPLAY_TAIL_SECONDS, EVENT_TAKE_SAVED, EVENT_LEVELS, LEFTOVER_KEEP, LEFTOVER_DISCARD, LEFTOVER_DELETE, LEFTOVER_SKIP
+from capture import TAKE_IDLE
+from control import ControlServer, CONTROL_HOST
+from profiles import CAPTURE_PROFILES, DEFAULT_PROFILE, profile_label
+from telemetry import Telemetry, default_log_path, app_data_dir
+
+# how often the level line is printed with --levels, in seconds
+LEVEL_PRINT_INTERVAL = 1.0
+
+
+def run_command(recorder, command, session_file):
+    if command.startswith('wait:'):
+        time.sleep(float(command[5:]))
+    elif command == 's':
+        if recorder.state == TAKE_IDLE:
+            recorder.start_session(session_file)
+        else:
+            recorder.end_session()
+    elif command == 'g':
+        recorder.mark_take(True)
+    elif command == 'b':
+        recorder.mark_take(False)
+    elif command == 'r':
+        recorder.replay()
+    elif command == 't':
+        recorder.replay(REPLAY_TAIL_SECONDS)
+    elif command == 'a':
+        recorder.assemble_good_takes()
+    elif command == 'q':
+        return False
+    elif command:
+        print(f"Unknown command '{command}'")
+    return True
+
+
+def print_levels(recorder):
+    last = [0.0]
+
+    def on_levels(levels):
+        now = time.monotonic()
+        if now - last[0] >= LEVEL_PRINT_INTERVAL:
+            last[0] = now
+            print(f"RMS {levels['rms_db']:6.1f} dBFS | Peak {levels['peak_db']:6.1f} dBFS | Clips {levels['clips']} | Health {recorder.health()[1]}")
+    recorder.subscribe(EVENT_LEVELS, on_levels)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Edit-as-you-go Sound Recorder without a window")
+    parser.add_argument('--directory', default=os.getcwd(), help="session directory, the current one by default")
+    parser.add_argument('--device', type=int, help="index of the input device, see --list-devices")
+    parser.add_argument('--also', type=int, action='append', default=[], help="another input device to record at the same time")
+    parser.add_argument('--profile', type=int, default=CAPTURE_PROFILES.index(DEFAULT_PROFILE), help="capture profile number, see --list-profiles")
+    parser.add_argument('--session-file', action='store_true', help="record the whole session into one file")
+    parser.add_argument('--synthetic', action='store_true', help="record a synthetic tone instead of a device")
+    parser.add_argument('--input-file', help="record this WAV file instead of a device")
+    parser.add_argument('--speed', type=float, default=1.0, help="how much faster than real time the synthetic or file source runs")
+    parser.add_argument('--cues', action='store_true', help="play the audio cues")
+    parser.add_argument('--levels', action='store_true', help="print the input level every second")
+    parser.add_argument('--leftovers', choices=[LEFTOVER_KEEP, LEFTOVER_DISCARD, LEFTOVER_DELETE, LEFTOVER_SKIP], default=LEFTOVER_SKIP,
+                        help="what to do with temp recordings left behind by a crash")
+    parser.add_argument('--log', default=default_log_path(), help="rotating JSON lines log of the capture health and everything printed")
+    parser.add_argument('--osc-port', type=int, help="take remote commands as OSC messages on this UDP port")
+    parser.add_argument('--http-port', type=int, help="take remote commands as HTTP requests on this port")
+    parser.add_argument('--control-host', default=CONTROL_HOST, help="address the remote control listens on, 0.0.0.0 for the whole network")
+    parser.add_argument('--script', help="commands to run instead of reading them from stdin")
+    parser.add_argument('--list-devices', action='store_true')
+    parser.add_argument('--list-profiles', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.list_profiles:
+        for i, profile in enumerate(CAPTURE_PROFILES):
+            print(f"{i}: {profile_label(profile)}")
+        return 0
+
+    if args.input_file:
+        backend = FileBackend(args.input_file, speed=args.speed)
+    elif args.synthetic:
+        backend = SyntheticBackend(speed=args.speed, devices=1 + len(args.also))
+    else:
+        backend = PyAudioBackend()
+
+    if args.list_devices:
+        for device in backend.input_devices():
+            print(f"{device['index']}: {device['name']}")
+        return 0
+
+    cues = None
+    if args.cues:
+        # only made when asked for, it needs pygame and a sound output
+        from cues import CuePlayer, CUE_CACHE_DIR
+        cues = CuePlayer(os.path.join(app_data_dir(), CUE_CACHE_DIR))
+
+    recorder = Recorder(backend, args.directory, cues, CAPTURE_PROFILES[args.profile], telemetry=Telemetry(args.log, log_prints=True))
+    recorder.subscribe(EVENT_TAKE_SAVED, lambda record: print(f"Saved take {record['take']} ({record['verdict']}, {record.get('duration', 0):.1f} s): {record['file']}"))
+    if args.levels:
+        print_levels(recorder)
+    recorder.handle_leftovers(lambda file_path, report: args.leftovers)
+
+    device = args.device
+    if device is None:
+        devices = backend.input_devices()
+        if not devices:
+            print("No audio input devices found")
+            return 1
+        device = devices[0]['index']
+    profile = recorder.select_device(device, args.also)
+    if profile != CAPTURE_PROFILES[args.profile]:
+        print(f"Recording {profile_label(profile)} instead")
+
+    control = None
+    if args.osc_port is not None or args.http_port is not None:
+        control = ControlServer(recorder, args.control_host, args.osc_port, args.http_port, args.session_file)
+        control.start()
+
+    try:
+        commands = args.script.split() if args.script is not None else (line.strip() for line in sys.stdin)
+        for command in commands:
+            if not run_command(recorder, command, args.session_file):
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if control is not None:
+            control.stop()
+        # unlike closing the window, quitting scraps the take in progress and waits for the rest to be saved
+        recorder.end_session()
+        recorder.wait()
+        recorder.close()
+        backend.terminate()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
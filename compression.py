@@ -0,0 +1,219 @@
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from wavfile import read_wav_info, WAVE_FORMAT_IEEE_FLOAT, COPY_CHUNK_SIZE
+
+CODEC_FLAC = 'flac'
+CODEC_WAVPACK = 'wavpack'
+
+# extension, encode command and decode command of every codec, run through the codec's own command line tools
+CODECS = {
+    CODEC_FLAC: ('.flac', ['flac', '--silent', '--force', '-5', '-o', '{dest}', '{src}'],
+                 ['flac', '--silent', '--force', '--decode', '-o', '{dest}', '{src}']),
+    CODEC_WAVPACK: ('.wv', ['wavpack', '-q', '-y', '{src}', '-o', '{dest}'],
+                    ['wvunpack', '-q', '-y', '{src}', '-o', '{dest}']),
+}
+
+# encoder processes running at once, kept low so recording always has a core to itself
+COMPRESS_WORKERS = 2
+
+# windows process flags: BELOW_NORMAL_PRIORITY_CLASS, and CREATE_NO_WINDOW for the command line tools
+BELOW_NORMAL_PRIORITY_CLASS = 0x00004000
+CREATE_NO_WINDOW = 0x08000000
+
+
+def codec_available(codec):
+    _, encode, decode = CODECS[codec]
+    return shutil.which(encode[0]) is not None and shutil.which(decode[0]) is not None
+
+
+def compressed_path(wav_path, codec):
+    return os.path.splitext(wav_path)[0] + CODECS[codec][0]
+
+
+def codec_for_path(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    for codec, (codec_extension, _, _) in CODECS.items():
+        if codec_extension == extension:
+            return codec
+    return None
+
+
+def decode_to_wav(file_path, wav_path):
+    # expand a FLAC/WavPack take back to a WAV, e.g. to read its audio
+    _run(CODECS[codec_for_path(file_path)][2], file_path, wav_path)
+
+
+def compress_take(wav_path, codec):
+    """ Encode a WAV take, check the result decodes back to the exact same samples, then delete the WAV.
+
+    Runs in a worker process. Returns (compressed path, wav bytes, compressed bytes, seconds of
+    audio). Raises and leaves the WAV alone if anything does not match.
+    """
+    info = read_wav_info(wav_path)
+    if info.format_tag == WAVE_FORMAT_IEEE_FLOAT and codec == CODEC_FLAC:
+        raise ValueError(f"FLAC cannot hold the float samples of '{wav_path}'")
+
+    dest_path = compressed_path(wav_path, codec)
+    verify_path = dest_path + '.verify.wav'
+    _, encode, decode = CODECS[codec]
+    try:
+        _run(encode, wav_path, dest_path)
+        _run(decode, dest_path, verify_path)
+        if not _same_audio(wav_path, verify_path):
+            raise ValueError(f"'{dest_path}' does not decode to the samples of '{wav_path}'")
+    except Exception:
+        _remove(dest_path)
+        raise
+    finally:
+        _remove(verify_path)
+
+    wav_size = os.path.getsize(wav_path)
+    os.remove(wav_path)
+    seconds = info.data_size / (info.channels * info.sample_width * info.sample_rate)
+    return dest_path, wav_size, os.path.getsize(dest_path), seconds
+
+
+def _run(command, src, dest):
+    command = [part.format(src=src, dest=dest) for part in command]
+    flags = CREATE_NO_WINDOW if os.name == 'nt' else 0
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, creationflags=flags)
+    if result.returncode != 0:
+        raise OSError(f"{command[0]} failed: {result.stderr.decode(errors='replace').strip()}")
+
+
+def _same_audio(path, other_path):
+    # the headers may be laid out differently, only the format and the sample data have to match
+    info = read_wav_info(path)
+    other = read_wav_info(other_path)
+    if (info.channels, info.sample_width, info.sample_rate, info.data_size) != \
+            (other.channels, other.sample_width, other.sample_rate, other.data_size):
+        return False
+    with open(path, 'rb') as f, open(other_path, 'rb') as other_f:
+        f.seek(info.data_offset)
+        other_f.seek(other.data_offset)
+        remaining = info.data_size
+        while remaining > 0:
+            size = min(COPY_CHUNK_SIZE, remaining)
+            if f.read(size) != other_f.read(size):
+                return False
+            remaining -= size
+    return True
+
+
+def _remove(file_path):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+def _lower_priority():
+    # runs first in every worker process, the codec tools it starts inherit the priority
+    try:
+        if os.name == 'nt':
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), BELOW_NORMAL_PRIORITY_CLASS)
+        else:
+            os.nice(10)
+    except Exception as e:
+        print(f"Could not lower the encoder priority: {e}")
+
+
+class TakeCompressor:
+    """ Compresses saved takes to FLAC or WavPack in a small pool of low priority processes.
+
+    `on_compressed(context, result)` is called with whatever was passed to `submit` and the
+    result of compress_take once a take is encoded and verified. Failed takes keep their WAV.
+    `stats()` tells whether the pool keeps up with recording: the queue depth should stay low
+    and `realtime_factor` (seconds of audio encoded per second the pool was busy) above 1.
+    """
+
+    def __init__(self, codec, on_compressed=None, max_workers=COMPRESS_WORKERS):
+        self.codec = codec
+        self.on_compressed = on_compressed
+        # spawned, not forked: a fork taken while the capture, meter and log threads run can inherit a lock one
+        # of them holds, e.g. the log's, and the worker's first print would then wait on it forever
+        self._pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'), initializer=_lower_priority)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._busy_since = None
+        self._busy_seconds = 0.0
+        self.compressed = 0
+        self.failed = 0
+        self.wav_bytes = 0
+        self.compressed_bytes = 0
+        self.audio_seconds = 0.0
+
+    def submit(self, wav_path, context=None):
+        with self._lock:
+            if self._pending == 0:
+                self._busy_since = time.monotonic()
+            self._pending += 1
+        future = self._pool.submit(compress_take, wav_path, self.codec)
+        future.add_done_callback(lambda future: self._done(future, wav_path, context))
+        return future
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def stats(self):
+        with self._lock:
+            busy_seconds = self._busy_seconds
+            if self._busy_since is not None:
+                busy_seconds += time.monotonic() - self._busy_since
+            return {
+                'pending': self._pending,
+                'compressed': self.compressed,
+                'failed': self.failed,
+                'ratio': self.compressed_bytes / self.wav_bytes if self.wav_bytes else 0.0,
+                'megabytes_per_second': self.wav_bytes / busy_seconds / 1e6 if busy_seconds else 0.0,
+                'realtime_factor': self.audio_seconds / busy_seconds if busy_seconds else 0.0,
+            }
+
+    def shutdown(self):
+        # takes still queued keep their WAV, the ones being encoded are finished first
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def _done(self, future, wav_path, context):
+        # runs on the pool's management thread
+        if future.cancelled():
+            # shut down before its turn came, the take keeps its WAV
+            self._settle(None)
+            return
+
+        result = None
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Could not compress '{wav_path}', keeping the WAV: {e}")
+        self._settle(result, failed=result is None)
+
+        if result is not None and self.on_compressed is not None:
+            try:
+                self.on_compressed(context, result)
+            except Exception as e:
+                print(f"Error after compressing '{wav_path}': {e}")
+
+    def _settle(self, result, failed=False):
+        # one job less to wait for: count how it went, and stop the busy clock when the pool runs dry
+        with self._lock:
+            self._pending -= 1
+            if failed:
+                self.failed += 1
+            elif result is not None:
+                _, wav_bytes, compressed_bytes, seconds = result
+                self.compressed += 1
+                self.wav_bytes += wav_bytes
+                self.compressed_bytes += compressed_bytes
+                self.audio_seconds += seconds
+            if self._pending == 0:
+                self._busy_seconds += time.monotonic() - self._busy_since
+                self._busy_since = None
@@ -0,0 +1,380 @@
+""" Remote control of a Recorder from other devices: OSC over UDP and a small HTTP endpoint.
+
+A phone or tablet app, a foot pedal bridge or a script on the local network can drive the
+recorder with the same commands the window's keys do:
+
+    session/start  session/end  session/toggle  take/good  take/bad  take/replay  take/replay_tail
+
+Over OSC each command is a message to its address, e.g. `/take/good`. Buttons of OSC apps send
+1 when pressed and 0 when released, so a message whose first argument is 0 is ignored. After
+each command the sender gets a `/status` reply: state, health, RMS dBFS, peak dBFS, clips and
+the command's latency in ms. `/status` on its own only asks for that reply, and `/levels`
+subscribes the sender to `/levels` messages (RMS, peak, peak hold, clips) METER_RATE times a
+second for LEVELS_SUBSCRIPTION_SECONDS; clients send it again to stay subscribed.
+
+Over HTTP each command is a POST to its path, e.g. `POST /take/good`, answered with the status
+as JSON. `GET /status` returns the status and `GET /levels` is a stream of server-sent events,
+one JSON levels object per meter update. Commands sent by a web page are refused: any page open
+in the narrator's browser could otherwise end the session, even with the server bound to this
+machine only. Browsers mark such requests with an Origin header, and scripts, pedal bridges and
+apps send none.
+
+Commands run on the server's own threads, never the UI's, so a busy window cannot delay a mark.
+The latency of every mark, from the packet arriving to the take boundary being set, is kept,
+logged and reported in the status.
+"""
+import json
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from capture import TAKE_IDLE
+from engine import REPLAY_TAIL_SECONDS, EVENT_LEVELS
+from metering import METER_RATE
+
+# only this machine by default. "0.0.0.0" takes commands from the whole network, and anyone on it
+CONTROL_HOST = '127.0.0.1'
+OSC_PORT = 9000
+HTTP_PORT = 9001
+
+COMMANDS = ['session/start', 'session/end', 'session/toggle', 'take/good', 'take/bad', 'take/replay', 'take/replay_tail']
+# commands that set a take boundary, and have their latency kept
+MARK_COMMANDS = ['session/start', 'session/toggle', 'take/good', 'take/bad']
+
+# an OSC client that asked for /levels gets them for this many seconds
+LEVELS_SUBSCRIPTION_SECONDS = 10
+# marks slower than this, from the packet arriving to the take boundary, are reported
+MARK_LATENCY_TARGET = 0.010
+# how many of the latest mark latencies the status sums up
+MARK_LATENCY_HISTORY = 1000
+# largest OSC packet read
+OSC_MAX_PACKET = 8192
+# how often the OSC thread checks whether the server was stopped, in seconds
+OSC_POLL_SECONDS = 0.5
+
+
+class ControlServer:
+    """ Serves the remote commands of one Recorder over OSC (UDP) and HTTP until stopped.
+
+    Either port can be None to leave that protocol out. `session_file` is passed to
+    `start_session`, a UI keeps it in step with its own setting. `on_command` is called with
+    the command and whether it did anything, on the server's thread, after the recorder has
+    carried it out; a UI uses it to catch up with what happened.
+    """
+
+    def __init__(self, recorder, host=CONTROL_HOST, osc_port=OSC_PORT, http_port=HTTP_PORT, session_file=False, on_command=None):
+        self.recorder = recorder
+        self.host = host
+        self.osc_port = osc_port
+        self.http_port = http_port
+        self.session_file = session_file
+        self.on_command = on_command
+        # seconds from each mark command arriving to its boundary being set, newest last
+        self.mark_latencies = deque(maxlen=MARK_LATENCY_HISTORY)
+        self._osc_socket = None
+        self._http_server = None
+        # OSC clients subscribed to the levels, by address, with when their subscription runs out
+        self._level_clients = {}
+        self._subscribed = False
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        if self.osc_port is not None:
+            try:
+                self._osc_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self._osc_socket.bind((self.host, self.osc_port))
+                # closing a socket does not wake up a thread blocked on it everywhere, so it wakes up by itself
+                self._osc_socket.settimeout(OSC_POLL_SECONDS)
+            except OSError as e:
+                print(f"Could not listen for OSC on {self.host}:{self.osc_port}: {e}")
+                self._osc_socket = None
+            else:
+                self._start_thread(self._run_osc, "control-osc")
+                print(f"Listening for OSC on {self.host}:{self.osc_port}")
+        if self.http_port is not None:
+            try:
+                self._http_server = ThreadingHTTPServer((self.host, self.http_port), ControlRequestHandler)
+            except OSError as e:
+                print(f"Could not listen for HTTP on {self.host}:{self.http_port}: {e}")
+            else:
+                self._http_server.daemon_threads = True
+                self._http_server.control = self
+                self._start_thread(self._http_server.serve_forever, "control-http")
+                print(f"Listening for HTTP on http://{self.host}:{self.http_port}/")
+
+    def stop(self):
+        self._stopped.set()
+        if self._osc_socket is not None:
+            self._osc_socket.close()
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+
+    def execute(self, command, received=None):
+        """ Carry out one of COMMANDS on this thread.
+
+        `received` is the perf_counter time the command arrived. Returns the seconds from then
+        until the recorder had carried it out, or None if it did nothing.
+        """
+        received = received if received is not None else time.perf_counter()
+        recorder = self.recorder
+        if command == 'session/toggle':
+            command = 'session/start' if recorder.state == TAKE_IDLE else 'session/end'
+        if command == 'session/start':
+            if recorder.device_index is None:
+                print("No input device selected, the session cannot start")
+                done = False
+            else:
+                done = recorder.state == TAKE_IDLE and recorder.start_session(self.session_file) is not None
+        elif command == 'session/end':
+            done = recorder.state != TAKE_IDLE
+            recorder.end_session()
+        elif command in ('take/good', 'take/bad'):
+            done = recorder.mark_take(command == 'take/good') is not None
+        elif command == 'take/replay':
+            done = bool(recorder.replay())
+        elif command == 'take/replay_tail':
+            done = bool(recorder.replay(REPLAY_TAIL_SECONDS))
+        else:
+            raise ValueError(f"unknown command '{command}'")
+        latency = time.perf_counter() - received
+
+        if done and command in MARK_COMMANDS:
+            self.mark_latencies.append(latency)
+            recorder.telemetry.log('remote_mark', command=command, latency_ms=round(latency * 1000, 3))
+            if latency > MARK_LATENCY_TARGET:
+                print(f"Remote {command} took {latency * 1000:.1f} ms, over the {MARK_LATENCY_TARGET * 1000:g} ms target")
+        if self.on_command is not None:
+            try:
+                self.on_command(command, done)
+            except Exception as e:
+                print(f"Error in the remote command listener: {e}")
+        return latency if done else None
+
+    def status(self, latency=None):
+        recorder = self.recorder
+        level, text, _ = recorder.health()
+        status = {
+            'state': recorder.state,
+            'replaying': recorder.replaying,
+            'session_file': recorder.session_mode,
+            'health': level,
+            'health_text': text,
+            'levels': recorder.levels(),
+            'mark_latency_ms': self.mark_latency_summary(),
+        }
+        if latency is not None:
+            # of the command just carried out
+            status['latency_ms'] = round(latency * 1000, 3)
+        return status
+
+    def mark_latency_summary(self):
+        # median, 99th percentile and worst of the latest marks, in ms
+        latencies = sorted(self.mark_latencies)
+        if not latencies:
+            return {'count': 0}
+        return {
+            'count': len(latencies),
+            'p50': round(latencies[len(latencies) // 2] * 1000, 3),
+            'p99': round(latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3),
+        }
+
+    def _start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _run_osc(self):
+        while not self._stopped.is_set():
+            try:
+                packet, sender = self._osc_socket.recvfrom(OSC_MAX_PACKET)
+            except OSError:
+                # a timeout, closed by stop(), or an ICMP error from a client that went away (Windows)
+                if self._stopped.is_set():
+                    return
+                continue
+            received = time.perf_counter()
+            # whatever one datagram holds, it must never stop the listener
+            try:
+                messages = parse_osc(packet)
+            except Exception as e:
+                print(f"Ignoring a bad OSC packet from {sender[0]}: {e}")
+                continue
+            for address, arguments in messages:
+                try:
+                    self._osc_message(address, arguments, sender, received)
+                except Exception as e:
+                    print(f"Error in the OSC command {address}: {e}")
+
+    def _osc_message(self, address, arguments, sender, received):
+        command = address.strip('/')
+        if command == 'levels':
+            self._level_clients[sender] = time.monotonic() + LEVELS_SUBSCRIPTION_SECONDS
+            if not self._subscribed:
+                self._subscribed = True
+                self.recorder.subscribe(EVENT_LEVELS, self._send_levels)
+            return
+        latency = None
+        if command in COMMANDS:
+            if arguments and not arguments[0]:
+                # the button was let go
+                return
+            latency = self.execute(command, received)
+        elif command != 'status':
+            print(f"Unknown OSC command {address}")
+            return
+        status = self.status(latency)
+        levels = status['levels']
+        reply = osc_message('/status', status['state'], status['health_text'], float(levels['rms_db']), float(levels['peak_db']),
+                            int(levels['clips']), float(status.get('latency_ms', 0.0)))
+        self._osc_socket.sendto(reply, sender)
+
+    def _send_levels(self, levels):
+        # on the recorder's level thread
+        if not self._level_clients or self._stopped.is_set():
+            return
+        now = time.monotonic()
+        message = osc_message('/levels', float(levels['rms_db']), float(levels['peak_db']), float(levels['peak_hold_db']), int(levels['clips']))
+        for client, expires in list(self._level_clients.items()):
+            if expires < now:
+                del self._level_clients[client]
+                continue
+            try:
+                self._osc_socket.sendto(message, client)
+            except OSError:
+                del self._level_clients[client]
+
+
+class ControlRequestHandler(BaseHTTPRequestHandler):
+    # the HTTP side of a ControlServer, which is self.server.control
+
+    def do_GET(self):
+        control = self.server.control
+        if self.path == '/status':
+            self._send_json(control.status())
+        elif self.path == '/levels':
+            self._stream_levels(control)
+        else:
+            self._send_json({'error': f"nothing at {self.path}", 'commands': COMMANDS}, 404)
+
+    def do_POST(self):
+        received = time.perf_counter()
+        control = self.server.control
+        if self.headers.get('Origin') is not None:
+            # the server has no pages of its own, so this came from someone else's
+            self._send_json({'error': "commands from web pages are not accepted"}, 403)
+            return
+        command = self.path.strip('/')
+        if command not in COMMANDS:
+            self._send_json({'error': f"unknown command '{command}'", 'commands': COMMANDS}, 404)
+            return
+        latency = control.execute(command, received)
+        status = control.status(latency)
+        status['done'] = latency is not None
+        self._send_json(status)
+
+    def log_message(self, format, *args):
+        # requests are not worth a line each in the log
+        pass
+
+    def _send_json(self, value, code=200):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream_levels(self, control):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while not control._stopped.wait(1 / METER_RATE):
+                self.wfile.write(b'data: ' + json.dumps(control.recorder.levels()).encode('utf-8') + b'\n\n')
+                self.wfile.flush()
+        except OSError:
+            # the client went away
+            pass
+
+
+def parse_osc(packet):
+    """ Returns the (address, arguments) of every message in an OSC packet, bundles unpacked. """
+    if packet.startswith(b'#bundle\0'):
+        messages = []
+        # the bundle's time tag is ignored, commands are carried out as they come
+        pos = 16
+        while pos + 4 <= len(packet):
+            size, pos = _osc_unpack('>i', packet, pos)
+            if size < 0 or pos + size > len(packet):
+                raise ValueError("bundle element runs past the end of the packet")
+            messages.extend(parse_osc(packet[pos:pos + size]))
+            pos += size
+        return messages
+
+    address, pos = _osc_string(packet, 0)
+    if not address.startswith('/'):
+        raise ValueError(f"'{address}' is not an OSC address")
+    if pos >= len(packet):
+        # no type tags at all, as very old clients send
+        return [(address, [])]
+    tags, pos = _osc_string(packet, pos)
+    if not tags.startswith(','):
+        raise ValueError(f"'{tags}' is not an OSC type tag string")
+    arguments = []
+    for tag in tags[1:]:
+        if tag in 'if':
+            value, pos = _osc_unpack('>' + tag, packet, pos)
+            arguments.append(value)
+        elif tag == 's':
+            value, pos = _osc_string(packet, pos)
+            arguments.append(value)
+        elif tag in 'TF':
+            arguments.append(tag == 'T')
+        else:
+            raise ValueError(f"unsupported OSC type tag '{tag}'")
+    return [(address, arguments)]
+
+
+def osc_message(address, *arguments):
+    """ Encodes an OSC message, with int, float and str arguments. """
+    tags = ','
+    data = b''
+    for value in arguments:
+        if isinstance(value, int):
+            tags += 'i'
+            data += struct.pack('>i', value)
+        elif isinstance(value, float):
+            tags += 'f'
+            data += struct.pack('>f', value)
+        else:
+            tags += 's'
+            data += _osc_pad(str(value).encode('utf-8'))
+    return _osc_pad(address.encode('utf-8')) + _osc_pad(tags.encode('ascii')) + data
+
+
+def _osc_string(packet, pos):
+    # a null terminated string padded to a multiple of 4 bytes, returns it and the position after it
+    end = packet.find(b'\0', pos)
+    if end < 0:
+        raise ValueError("unterminated string")
+    return packet[pos:end].decode('utf-8', 'replace'), (end // 4 + 1) * 4
+
+
+def _osc_unpack(fmt, packet, pos):
+    # one 4 byte value, returns it and the position after it
+    if pos + 4 > len(packet):
+        raise ValueError("packet ends in the middle of an argument")
+    return struct.unpack_from(fmt, packet, pos)[0], pos + 4
+
+
+def _osc_pad(data):
+    return data + b'\0' * (4 - len(data) % 4)
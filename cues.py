@@ -0,0 +1,110 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide' # hide the pygame banner
+
+
+def resourcePath(relativePath):
+    """ Get absolute path to resource, works for dev and for PyInstaller """
+    try:
+        # PyInstaller creates a temp folder and stores path in _MEIPASS
+        basePath = sys._MEIPASS
+    except Exception:
+        basePath = os.path.abspath(".")
+
+    return os.path.join(basePath, relativePath)
+
+
+GOOD_TAKE_CUE = "audio/good.mp3"
+BAD_TAKE_CUE = "audio/bad.mp3"
+SESS_START_CUE = "audio/session_start.mp3"
+SESS_END_CUE = "audio/session_end.mp3"
+
+# decoded cues are cached as raw samples in this directory (under the app's data directory),
+# named after the cue, its content and the mixer format
+CUE_CACHE_DIR = 'cue-cache'
+CUE_CACHE_NAME = '{0}_{1}_{2}_{3}_{4}.pcm'
+
+
+class CuePlayer:
+    """ Plays the audio cues that let the narrator follow the recorder without seeing the screen.
+
+    pygame is imported, the mixer set up and the cues loaded on a background thread, so making
+    a CuePlayer costs nothing at startup. Cues asked for before they are ready are skipped.
+    With a `cache_dir`, each cue is decoded from its MP3 once and its raw samples kept there,
+    later runs load those instead of decoding again. Cues are played asynchronously.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.sounds = None
+        self.ui_channel = None
+        self.record_start_channel = None
+        # seconds it took to get the cues ready, and how many came from the cache
+        self.load_seconds = None
+        self.cached = 0
+        self.ready = threading.Event()
+        self._thread = threading.Thread(target=self._load, name="cue-loader", daemon=True)
+        self._thread.start()
+
+    def session_started(self):
+        if self.ready.is_set():
+            self.record_start_channel.play(self.sounds[SESS_START_CUE])
+
+    def take_marked(self, good):
+        # the start cue follows the verdict cue on the same channel
+        if self.ready.is_set():
+            self.ui_channel.play(self.sounds[GOOD_TAKE_CUE if good else BAD_TAKE_CUE])
+            self.ui_channel.queue(self.sounds[SESS_START_CUE])
+
+    def session_ended(self):
+        if self.ready.is_set():
+            self.ui_channel.play(self.sounds[SESS_END_CUE])
+
+    def _load(self):
+        started = time.perf_counter()
+        try:
+            from pygame import mixer as pymixer
+            pymixer.init()
+            self.ui_channel = pymixer.Channel(0)
+            self.record_start_channel = pymixer.Channel(2)
+            self.sounds = {cue: self._load_sound(pymixer, cue) for cue in (GOOD_TAKE_CUE, BAD_TAKE_CUE, SESS_START_CUE, SESS_END_CUE)}
+        except Exception as e:
+            print(f"Could not load the audio cues, recording without them: {e}")
+            return
+        self.load_seconds = time.perf_counter() - started
+        self.ready.set()
+        print(f"Audio cues ready in {self.load_seconds * 1000:.0f} ms, {self.cached} of {len(self.sounds)} from the cache")
+
+    def _load_sound(self, pymixer, cue):
+        file_path = resourcePath(cue)
+        if self.cache_dir is None:
+            return pymixer.Sound(file_path)
+
+        # keyed by content rather than file time, a one-file build extracts the cues afresh on every run
+        with open(file_path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()[:16]
+        frequency, size, channels = pymixer.get_init()
+        name = os.path.splitext(os.path.basename(cue))[0]
+        cache_path = os.path.join(self.cache_dir, CUE_CACHE_NAME.format(name, digest, frequency, size, channels))
+        try:
+            with open(cache_path, 'rb') as f:
+                sound = pymixer.Sound(buffer=f.read())
+            self.cached += 1
+            return sound
+        except OSError:
+            pass
+
+        sound = pymixer.Sound(file_path)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # written aside and renamed, so a crash never leaves half a cue in the cache
+            with open(cache_path + '.tmp', 'wb') as f:
+                f.write(sound.get_raw())
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError as e:
+            print(f"Could not cache the cue '{cue}': {e}")
+        return sound
@@ -0,0 +1,358 @@
+""" Batch conversion of a session's good takes to a distribution format, e.g. for an audiobook.
+
+Every good take is normalized, resampled and dithered down to the delivery format (44.1 kHz
+16 bit by default) and written under the same name to recorder-delivery in the session
+directory, several takes at once in a pool of processes:
+
+    python delivery.py "D:/Sessions/Chapter 1"
+    python delivery.py . --sample-rate 48000 --bits 24 --rms -19
+
+Each take is streamed through the stages DELIVERY_BLOCK_FRAMES at a time:
+
+    gain      to bring its RMS level to --rms dBFS, held back so its true peak stays under
+              --peak-ceiling. The levels are taken from the session manifest (the recorder
+              measures them while recording), or measured in a first pass for takes without them
+    resample  polyphase windowed sinc, carrying the filter history from block to block
+    dither    TPDF, one LSB of the delivery format, before rounding
+
+so the memory a worker uses does not depend on the length of the take. Progress and
+throughput are printed as the pool goes, and each worker's peak RSS at the end.
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from analysis import LevelStats, LoudnessStats
+from compression import codec_for_path, decode_to_wav
+from engine import good_takes, KEEP_DIR
+from metering import METER_FLOOR_DB
+from session import TakeIndex, TAKE_LOG_NAME
+from wavfile import WavWriter, read_wav_info, decode_samples, encode_samples, WAVE_FORMAT_PCM, FSYNC_ON_CLOSE
+
+try:
+    import resource
+except ImportError:
+    # not on Windows, peak RSS is left out there
+    resource = None
+
+DELIVERY_DIR = "recorder-delivery"
+DELIVERY_SAMPLE_RATE = 44100
+DELIVERY_SAMPLE_WIDTH = 2
+
+# takes are brought to this RMS level, in the middle of the ACX range (-23 to -18 dBFS), unless
+# that would put their true peak over the ceiling, which leaves room for the resampler's ripple
+NORMALIZE_RMS_DB = -20.0
+PEAK_CEILING_DB = -3.5
+
+# frames of the take read, processed and written at a time
+DELIVERY_BLOCK_FRAMES = 1 << 16
+# the resampler's filter reaches this many periods of the lower of the two rates either side of each
+# output sample. its passband ends at RESAMPLE_ROLLOFF of the lower Nyquist frequency, and the Kaiser
+# window's beta sets the stopband (about -90 dB at 9)
+RESAMPLE_ZERO_CROSSINGS = 64
+RESAMPLE_ROLLOFF = 0.95
+RESAMPLE_KAISER_BETA = 9.0
+
+# one core is left for everything else
+DELIVERY_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+# how often progress is printed, in seconds
+PROGRESS_INTERVAL = 1.0
+
+# workers report the bytes of audio they have read on this queue, set up by _init_worker
+_progress = None
+
+
+class Resampler:
+    """ Streaming polyphase resampler between two integer sample rates.
+
+    The rates are reduced to up/down by their greatest common divisor, and the windowed sinc
+    low pass at `up` times the input rate is split into `up` phases of `taps` taps, only the
+    phase an output sample needs is ever applied. Output sample n is centred on input time
+    n * down / up, so nothing is delayed. The last `taps` input frames are carried between
+    blocks; `finish` flushes the output the last frames still owe.
+    """
+
+    def __init__(self, from_rate, to_rate, channels, zero_crossings=RESAMPLE_ZERO_CROSSINGS, rolloff=RESAMPLE_ROLLOFF,
+                 beta=RESAMPLE_KAISER_BETA):
+        divisor = math.gcd(from_rate, to_rate)
+        self.up = to_rate // divisor
+        self.down = from_rate // divisor
+        self.channels = channels
+        self.taps = 2 * math.ceil(zero_crossings * max(1.0, self.down / self.up))
+        self.phases = resampler_phases(self.up, self.down, self.taps, rolloff, beta)
+        # the filter's centre, in samples at the upsampled rate
+        self._centre = self.up * self.taps // 2
+        # input frames kept for the next block, starting at input frame self._start
+        self._history = np.zeros((self.taps, channels))
+        self._start = -self.taps
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def process(self, samples):
+        # float64 (frames, channels) in, the output they complete out
+        self.frames_in += samples.shape[0]
+        return self._run(np.concatenate((self._history, samples)), None)
+
+    def finish(self):
+        # enough silence for the filter to reach past the last frame, then only the output the input is worth
+        total = -(-self.frames_in * self.up // self.down)
+        padding = np.zeros((self.taps // 2 + 2, self.channels))
+        return self._run(np.concatenate((self._history, padding)), total)
+
+    def _run(self, block, limit):
+        end = self._start + block.shape[0]
+        # outputs whose newest input frame, (n * down + centre) // up, is in the block
+        count = -(-(end * self.up - self._centre) // self.down) - self.frames_out
+        if limit is not None:
+            count = min(count, limit - self.frames_out)
+        output = np.empty((max(count, 0), self.channels))
+        # every up-th output uses the same phase, on input windows down frames apart: a strided view
+        # of the block, so each phase is one matrix-vector product and nothing is gathered
+        windows = sliding_window_view(block, self.taps, axis=0)
+        for first in range(min(self.up, output.shape[0])):
+            newest, phase = divmod((self.frames_out + first) * self.down + self._centre, self.up)
+            start = newest - self.taps + 1 - self._start
+            rows = output[first::self.up]
+            rows[:] = windows[start:start + rows.shape[0] * self.down:self.down] @ self.phases[phase]
+        self.frames_out += output.shape[0]
+        self._history = block[-self.taps:]
+        self._start = end - self.taps
+        return output
+
+
+def resampler_phases(up, down, taps, rolloff, beta):
+    # the low pass at the upsampled rate as (up, taps): row p holds the taps applied to the `taps` input frames
+    # ending at an output's newest one, oldest first, for outputs p samples past an input frame
+    length = up * taps
+    centre = length // 2
+    t = np.arange(length) - centre
+    cutoff = 0.5 * rolloff * min(1.0 / up, 1.0 / down)
+    window = np.i0(beta * np.sqrt(np.clip(1 - (t / centre) ** 2, 0, None))) / np.i0(beta)
+    # times up, the zeros stuffed between input frames take that much of the level with them
+    fir = up * 2 * cutoff * np.sinc(2 * cutoff * t) * window
+    return fir.reshape(taps, up).T[:, ::-1].copy()
+
+
+def tpdf_dither(samples, sample_width, rng):
+    # triangular noise of one LSB at the delivery bit depth, added before encode_samples rounds
+    lsb = 1.0 / (1 << (8 * sample_width - 1))
+    return samples + (rng.random(samples.shape) - rng.random(samples.shape)) * lsb
+
+
+def normalize_gain_db(rms_db, peak_db, rms_target_db=NORMALIZE_RMS_DB, peak_ceiling_db=PEAK_CEILING_DB):
+    # the gain that brings the RMS level to the target, less whatever would put the peak over the ceiling
+    # a silent take reads as the meter floor, and is delivered as recorded
+    if not math.isfinite(rms_db) or not math.isfinite(peak_db) or rms_db <= METER_FLOOR_DB:
+        return 0.0
+    return min(rms_target_db - rms_db, peak_ceiling_db - peak_db)
+
+
+def read_blocks(file_path, block_frames=DELIVERY_BLOCK_FRAMES):
+    # float64 (frames, channels) blocks of a WAV's audio
+    info = read_wav_info(file_path)
+    frame_size = info.channels * info.sample_width
+    with open(file_path, 'rb') as f:
+        f.seek(info.data_offset)
+        remaining = info.data_size - info.data_size % frame_size
+        while remaining > 0:
+            data = f.read(min(block_frames * frame_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            data = data[:len(data) - len(data) % frame_size]
+            yield decode_samples(data, info.sample_width, info.format_tag).reshape(-1, info.channels)
+
+
+def measure_take(file_path):
+    """ (RMS dBFS, true peak dBTP) of a WAV, in one streamed pass with the recorder's own analyzers. """
+    info = read_wav_info(file_path)
+    levels, loudness = LevelStats(), LoudnessStats(info.sample_rate, info.channels)
+    frame = 0
+    for samples in read_blocks(file_path):
+        levels.process(samples, frame)
+        loudness.process(samples, frame)
+        frame += samples.shape[0]
+    return levels.finish()['rms_db'], loudness.finish()['true_peak_dbtp']
+
+
+def deliver_take(src_path, dest_path, sample_rate=DELIVERY_SAMPLE_RATE, sample_width=DELIVERY_SAMPLE_WIDTH, levels=None,
+                 rms_target_db=NORMALIZE_RMS_DB, peak_ceiling_db=PEAK_CEILING_DB):
+    """ Write `src_path` normalized, resampled and dithered to `dest_path`, a block at a time.
+
+    `levels` is the take's (RMS dBFS, true peak dBTP) if known, otherwise they are measured
+    first; with `rms_target_db` None there is no gain. Runs in a worker process. Returns a
+    dict of what was done, with the worker's peak RSS so far.
+    """
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(dest_path)) as temp_dir:
+        # compressed takes are expanded to WAV first
+        if codec_for_path(src_path) is not None:
+            wav_path = os.path.join(temp_dir, os.path.splitext(os.path.basename(src_path))[0] + '.wav')
+            decode_to_wav(src_path, wav_path)
+        else:
+            wav_path = src_path
+        info = read_wav_info(wav_path)
+
+        gain_db = 0.0
+        if rms_target_db is not None:
+            rms_db, peak_db = levels if levels is not None else measure_take(wav_path)
+            gain_db = normalize_gain_db(rms_db, peak_db, rms_target_db, peak_ceiling_db)
+        gain = 10 ** (gain_db / 20)
+        resampler = Resampler(info.sample_rate, sample_rate, info.channels) if info.sample_rate != sample_rate else None
+        # seeded by the take's name, so delivering it again gives the same file
+        rng = np.random.default_rng(zlib.crc32(os.path.basename(src_path).encode('utf-8')))
+
+        frames = 0
+        with WavWriter(dest_path, info.channels, sample_width, sample_rate, format_tag=WAVE_FORMAT_PCM, fsync=FSYNC_ON_CLOSE) as dest:
+            def write(samples):
+                if samples.shape[0]:
+                    dest.write(encode_samples(tpdf_dither(samples, sample_width, rng).reshape(-1), sample_width, WAVE_FORMAT_PCM))
+
+            for samples in read_blocks(wav_path):
+                samples = samples * gain
+                write(resampler.process(samples) if resampler is not None else samples)
+                frames += samples.shape[0]
+                if _progress is not None:
+                    _progress.put(samples.size * info.sample_width)
+            if resampler is not None:
+                write(resampler.finish())
+            frames_out = dest.frames_written
+
+    return {
+        'file': src_path,
+        'dest': dest_path,
+        'gain_db': round(gain_db, 2),
+        'frames': frames,
+        'frames_out': frames_out,
+        'audio_seconds': frames / info.sample_rate,
+        'input_bytes': frames * info.channels * info.sample_width,
+        'seconds': time.perf_counter() - started,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def deliver_takes(takes, dest_dir, sample_rate=DELIVERY_SAMPLE_RATE, sample_width=DELIVERY_SAMPLE_WIDTH, rms_target_db=NORMALIZE_RMS_DB,
+                  peak_ceiling_db=PEAK_CEILING_DB, workers=DELIVERY_WORKERS, on_progress=None):
+    """ Deliver every (path, levels or None) of `takes` into `dest_dir`, `workers` takes at a time.
+
+    `on_progress(bytes done, total bytes, seconds so far)` is called every PROGRESS_INTERVAL
+    from this thread, counting the takes' audio data as it is read, and once more with all of
+    it done when the pool has finished. Returns the result of deliver_take for every take
+    delivered, failed takes are printed and left out.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    total = 0
+    for path, _ in takes:
+        # compressed takes count by their file size, close enough for a progress report
+        total += read_wav_info(path).data_size if codec_for_path(path) is None else os.path.getsize(path)
+    done = 0
+    results = []
+    started = time.perf_counter()
+    last_report = started
+    # spawned on every platform, as the compressor's are, so a worker never inherits a recorder's threads
+    context = multiprocessing.get_context('spawn')
+    progress = context.Queue()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(progress,)) as pool:
+        futures = {pool.submit(deliver_take, path, os.path.join(dest_dir, os.path.splitext(os.path.basename(path))[0] + '.wav'),
+                               sample_rate, sample_width, levels, rms_target_db, peak_ceiling_db): path for path, levels in takes}
+        pending = set(futures)
+        while pending:
+            done += _drain_progress(progress, PROGRESS_INTERVAL)
+            for future in [future for future in pending if future.done()]:
+                pending.discard(future)
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f"Could not deliver '{futures[future]}': {e}")
+            now = time.perf_counter()
+            if on_progress is not None and pending and now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                on_progress(min(done, total), total, now - started)
+        # whatever the workers reported after the last pass, then the end, even if a report went missing
+        done += _drain_progress(progress)
+    if on_progress is not None:
+        on_progress(total, total, time.perf_counter() - started)
+    return results
+
+
+def _drain_progress(progress, timeout=None):
+    # bytes reported by the workers so far, waiting up to `timeout` for the first report
+    done = 0
+    try:
+        if timeout is not None:
+            done += progress.get(timeout=timeout)
+        while True:
+            done += progress.get_nowait()
+    except queue.Empty:
+        pass
+    return done
+
+
+def _init_worker(progress):
+    global _progress
+    _progress = progress
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a session's good takes to a distribution format")
+    parser.add_argument('directory', nargs='?', default=os.getcwd(), help="session directory, the current one by default")
+    parser.add_argument('--sample-rate', type=int, default=DELIVERY_SAMPLE_RATE)
+    parser.add_argument('--bits', type=int, choices=[16, 24], default=DELIVERY_SAMPLE_WIDTH * 8)
+    parser.add_argument('--rms', type=float, default=NORMALIZE_RMS_DB, help="RMS level the takes are normalized to, in dBFS")
+    parser.add_argument('--peak-ceiling', type=float, default=PEAK_CEILING_DB, help="highest true peak normalizing may go to, in dBTP")
+    parser.add_argument('--no-normalize', action='store_true', help="leave the level of the takes alone")
+    parser.add_argument('--workers', type=int, default=DELIVERY_WORKERS, help="takes converted at once")
+    parser.add_argument('--output', help=f"where the delivered takes go, {DELIVERY_DIR} in the session directory by default")
+    args = parser.parse_args(argv)
+
+    manifest = TakeIndex(os.path.join(args.directory, TAKE_LOG_NAME))
+    takes = []
+    for path, record in good_takes(args.directory, manifest):
+        # levels measured while recording save a pass over the take
+        levels = None
+        if 'rms_db' in record.get('levels', {}) and 'true_peak_dbtp' in record.get('loudness', {}):
+            levels = (record['levels']['rms_db'], record['loudness']['true_peak_dbtp'])
+        takes.append((path, levels))
+    if not takes:
+        print(f"There are no good takes in '{args.directory}' or its {KEEP_DIR} folder.")
+        return 1
+
+    def on_progress(done, total, seconds):
+        print(f"Delivering: {done / total if total else 1:.0%}, {done / seconds / 1e6 if seconds else 0:.1f} MB/s", file=sys.stderr)
+
+    dest_dir = args.output or os.path.join(args.directory, DELIVERY_DIR)
+    started = time.perf_counter()
+    results = deliver_takes(takes, dest_dir, args.sample_rate, args.bits // 8, None if args.no_normalize else args.rms, args.peak_ceiling,
+                            args.workers, on_progress)
+    seconds = time.perf_counter() - started
+    for result in results:
+        print(f"{os.path.basename(result['dest'])}: {result['gain_db']:+.2f} dB, {result['audio_seconds']:.1f} s of audio in {result['seconds']:.1f} s")
+    audio_seconds = sum(result['audio_seconds'] for result in results)
+    input_bytes = sum(result['input_bytes'] for result in results)
+    peaks = [result['peak_rss_bytes'] for result in results if result['peak_rss_bytes'] is not None]
+    print(f"Delivered {len(results)} of {len(takes)} takes to '{dest_dir}' in {seconds:.1f} s: "
+          f"{audio_seconds / seconds:.1f}x real time, {input_bytes / seconds / 1e6:.1f} MB/s"
+          + (f", worker peak RSS {max(peaks) / 1e6:.0f} MB" if peaks else ""))
+    return 0 if len(results) == len(takes) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
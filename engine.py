@@ -0,0 +1,756 @@
+import ctypes
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from analysis import ClipDetector, LevelStats, LoudnessStats, SpeechTrim, acx_problems, detect_trim
+from backends import STREAM_CONTINUE
+from capture import Take, CaptureWriter, CaptureGroup, TakeSequencer, SessionSequencer, BackgroundWorker, TAKE_IDLE, TAKE_RECORDING
+from compression import TakeCompressor, codec_available, codec_for_path, compressed_path, decode_to_wav, CODECS
+from metering import LevelMeter, METER_RATE
+from peaks import PeakPyramid, PEAKS_EXTENSION
+from profiles import CAPTURE_PROFILES, DEFAULT_PROFILE, SAMPLE_FORMATS, profile_label
+from recovery import recover_recording
+from replay import StreamingPlayer
+from session import export_takes, assemble_takes, take_index_path, TakeIndex, TAKE_LOG_NAME, VERDICT_GOOD, VERDICT_BAD
+from telemetry import Telemetry, CallbackStats
+from wavfile import repair_header
+
+KEEP_DIR = "recorder-keep"
+DISCARD_DIR = "recorder-discard"
+
+# saved takes are compressed in the background when this is CODEC_FLAC or CODEC_WAVPACK (needs the codec's
+# command line tools on the PATH). the WAV is only deleted once the compressed file decodes to the same samples
+COMPRESS_CODEC = None
+
+# the master only gets each good take from its suggested in point to its out point (see analysis.SpeechTrim),
+# leaving out the cue and breath before the speech and the reach for the key after it
+TRIM_MASTER = True
+
+# "replay the end of the take" plays this many seconds of it
+REPLAY_TAIL_SECONDS = 10
+
+# seconds of audio from just before the session starts (or recording resumes after a replay) kept at the head of the take
+PRE_ROLL_SECONDS = 2
+
+TEMP_AUDIOFILE_NAME = '__eaygsr_recording_temp_{0}.wav'
+TEMP_AUDIOFILE_GLOB = '__eaygsr_recording_temp*.wav'
+SESSION_AUDIOFILE_NAME = 'session_{0}.wav'
+SESSION_AUDIOFILE_GLOB = 'session_*.wav'
+# kept takes are named by start time and take id, so they sort in recording order and never collide
+TAKE_AUDIOFILE_NAME = 'track_{0}_{1:04d}.wav'
+MASTER_AUDIOFILE_NAME = 'master_{0}.wav'
+# the same take recorded by another input device is saved next to it with this appended to the name
+DEVICE_AUDIOFILE_SUFFIX = '_dev{0}'
+
+# what a leftover temp recording can be turned into, see Recorder.handle_leftovers
+LEFTOVER_KEEP = "keep"
+LEFTOVER_DISCARD = "discard"
+LEFTOVER_DELETE = "delete"
+LEFTOVER_SKIP = "skip"
+
+# events a Recorder sends to its subscribers, with what they are called with
+EVENT_SESSION_STARTED = "session_started"   # (take)
+EVENT_TAKE_MARKED = "take_marked"           # (take), the finished take with its verdict
+EVENT_TAKE_ANALYZED = "take_analyzed"       # (take, ACX problems), once the marked take's analysis is done
+EVENT_TAKE_SAVED = "take_saved"             # (manifest record)
+EVENT_SESSION_ENDED = "session_ended"       # ()
+EVENT_LEVELS = "levels"                     # (levels dict), METER_RATE times a second
+
+
+# stands in for the suggested in and out points of a take recorded before takes were trimmed
+NOT_ANALYZED = object()
+
+
+def capture_timestamp(time_info):
+    # when the block's first frame was captured, on the perf_counter clock. the stream reports it on
+    # its own clock, so only the latency it reports is used. None when the host API does not report it
+    adc_time = time_info.get('input_buffer_adc_time', 0) if time_info else 0
+    latency = time_info.get('current_time', 0) - adc_time if adc_time else -1
+    if not 0 <= latency < 1:
+        return None
+    return time.perf_counter() - latency
+
+
+class Recorder:
+    """ The whole recorder without any UI: input streams, takes, saving, replay and assembly.
+
+    The Qt window and the command line each drive one of these. Audio comes from `backend`
+    (see backends.py), so the same engine records from real devices, a synthetic tone or a
+    WAV file. `cues` is anything with `session_started()`, `take_marked(good)` and
+    `session_ended()`, e.g. a cues.CuePlayer, or None for silence. `telemetry` keeps the
+    health of the capture and its log (see telemetry.py), by default one that logs nowhere.
+
+    Functions given to `subscribe` are called on whichever thread the event happens on: the
+    caller's for session and mark events, the take finisher thread for saved takes and a meter
+    thread for levels. A UI has to hand them over to its own thread. Starting and ending
+    sessions, marking, holding and replaying takes can be called from any thread.
+    """
+
+    def __init__(self, backend, directory, cues=None, profile=DEFAULT_PROFILE, compress_codec=COMPRESS_CODEC, pre_roll_seconds=PRE_ROLL_SECONDS,
+                 telemetry=None):
+        self.backend = backend
+        self.directory = directory
+        self.cues = cues
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.pre_roll_seconds = pre_roll_seconds
+        self.profile = None
+        self.device_index = None
+        # devices recorded at the same time as the selected one, each to its own files
+        self.extra_device_indexes = []
+        # one input stream per recorded device, the selected device's first
+        self.streams = []
+        self.replaying = False
+        # session manifests by session directory
+        self.manifests = {}
+        self._listeners = {}
+        self._levels_thread = None
+        # sessions and takes can be driven from more than one thread (the UI and a control.ControlServer),
+        # one transition at a time
+        self._lock = threading.RLock()
+        self._closed = False
+
+        # takes are replayed straight from disk through their own output stream
+        self.player = StreamingPlayer(backend)
+        self.take_worker = BackgroundWorker("take-finisher")
+        self.capture = None
+        self.takes = None
+        self.apply_profile(profile)
+
+        # encodes saved takes in low priority processes
+        self.compressor = None
+        if compress_codec is not None:
+            if codec_available(compress_codec):
+                self.compressor = TakeCompressor(compress_codec, self.take_compressed)
+            else:
+                print(f"The {compress_codec} command line tools were not found, takes are kept as WAV")
+
+    @property
+    def state(self):
+        return self.takes.state
+
+    @property
+    def recording(self):
+        return self.takes.state == TAKE_RECORDING
+
+    @property
+    def session_mode(self):
+        return self.takes is self.session_takes
+
+    def subscribe(self, event, fn):
+        self._listeners.setdefault(event, []).append(fn)
+        if event == EVENT_LEVELS and self._levels_thread is None:
+            self._levels_thread = threading.Thread(target=self._run_levels, name="level-events", daemon=True)
+            self._levels_thread.start()
+
+    def levels(self):
+        clips = self.capture.analyzers.get(ClipDetector.name)
+        return {
+            'rms_db': self.meter.rms_db,
+            'peak_db': self.meter.peak_db,
+            'peak_hold_db': self.meter.peak_hold_db,
+            'clips': clips.count if clips is not None else 0,
+        }
+
+    def health(self):
+        # (HEALTH_OK/WARNING/BAD, short text, summary) since the session started, see Telemetry.health
+        return self.telemetry.health()
+
+    def input_devices(self):
+        return self.backend.input_devices()
+
+    def select_device(self, device_index, extra_device_indexes=None):
+        """ Record from `device_index` (None for no device), and from `extra_device_indexes` alongside it.
+
+        If the device cannot record the current profile, the first profile it can record is
+        picked instead. Returns the profile in use.
+        """
+        self.device_index = device_index if device_index is not None and device_index >= 0 else None
+        if extra_device_indexes is not None:
+            self.extra_device_indexes = list(extra_device_indexes)
+        profile = self.profile
+        supported = [self.profile_supported(candidate) for candidate in CAPTURE_PROFILES]
+        if not supported[CAPTURE_PROFILES.index(profile)] and any(supported):
+            profile = CAPTURE_PROFILES[supported.index(True)]
+            print(f"The device cannot record {profile_label(self.profile)}, switching to {profile_label(profile)}")
+        # the writers are rebuilt too, the devices recorded alongside depend on which one is selected
+        self.apply_profile(profile)
+        return profile
+
+    def profile_supported(self, profile, device_index=None):
+        if device_index is None:
+            device_index = self.device_index
+        if device_index is None:
+            return True
+        return self.backend.is_format_supported(profile, device_index)
+
+    def set_profile(self, profile):
+        if self.takes is not None and self.takes.state != TAKE_IDLE:
+            raise ValueError("The capture profile cannot be changed during a session")
+        if not self.profile_supported(profile):
+            raise ValueError(f"The selected input device cannot record {profile_label(profile)}")
+        if profile != self.profile:
+            self.apply_profile(profile)
+
+    def apply_profile(self, profile):
+        # everything downstream of the stream is built for one format, so it is all rebuilt
+        self.stop_audio_stream()
+        if self.capture is not None:
+            self.capture.stop()
+
+        self.profile = profile
+        sample_format = SAMPLE_FORMATS[profile.sample_format]
+        self.sample_rate = profile.sample_rate
+        self.channels = profile.channels
+        self.sample_width = sample_format.stream_width
+
+        self.meter = LevelMeter(self.sample_rate, self.channels, sample_format.dtype, profile.frames_per_buffer)
+
+        # disk writes happen on the capture writer thread, never in the audio callback
+        self.writer = CaptureWriter(self.channels, self.sample_width, self.sample_rate, on_file_opened=set_hidden_attribute,
+                                    pre_roll_seconds=self.pre_roll_seconds, make_analyzers=self.make_take_analyzers,
+                                    file_sample_width=sample_format.file_width, format_tag=sample_format.format_tag)
+        self.capture = self.writer
+
+        # every other device gets a writer (and a thread) of its own, so a slow one cannot hold up the rest
+        self.recorded_devices = [(self.device_index, self.writer)]
+        for device_index in self.extra_device_indexes:
+            if device_index == self.device_index:
+                continue
+            if not self.profile_supported(profile, device_index):
+                print(f"Input device {device_index} cannot record {profile_label(profile)}, leaving it out")
+                continue
+            writer = CaptureWriter(self.channels, self.sample_width, self.sample_rate, on_file_opened=set_hidden_attribute,
+                                   pre_roll_seconds=self.pre_roll_seconds, file_sample_width=sample_format.file_width,
+                                   format_tag=sample_format.format_tag)
+            self.recorded_devices.append((device_index, writer))
+        if len(self.recorded_devices) > 1:
+            names = [self.backend.device_name(device_index) if device_index is not None else "none" for device_index, _ in self.recorded_devices]
+            self.capture = CaptureGroup([writer for _, writer in self.recorded_devices], names)
+        self.capture.start()
+        self.file_takes = TakeSequencer(self.capture, self.new_take_path, self.finish_take, self.take_worker)
+        self.session_takes = SessionSequencer(self.capture, self.new_session_path, self.finish_session, self.take_worker)
+        self.takes = self.file_takes
+
+        # one set of callback counters per recorded device, the selected device's first
+        block_period = profile.frames_per_buffer / profile.sample_rate
+        self.callback_stats = [CallbackStats(block_period) for _ in self.recorded_devices]
+        self.telemetry.watch(self.callback_stats, self.capture)
+        print(f"Capture profile: {profile_label(profile)}, {profile.frames_per_buffer} frames per buffer")
+
+        self.start_audio_stream()
+
+    def stop_audio_stream(self):
+        for stream in self.streams:
+            stream.stop_stream()
+            stream.close()
+        self.streams = []
+
+    def start_audio_stream(self):
+        self.stop_audio_stream()
+
+        if self.device_index is None:
+            return
+        # the writers' clocks restart with the streams, the gap must not count as drift
+        self.capture.reset_clock()
+        for (device_index, writer), stats in zip(self.recorded_devices, self.callback_stats):
+            callback = self.audio_callback if writer is self.writer else self.device_callback(writer, stats)
+            try:
+                stream = self.backend.open_input(device_index, self.profile, callback)
+            except OSError as e:
+                if writer is self.writer:
+                    raise
+                # a missing backup device must not stop the main one from recording
+                print(f"Could not open input device {device_index}: {e}")
+                continue
+            self.streams.append(stream)
+        # started together so the streams' first blocks are as close in time as they can be
+        for stream in self.streams:
+            stream.start_stream()
+
+    def start_session(self, session_file=False):
+        with self._lock:
+            if self.takes.state != TAKE_IDLE:
+                return self.takes.current
+            if not self.directory:
+                print("No directory selected for saving recordings.")
+                return None
+            if self.cues is not None:
+                self.cues.session_started()
+            self.takes = self.session_takes if session_file else self.file_takes
+            take = self.takes.start()
+            self.telemetry.session_started(directory=self.directory, profile=profile_label(self.profile), frames_per_buffer=self.profile.frames_per_buffer,
+                                           devices=[self.backend.device_name(index) for index, _ in self.recorded_devices if index is not None],
+                                           session_file=session_file)
+            print('Session Started')
+            self._emit(EVENT_SESSION_STARTED, take)
+            return take
+
+    def mark_take(self, good):
+        with self._lock:
+            if self.replaying:
+                self.stop_replay()
+            if self.takes.state != TAKE_IDLE:
+                # a held take got its stream counters when it was put on hold, the next take starts counting now
+                delta = self.telemetry.take_delta()
+                if self.recording:
+                    self.takes.current.telemetry.update(delta)
+            # the next take starts on the exact sample this one ends, the file is moved in the background
+            finished = self.takes.mark(good)
+            if finished is None:
+                return None
+            if self.cues is not None:
+                self.cues.take_marked(good)
+            self._emit(EVENT_TAKE_MARKED, finished)
+            # queued behind the sequencer's own wait for the take, so it reports within a flush interval of the mark
+            self.take_worker.submit(self.take_analyzed, finished)
+            return finished
+
+    def hold(self):
+        with self._lock:
+            if self.recording:
+                # the take stays open for a verdict, the writer closes its file in the background
+                self.takes.current.telemetry.update(self.telemetry.take_delta())
+                self.takes.hold()
+
+    def replay(self, last_seconds=None):
+        # put the current take on hold and play it on repeat, from its last `last_seconds` if given
+        with self._lock:
+            if self.takes.state == TAKE_IDLE:
+                return False
+            self.hold()
+            self.replaying = True
+            take = self.takes.current
+            take.closed.wait() # the writer closes held takes right away
+            if self.session_mode:
+                # in session mode the take is a range of the capture file
+                start_frame, end_frame = take.start_frame, take.end_frame
+            else:
+                start_frame, end_frame = 0, None
+            try:
+                return self.player.play(take.file_path, start_frame, end_frame, last_seconds)
+            except (OSError, ValueError) as e:
+                print(f"Error while replaying the take: {e}")
+                return False
+
+    def skip(self, seconds):
+        self.player.skip(seconds)
+
+    def stop_replay(self):
+        with self._lock:
+            if self.player.start_latency is not None:
+                print(f"Replay started in {self.player.start_latency * 1000:.1f} ms")
+            self.player.stop()
+            self.replaying = False
+
+    def end_session(self):
+        with self._lock:
+            if self.takes.state == TAKE_IDLE:
+                return
+            self.hold()
+            self.stop_replay()
+            self.takes.end() # scraps are deleted in the background
+            if self.cues is not None:
+                self.cues.session_ended()
+            print('Session Ended')
+            self.telemetry.session_ended()
+            self._emit(EVENT_SESSION_ENDED)
+
+    def wait(self):
+        # block until every finished take has been saved
+        self.take_worker.wait()
+
+    def close(self):
+        # make sure the writer threads flush and close any open take before we exit. a take
+        # still open is left as a temp file, and offered by handle_leftovers on the next start.
+        # a session file is ended instead, so the takes marked in it are exported now
+        if self.session_mode:
+            self.end_session()
+            self.wait()
+        self.player.stop()
+        self.stop_audio_stream()
+        self.capture.stop()
+        if self.compressor is not None:
+            self.compressor.shutdown()
+        self._closed = True
+
+    def new_take_path(self):
+        return f"{self.directory}/{TEMP_AUDIOFILE_NAME.format(time.time_ns())}"
+
+    def new_session_path(self):
+        return f"{self.directory}/{SESSION_AUDIOFILE_NAME.format(int(time.time()))}"
+
+    def handle_leftovers(self, decide):
+        """ Offer every temp recording left in the directory by a crash to `decide`.
+
+        `decide(file_path, report)` gets the RecoveryReport (None if the file could not be
+        repaired) and returns LEFTOVER_KEEP, LEFTOVER_DISCARD, LEFTOVER_DELETE or LEFTOVER_SKIP.
+        Empty files are deleted without asking. The takes marked in a session file that was
+        never ended are exported without asking, they already have their verdicts.
+        """
+        # let any takes still being moved from a previous session land first
+        self.wait()
+        for file_path in sorted(glob.glob(os.path.join(glob.escape(self.directory), SESSION_AUDIOFILE_GLOB))):
+            self.handle_leftover_session(file_path)
+        for file_path in sorted(glob.glob(os.path.join(glob.escape(self.directory), TEMP_AUDIOFILE_GLOB))):
+            self.handle_leftover(file_path, decide)
+
+    def handle_leftover_session(self, file_path):
+        # only session files with marked takes have an index, the other devices' files do not
+        index = TakeIndex(take_index_path(file_path))
+        if not index.takes():
+            return
+        session_name = os.path.basename(file_path)
+        if self.take_manifest(self.directory).takes(where=lambda take: take.get('session') == session_name):
+            return
+
+        print(f"Session file '{file_path}' was not ended, exporting its takes")
+        capture = Take(file_path)
+        stem = os.path.splitext(file_path)[0]
+        # the other devices' files are numbered from 1, in the order finish_session expects them
+        while True:
+            device_path = f"{stem}{DEVICE_AUDIOFILE_SUFFIX.format(len(capture.device_takes) + 1)}.wav"
+            if not os.path.exists(device_path):
+                break
+            capture.device_takes.append(Take(device_path))
+        try:
+            # the header still has the sizes it was opened with
+            for take in [capture] + capture.device_takes:
+                repair_header(take.file_path)
+            self.finish_session(capture)
+        except (OSError, ValueError) as e:
+            print(f"Could not export the takes of '{file_path}': {e}")
+
+    def handle_leftover(self, file_path, decide):
+        if not os.path.exists(file_path):
+            return
+        # The temporary audio file exists, which could be due to a program crash.
+        # check if file length is zero, if so just delete it
+        if os.path.getsize(file_path) == 0:
+            print("Temporary audio file is empty. Deleting it.")
+            os.remove(file_path)
+            return
+
+        # fix up the header from the audio that actually made it to disk
+        try:
+            report = recover_recording(file_path)
+        except (ValueError, OSError) as e:
+            print(f"Could not recover '{file_path}': {e}")
+            report = None
+
+        if report is not None and report.frames == 0:
+            print("Temporary audio file has no audio. Deleting it.")
+            os.remove(file_path)
+            return
+
+        response = decide(file_path, report)
+
+        fields = {}
+        if report is not None:
+            # the file was last written about when the take ended
+            fields = {
+                'frames': report.frames,
+                'start_time': os.path.getmtime(file_path) - report.frames / report.sample_rate,
+                'sample_rate': report.sample_rate,
+                'levels': {'peak_db': round(report.peak_db, 2), 'rms_db': round(report.rms_db, 2)},
+            }
+            try:
+                # not analyzed while it was recorded, the file is scanned instead
+                fields['trim'] = detect_trim(file_path)
+            except (OSError, ValueError) as e:
+                print(f"Could not find the speech in '{file_path}': {e}")
+
+        if response == LEFTOVER_KEEP:
+            self.save_recording(True, file_path, **fields)
+        elif response == LEFTOVER_DISCARD:
+            self.save_recording(False, file_path, **fields)
+        elif response == LEFTOVER_DELETE:
+            os.remove(file_path)
+
+    def finish_session(self, capture):
+        # runs on the take finisher thread once the session capture file is closed
+        session_directory = os.path.dirname(capture.file_path)
+        keep_dir, discard_dir = f"{session_directory}/{KEEP_DIR}", f"{session_directory}/{DISCARD_DIR}"
+        written = export_takes(capture.file_path, keep_dir, discard_dir)
+        print(f"Exported {len(written)} takes from '{capture.file_path}'")
+
+        # each take's peaks go next to its exported file, the scrapped take's are deleted
+        peaks = []
+        for take, dest_path in written:
+            peaks.append(self.move_peaks(take.get('peaks'), session_directory, dest_path))
+        for file_path in glob.glob(glob.escape(os.path.splitext(capture.file_path)[0]) + f"_take*{PEAKS_EXTENSION}"):
+            os.remove(file_path)
+        # the session files were hidden while they were recorded, they are kept for re-cutting
+        for file_path in [capture.file_path] + [device_take.file_path for device_take in capture.device_takes]:
+            if os.path.exists(file_path):
+                unset_hidden_attribute(file_path)
+
+        # the other devices' session files start on the same instant, so the same frame ranges cut the same takes
+        devices = [[] for _ in written]
+        for device, device_take in enumerate(capture.device_takes, 1):
+            if not os.path.exists(device_take.file_path):
+                continue
+            device_written = export_takes(capture.file_path, keep_dir, discard_dir, device_take.file_path, DEVICE_AUDIOFILE_SUFFIX.format(device))
+            for records, (_, dest_path) in zip(devices, device_written):
+                records.append({'device': device_take.device, 'file': os.path.relpath(dest_path, session_directory),
+                                'drift_ppm': device_take.drift_ppm})
+
+        # the exported takes join the directory's manifest, their frame offsets stay relative to the session file
+        manifest = self.take_manifest(session_directory)
+        for (take, dest_path), device_records, peaks_path in zip(written, devices, peaks):
+            take_id = manifest.next_take_id()
+            fields = {'devices': device_records} if device_records else {}
+            if peaks_path is not None:
+                fields['peaks'] = os.path.relpath(peaks_path, session_directory)
+            manifest.add(take_id, take['start_frame'], take['end_frame'], take['verdict'], take.get('sample_rate'),
+                         file=os.path.relpath(dest_path, session_directory), start_time=take.get('start_time'),
+                         session=os.path.basename(capture.file_path), session_take=take['take'],
+                         clips=take.get('clips'), levels=take.get('levels'), loudness=take.get('loudness'), trim=take.get('trim'), telemetry=take.get('telemetry'), **fields)
+            self.compress_take(manifest, take_id, dest_path)
+            self.telemetry.log('take_saved', record=manifest.get(take_id))
+            self._emit(EVENT_TAKE_SAVED, manifest.get(take_id))
+
+    def finish_take(self, take):
+        # runs on the take finisher thread once the writer has closed the take's file
+        if take.verdict is None:
+            for file_path in [take.file_path, self.peaks_path(take)] + [device_take.file_path for device_take in take.device_takes]:
+                try:
+                    os.remove(file_path) # delete scraps
+                except FileNotFoundError:
+                    pass
+        else:
+            self.save_recording(take.verdict, take.file_path, take.frames, take.start_time, device_takes=take.device_takes,
+                                telemetry=take.telemetry, **take.analysis)
+
+    def take_analyzed(self, take):
+        # runs on the take finisher thread
+        take.closed.wait()
+        problems = acx_problems(take.analysis)
+        if problems:
+            print(f"Take does not meet ACX requirements: {'; '.join(problems)}")
+        self._emit(EVENT_TAKE_ANALYZED, take, problems)
+
+    def assemble_good_takes(self):
+        # queued behind any takes still being saved, so they make it into the master
+        self.take_worker.submit(self.export_master, self.directory)
+
+    def export_master(self, session_directory):
+        # runs on the take finisher thread
+        takes = good_takes(session_directory, self.take_manifest(session_directory))
+        take_paths = [take_path for take_path, _ in takes]
+        # suggested (in, out) points by take, takes recorded before there was trimming are scanned
+        trims = [take['trim'] if 'trim' in take else NOT_ANALYZED for _, take in takes]
+        if not take_paths:
+            print("There are no good takes to assemble.")
+            return None
+
+        dest_path = os.path.join(session_directory, MASTER_AUDIOFILE_NAME.format(int(time.time())))
+        started = time.perf_counter()
+        try:
+            with tempfile.TemporaryDirectory(dir=session_directory) as temp_dir:
+                # compressed takes are expanded to WAV first
+                wav_paths = []
+                ranges = []
+                for take_path, trim in zip(take_paths, trims):
+                    if codec_for_path(take_path) is not None:
+                        wav_path = os.path.join(temp_dir, os.path.splitext(os.path.basename(take_path))[0] + '.wav')
+                        decode_to_wav(take_path, wav_path)
+                        take_path = wav_path
+                    wav_paths.append(take_path)
+                    if TRIM_MASTER and trim is NOT_ANALYZED:
+                        trim = detect_trim(take_path)
+                    ranges.append((trim['in_frame'], trim['out_frame']) if TRIM_MASTER and trim else None)
+                frames = assemble_takes(wav_paths, dest_path, ranges=ranges)
+        except (OSError, ValueError) as e:
+            print(f"Error while assembling the good takes: {e}")
+            return None
+        print(f"Assembled {len(take_paths)} good takes ({frames} frames) into '{dest_path}' in {time.perf_counter() - started:.1f} s")
+        return dest_path
+
+    def make_take_analyzers(self, take):
+        # called on the capture writer thread for every new take
+        return [ClipDetector(self.sample_rate, self.channels), LevelStats(), LoudnessStats(self.sample_rate, self.channels),
+                PeakPyramid(self.sample_rate, self.channels, self.peaks_path(take)), SpeechTrim(self.sample_rate)]
+
+    def peaks_path(self, take):
+        stem = os.path.splitext(take.file_path)[0]
+        if take.take_id is not None:
+            # a take of a session file, named the way export_takes will name its file
+            stem = f"{stem}_take{take.take_id:04d}"
+        return stem + PEAKS_EXTENSION
+
+    def move_peaks(self, peaks, source_directory, take_path):
+        # moves a take's peaks sidecar next to the take's file, returns where it went (None if it has none)
+        if not peaks:
+            return None
+        dest_path = os.path.splitext(take_path)[0] + PEAKS_EXTENSION
+        try:
+            shutil.move(os.path.join(source_directory, peaks['file']), dest_path)
+        except (FileNotFoundError, shutil.Error) as e:
+            print(f"Could not move the peaks of '{take_path}': {e}")
+            return None
+        return dest_path
+
+    def take_manifest(self, session_directory):
+        # one TakeIndex per directory, so its in-memory records are shared
+        manifest = self.manifests.get(session_directory)
+        if manifest is None:
+            manifest = self.manifests[session_directory] = TakeIndex(os.path.join(session_directory, TAKE_LOG_NAME))
+        return manifest
+
+    def save_recording(self, wasGoodTake, src_path, frames=0, start_time=None, sample_rate=None, device_takes=(), **fields):
+        # move file to keep or discard based on how we stopped the recording, and add it to the session manifest
+        session_directory = os.path.dirname(src_path)
+        if wasGoodTake:
+            directory_path = f"{session_directory}/{KEEP_DIR}"
+        else:
+            directory_path = f"{session_directory}/{DISCARD_DIR}"
+
+        if not os.path.exists(directory_path):
+            os.makedirs(directory_path)
+
+        manifest = self.take_manifest(session_directory)
+        if start_time is None:
+            start_time = time.time()
+        take_id = manifest.next_take_id()
+        dest_path = os.path.join(directory_path, TAKE_AUDIOFILE_NAME.format(int(start_time), take_id))
+        while os.path.exists(dest_path):
+            # the manifest was removed or edited by hand, never overwrite a take
+            take_id += 1
+            dest_path = os.path.join(directory_path, TAKE_AUDIOFILE_NAME.format(int(start_time), take_id))
+
+        try:
+            shutil.move(src_path, dest_path)
+            unset_hidden_attribute(dest_path) # make file visible again to the user
+            print(f"Moved '{src_path}' to '{directory_path}'")
+        except FileNotFoundError:
+            print(f"Source file '{src_path}' not found.")
+            return None
+        except shutil.Error as e:
+            print(f"Error while moving the file: {e}")
+            return None
+
+        # the other devices' files of the take go next to it, under the same take id
+        devices = []
+        stem, extension = os.path.splitext(dest_path)
+        for device, device_take in enumerate(device_takes, 1):
+            device_path = f"{stem}{DEVICE_AUDIOFILE_SUFFIX.format(device)}{extension}"
+            try:
+                shutil.move(device_take.file_path, device_path)
+                unset_hidden_attribute(device_path)
+            except (FileNotFoundError, shutil.Error) as e:
+                print(f"Could not move '{device_take.file_path}': {e}")
+                continue
+            devices.append({'device': device_take.device, 'file': os.path.relpath(device_path, session_directory),
+                            'start_frame': device_take.start_frame, 'frames': device_take.frames, 'drift_ppm': device_take.drift_ppm})
+        if devices:
+            fields['devices'] = devices
+        peaks_path = self.move_peaks(fields.pop('peaks', None), session_directory, dest_path)
+        if peaks_path is not None:
+            fields['peaks'] = os.path.relpath(peaks_path, session_directory)
+
+        verdict = VERDICT_GOOD if wasGoodTake else VERDICT_BAD
+        manifest.add(take_id, 0, frames, verdict, sample_rate or self.sample_rate,
+                     file=os.path.relpath(dest_path, session_directory), start_time=start_time, **fields)
+        self.compress_take(manifest, take_id, dest_path)
+        self.telemetry.log('take_saved', record=manifest.get(take_id))
+        self._emit(EVENT_TAKE_SAVED, manifest.get(take_id))
+        return dest_path
+
+    def compress_take(self, manifest, take_id, wav_path):
+        if self.compressor is not None:
+            self.compressor.submit(wav_path, (manifest, take_id))
+
+    def take_compressed(self, context, result):
+        # runs on the compressor's thread once the WAV has been replaced
+        manifest, take_id = context
+        dest_path, wav_bytes, compressed_bytes, _ = result
+        manifest.update(take_id, file=os.path.relpath(dest_path, os.path.dirname(manifest.path)), codec=self.compressor.codec)
+        stats = self.compressor.stats()
+        print(f"Compressed '{os.path.basename(dest_path)}' to {compressed_bytes / wav_bytes:.0%} of the WAV, "
+              f"{stats['pending']} takes queued, encoding at {stats['realtime_factor']:.1f}x realtime")
+
+    def audio_callback(self, in_data, frame_count, time_info, status):
+        started = time.perf_counter()
+
+        # Update the audio meter
+        self.meter.process(in_data)
+
+        # only copy into the ring buffer here, the capture writer thread does the file I/O.
+        # audio is pushed even between takes so the pre-roll is always filled
+        self.writer.push(in_data, capture_timestamp(time_info))
+
+        # xruns and latency are only counted here, the telemetry thread reports them
+        self.callback_stats[0].record(started, status, time_info)
+        return None, STREAM_CONTINUE
+
+    def device_callback(self, writer, stats):
+        # stream callback of one of the other recorded devices, it only feeds that device's writer
+        def callback(in_data, frame_count, time_info, status):
+            started = time.perf_counter()
+            writer.push(in_data, capture_timestamp(time_info))
+            stats.record(started, status, time_info)
+            return None, STREAM_CONTINUE
+        return callback
+
+    def _emit(self, event, *args):
+        for fn in self._listeners.get(event, []):
+            try:
+                fn(*args)
+            except Exception as e:
+                # a broken listener must never stop the recording
+                print(f"Error in the {event} listener: {e}")
+
+    def _run_levels(self):
+        while not self._closed:
+            time.sleep(1 / METER_RATE)
+            self._emit(EVENT_LEVELS, self.levels())
+
+
+def good_takes(session_directory, manifest):
+    """ (path, manifest record) of every good take file in `session_directory`, in recording order.
+
+    Takes recorded before there was a manifest get an empty record, their names sort in
+    recording order. Takes missing from disk are left out.
+    """
+    takes = manifest.takes(VERDICT_GOOD, where=lambda take: 'file' in take)
+    takes.sort(key=lambda take: take.get('start_time') or take['time'])
+    found_takes = []
+    for take in takes:
+        take_path = os.path.join(session_directory, take['file'])
+        # a take compressed while the app was closing still has its WAV name in the manifest
+        found = [path for path in [take_path] + [compressed_path(take_path, codec) for codec in CODECS] if os.path.exists(path)]
+        if found:
+            found_takes.append((found[0], take))
+        else:
+            print(f"Good take '{take_path}' is missing, leaving it out")
+    if not found_takes:
+        found_takes = [(take_path, {}) for take_path in sorted(glob.glob(os.path.join(glob.escape(session_directory), KEEP_DIR, '*.wav')))]
+    return found_takes
+
+
+def set_hidden_attribute(file_path):
+    if os.name == 'nt':
+        # On Windows, set the hidden attribute
+        try:
+            # FILE_ATTRIBUTE_HIDDEN = 2
+            ctypes.windll.kernel32.SetFileAttributesW(file_path, 2)
+        except Exception as e:
+            print(f"Error setting hidden attribute: {e}")
+    else:
+        print("Setting file attributes is not supported on this platform.")
+
+
+def unset_hidden_attribute(file_path):
+    if os.name == 'nt':
+        # On Windows, remove the hidden attribute
+        try:
+            # FILE_ATTRIBUTE_NORMAL = 128
+            ctypes.windll.kernel32.SetFileAttributesW(file_path, 128)
+        except Exception as e:
+            print(f"Error unsetting hidden attribute: {e}")
+    else:
+        print("Setting file attributes is not supported on this platform.")
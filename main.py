@@ -1,57 +1,54 @@
-import shutil
-from PySide6.QtWidgets import QMainWindow, QApplication, QPushButton, QFileDialog, QComboBox, QProgressBar, QLabel, QHBoxLayout, QVBoxLayout, QMessageBox
+import time
+# time to interactive is measured from here, before the heavy imports
+STARTED = time.perf_counter()
+
+import multiprocessing
+from PySide6.QtWidgets import QMainWindow, QApplication, QPushButton, QFileDialog, QComboBox, QProgressBar, QLabel, QHBoxLayout, QVBoxLayout, QMessageBox, QCheckBox, QToolButton, QMenu
 from PySide6 import QtCore, QtWidgets
 from PySide6.QtGui import QKeySequence, QShortcut, QIcon
 from PySide6.QtCore import QTimer, QTime
 
-import sys, os, ctypes
-os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide' # hide the pygame banner
-import pyaudio
-import math
-import time
-import numpy as np
-import wave
-from pygame import mixer as pymixer
+import sys, os, threading
+from engine import Recorder, REPLAY_TAIL_SECONDS, EVENT_TAKE_ANALYZED, KEEP_DIR, DISCARD_DIR, LEFTOVER_KEEP, LEFTOVER_DISCARD, LEFTOVER_DELETE, LEFTOVER_SKIP
+from backends import PyAudioBackend
+from cues import CuePlayer, CUE_CACHE_DIR
+from metering import METER_RATE
+from capture import TAKE_IDLE
+from profiles import CAPTURE_PROFILES, DEFAULT_PROFILE, profile_label
+from telemetry import Telemetry, default_log_path, app_data_dir, HEALTH_OK, HEALTH_WARNING, HEALTH_BAD, HEALTH_INTERVAL
 
 VERSION = '0.2.1'
 
-def resourcePath(relativePath):
-    """ Get absolute path to resource, works for dev and for PyInstaller """
-    try:
-        # PyInstaller creates a temp folder and stores path in _MEIPASS
-        basePath = sys._MEIPASS
-    except Exception:
-        basePath = os.path.abspath(".")
-
-    return os.path.join(basePath, relativePath)
-
-pymixer.init()
-ui_channel = pymixer.Channel(0)
-replay_channel = pymixer.Channel(1)
-record_start_channel = pymixer.Channel(2)
-
-GOOD_TAKE_SND = pymixer.Sound(resourcePath("audio/good.mp3"))
-BAD_TAKE_SND = pymixer.Sound(resourcePath("audio/bad.mp3"))
-SESS_START_SND = pymixer.Sound(resourcePath("audio/session_start.mp3"))
-SESS_END_SND = pymixer.Sound(resourcePath("audio/session_end.mp3"))
-
 SESS_START_KEY = QtCore.Qt.Key_F10
 GOOD_TAKE_KEY = QtCore.Qt.Key_F11
 BAD_TAKE_KEY = QtCore.Qt.Key_F12
 REPLAY_TAKE_KEY = QtCore.Qt.Key_F13
+REPLAY_TAIL_KEY = "Shift+F13"
+REPLAY_BACK_KEY = QtCore.Qt.Key_Left
+REPLAY_FORWARD_KEY = QtCore.Qt.Key_Right
+
+# the arrow keys seek the replay by this many seconds
+REPLAY_SEEK_SECONDS = 5
+
+# the audio meter shows RMS levels between these, in dBFS
+METER_MIN_DB = -44
+METER_MAX_DB = -8
+
+# colour of the capture health indicator by health level
+HEALTH_COLORS = {HEALTH_OK: "#00cc00", HEALTH_WARNING: "#FFB300", HEALTH_BAD: "#FF5252"}
 
-DISTORTION_THRESHOLD = 0.8
+# the window should take input within this many seconds of starting, a slower start is reported
+STARTUP_TARGET_SECONDS = 1.0
 
-KEEP_DIR = "recorder-keep"
-DISCARD_DIR = "recorder-discard"
+# take the session and take commands from other devices too, over OSC and HTTP (see control.py for
+# the commands and the ports). the keys only work while the window has focus
+REMOTE_CONTROL = False
 
 APP_TITLE = "Edit-as-you-go Sound Recorder"
 SESSION_DIR_PATH_TXT = "Session Directory: {0}"
 GOOD_TAKE_PATH_TXT = f"    - Good takes: {{0}}/{KEEP_DIR}"
 BAD_TAKE_PATH_TXT = f"    - Bad takes: {{0}}/{DISCARD_DIR}"
 
-TEMP_AUDIOFILE_NAME = '__eaygsr_recording_temp.wav'
-
 
 # style the app, win 10 dark theme
 dark_stylesheet = """
@@ -105,23 +102,27 @@ dark_stylesheet = """
 """
 
 class MainWindow(QMainWindow):
-    audio_level_updated = QtCore.Signal(int)
+    
+    # the input devices, found on a background thread
+    devices_found = QtCore.Signal(list)
+    # a marked take and what keeps it from meeting the ACX requirements, from the take finisher thread
+    take_checked = QtCore.Signal(object, list)
+    # a remote command the recorder has carried out, and whether it did anything, from the control server's thread
+    remote_command = QtCore.Signal(str, bool)
     
     def __init__(self):
         super().__init__()
 
-        self.audio = pyaudio.PyAudio()
-        self.stream = None
-        self.bit_depth = pyaudio.paInt32
-        self.sample_rate = 96000
-        self.channels = 1
-        self.recording = False
-        self.replaying = False
         self.selected_directory = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.DesktopLocation)
-        self.selected_device_index = None
+        # the window only drives the recorder, everything about capture, takes and files lives there
+        # the windowed build has no console, so the log is the only place anything printed ends up
+        self.telemetry = Telemetry(default_log_path(), log_prints=True)
+        # neither PortAudio nor the cues are started here, they get going in the background once the window is up
+        cues = CuePlayer(os.path.join(app_data_dir(), CUE_CACHE_DIR))
+        self.recorder = Recorder(PyAudioBackend(), self.selected_directory, cues, telemetry=self.telemetry)
 
         self.setWindowTitle(APP_TITLE)
-        self.setFixedSize(650, 350)
+        self.setFixedSize(650, 410)
         icon = QIcon("icon.png")
         self.setWindowIcon(icon)
 
@@ -129,6 +130,14 @@ class MainWindow(QMainWindow):
         self.select_dir_btn = QPushButton("Select Directory")
         self.select_dir_btn.pressed.connect(self.select_directory)
         
+        # joins every good take of the session directory into one file
+        self.assemble_btn = QPushButton("Assemble Good Takes")
+        self.assemble_btn.pressed.connect(self.recorder.assemble_good_takes)
+        
+        directory_layout = QHBoxLayout()
+        directory_layout.addWidget(self.select_dir_btn, 1)
+        directory_layout.addWidget(self.assemble_btn)
+        
         self.target_dir_lbl = QLabel(SESSION_DIR_PATH_TXT.format(self.selected_directory))
         self.target_dir_lbl.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
 
@@ -144,42 +153,95 @@ class MainWindow(QMainWindow):
         
         # Create a QComboBox for audio input devices
         self.audio_input_combo = QComboBox()
-        self.audio_input_combo.addItem("None", -1)  # Default item
+        self.audio_input_combo.addItem("Looking for input devices...", -1)  # Default item, "None" once the devices are found
+        self.devices_loaded = False
         self.audio_input_combo.setCurrentIndex(0)  # Set "None" as the initial selection
         self.audio_input_combo.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Fixed)
         
+        # more devices to record alongside the selected one, e.g. a backup or room mic on another interface
+        self.extra_devices_menu = QMenu(self)
+        self.extra_devices_btn = QToolButton()
+        self.extra_devices_btn.setText("Also Record From: None")
+        self.extra_devices_btn.setMenu(self.extra_devices_menu)
+        self.extra_devices_btn.setPopupMode(QToolButton.InstantPopup)
+        self.extra_devices_btn.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Fixed)
+        
         # Create a QProgressBar for the audio meter
         self.audio_meter = QProgressBar()
         self.audio_meter.setValue(0)
-        self.audio_meter.setRange(49, 85)
+        self.audio_meter.setRange(METER_MIN_DB, METER_MAX_DB)
         self.audio_meter.setSizeIncrement(1, 1)
         self.audio_meter.setTextVisible(False)
         self.audio_meter.setOrientation(QtCore.Qt.Vertical)
         self.audio_meter.setFixedSize(20, 60)
         
+        # capture format, only the ones the selected device supports can be picked
+        self.profile_combo = QComboBox()
+        for profile in CAPTURE_PROFILES:
+            self.profile_combo.addItem(profile_label(profile))
+        self.profile_combo.setCurrentIndex(CAPTURE_PROFILES.index(DEFAULT_PROFILE))
+        self.profile_combo.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Fixed)
+        self.profile_combo.currentIndexChanged.connect(self.select_profile)
+        
         # simple quality label
-        quality_label = QLabel("Quality: 96 kHz | 32 Bit")
-        quality_label.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
+        self.quality_label = QLabel()
+        self.quality_label.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
+        
+        # record the whole session to one file and keep takes as an index into it
+        self.session_mode_checkbox = QCheckBox("Single session file")
+        self.session_mode_checkbox.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
+        self.session_mode_checkbox.toggled.connect(self.select_session_mode)
+        self.control = None
         
         # Create a label to display the session time
         self.session_time_label = QLabel("Take Duration: 00:00")
         self.session_time_label.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
         
+        # number of clipped regions in the current take
+        self.clip_label = QLabel("Clips: 0")
+        self.clip_label.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
+        self.clip_count = 0
+        
+        # xruns and dropped audio since the session started, the details are in the tooltip
+        self.health_label = QLabel()
+        self.health_label.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
+        self.health = None
+        
+        # whether the last marked take meets the ACX requirements, the problems are in the tooltip
+        self.acx_label = QLabel("ACX: -")
+        self.acx_label.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
+        
         # Create a QTimer to update the session time label
         self.session_timer = QTimer()
         self.session_timer.timeout.connect(self.update_session_time)
         
         inputs_left_layout = QVBoxLayout()
         inputs_left_layout.addWidget(self.audio_input_combo)
-        inputs_left_layout.addWidget(quality_label)
+        inputs_left_layout.addWidget(self.extra_devices_btn)
+        inputs_left_layout.addWidget(self.profile_combo)
+        inputs_left_layout.addWidget(self.quality_label)
+        inputs_left_layout.addWidget(self.session_mode_checkbox)
         inputs_left_layout.addWidget(self.session_time_label)
+        clip_layout = QHBoxLayout()
+        clip_layout.addWidget(self.clip_label)
+        clip_layout.addWidget(self.health_label)
+        clip_layout.addWidget(self.acx_label)
+        clip_layout.addStretch(1)
+        inputs_left_layout.addLayout(clip_layout)
         
         inputs_layout = QHBoxLayout()
         inputs_layout.addLayout(inputs_left_layout, 1)
         inputs_layout.addWidget(self.audio_meter)
         
-        # connect signal to function
-        self.audio_level_updated.connect(self.update_audio_meter)
+        # the callback only updates the meter's state, the UI reads it at a fixed rate
+        self.meter_timer = QTimer()
+        self.meter_timer.timeout.connect(self.update_audio_meter)
+        self.meter_timer.start(1000 // METER_RATE)
+        
+        self.health_timer = QTimer()
+        self.health_timer.timeout.connect(self.update_health)
+        self.health_timer.start(int(HEALTH_INTERVAL * 1000))
+        self.update_health()
         
         # start session button
         self.start_button = QPushButton("Start Session (F10)")
@@ -209,7 +271,7 @@ class MainWindow(QMainWindow):
         
         # layout all UI
         layout = QtWidgets.QVBoxLayout()
-        layout.addWidget(self.select_dir_btn)
+        layout.addLayout(directory_layout)
         layout.addWidget(self.target_dir_lbl)
         layout.addWidget(self.good_take_lbl)
         layout.addWidget(self.bad_take_lbl)
@@ -227,8 +289,7 @@ class MainWindow(QMainWindow):
         self.setStyleSheet(dark_stylesheet)
         self.show()
         
-        # Initialize audio processing
-        self.start_audio_stream()
+        self.show_profile()
         
         # keyboard shortcuts
         session_start_key_shortcut = QShortcut(QKeySequence(SESS_START_KEY), self)
@@ -243,8 +304,33 @@ class MainWindow(QMainWindow):
         replay_key_shortcut = QShortcut(QKeySequence(REPLAY_TAKE_KEY), self)
         replay_key_shortcut.activated.connect(self.replay_last_take_button.click)
         
-        self.populate_audio_input_devices()
+        replay_tail_key_shortcut = QShortcut(QKeySequence(REPLAY_TAIL_KEY), self)
+        replay_tail_key_shortcut.activated.connect(self.replay_take_tail)
+        
+        replay_back_key_shortcut = QShortcut(QKeySequence(REPLAY_BACK_KEY), self)
+        replay_back_key_shortcut.activated.connect(lambda: self.recorder.skip(-REPLAY_SEEK_SECONDS))
+        
+        replay_forward_key_shortcut = QShortcut(QKeySequence(REPLAY_FORWARD_KEY), self)
+        replay_forward_key_shortcut.activated.connect(lambda: self.recorder.skip(REPLAY_SEEK_SECONDS))
+        
+        # starting PortAudio can take seconds with some drivers, so the devices are listed in the background
+        self.devices_found.connect(self.populate_audio_input_devices)
+        self.take_checked.connect(self.show_take_check)
+        self.remote_command.connect(self.show_remote_command)
+        self.recorder.subscribe(EVENT_TAKE_ANALYZED, self.take_checked.emit)
+        threading.Thread(target=self.scan_audio_input_devices, name="device-scan", daemon=True).start()
         self.update_controls()
+        QTimer.singleShot(0, self.window_ready)
+    
+    def window_ready(self):
+        # the first pass of the event loop, the window is on screen and taking input
+        seconds = time.perf_counter() - STARTED
+        print(f"Window ready in {seconds * 1000:.0f} ms" + (f", over the {STARTUP_TARGET_SECONDS:g} s target" if seconds > STARTUP_TARGET_SECONDS else ""))
+        self.telemetry.log('startup', stage='window', seconds=round(seconds, 3))
+        if REMOTE_CONTROL:
+            from control import ControlServer
+            self.control = ControlServer(self.recorder, session_file=self.session_mode_checkbox.isChecked(), on_command=self.remote_command.emit)
+            self.control.start()
         self.handle_any_file_leftovers()
     
     def update_session_time(self):
@@ -254,36 +340,18 @@ class MainWindow(QMainWindow):
         self.session_time_label.setText(f"Take Duration: {elapsed_time // 60000:02d}:{(elapsed_time // 1000) % 60:02d}")
     
     def handle_any_file_leftovers(self):
-        file_path = f"{self.selected_directory}/{TEMP_AUDIOFILE_NAME}"
-        if os.path.exists(file_path):
-            # The temporary audio file exists, which could be due to a program crash.
-            # check if file length is zero, if so just delete it
-            if os.path.getsize(file_path) == 0:
-                print("Temporary audio file is empty. Deleting it.")
-                os.remove(file_path)
-            else:
-                # Prompt the user to keep or discard it.
-                response = self.prompt_for_keep_or_discard()
-
-                if response == "keep":
-                    # Move the file to the "keep" directory
-                    self.save_recording(True)
-                elif response == "discard":
-                    # Move the file to the "discard" directory
-                    self.save_recording(False)
-                elif response == 'delete':
-                    # Delete the file completely
-                    os.remove(file_path)
-                else:
-                    # we should not get here...
-                    pass
+        self.recorder.handle_leftovers(self.prompt_for_keep_or_discard)
     
-    def prompt_for_keep_or_discard(self):
+    def prompt_for_keep_or_discard(self, file_path, report=None):
         # Create a custom QMessageBox with customized button labels.
         msg_box = QMessageBox()
         
         msg_box.setWindowTitle("Temporary Recording File Found")
-        message = f"A temporary audio file was found in '{self.selected_directory}'. Do you want to place it in the keep folder, discard folder, or delete it entirely?"
+        message = f"A temporary audio file '{os.path.basename(file_path)}' was found in '{self.selected_directory}'."
+        if report is not None:
+            seconds = report.frames // report.sample_rate
+            message += f"\n\nDuration: {seconds // 60:02d}:{seconds % 60:02d} | Peak: {report.peak_db:.1f} dBFS | RMS: {report.rms_db:.1f} dBFS"
+        message += "\n\nDo you want to place it in the keep folder, discard folder, or delete it entirely?"
         msg_box.setText(message)
 
         # Create custom buttons with desired labels.
@@ -294,13 +362,13 @@ class MainWindow(QMainWindow):
         msg_box.exec()
 
         if msg_box.clickedButton() == keep_button:
-            return "keep"
+            return LEFTOVER_KEEP
         elif msg_box.clickedButton() == discard_button:
-            return "discard"
+            return LEFTOVER_DISCARD
         elif msg_box.clickedButton() == delete_button:
-            return "delete"
+            return LEFTOVER_DELETE
         else:
-            return "skip"
+            return LEFTOVER_SKIP
     
     def display_message(self, title, msg):
         message_box = QMessageBox()
@@ -311,16 +379,49 @@ class MainWindow(QMainWindow):
         message_box.exec()
     
     def update_controls(self):
-        has_device = self.selected_device_index is not None and self.selected_device_index > -1
-        self.start_button.setEnabled(has_device)
-        self.audio_input_combo.setEnabled(not self.recording and not self.replaying)
-        self.select_dir_btn.setEnabled(not self.recording and not self.replaying)
-        self.finish_good_take_button.setEnabled(self.recording or self.replaying)
-        self.finish_bad_take_button.setEnabled(self.recording or self.replaying)
-        self.replay_last_take_button.setEnabled(self.recording)
+        recorder = self.recorder
+        self.start_button.setEnabled(recorder.device_index is not None)
+        self.audio_input_combo.setEnabled(self.devices_loaded and not recorder.recording and not recorder.replaying)
+        self.extra_devices_btn.setEnabled(self.devices_loaded and recorder.state == TAKE_IDLE)
+        self.profile_combo.setEnabled(recorder.state == TAKE_IDLE)
+        self.select_dir_btn.setEnabled(not recorder.recording and not recorder.replaying)
+        self.assemble_btn.setEnabled(not recorder.recording and not recorder.replaying)
+        self.session_mode_checkbox.setEnabled(recorder.state == TAKE_IDLE)
+        self.finish_good_take_button.setEnabled(recorder.recording or recorder.replaying)
+        self.finish_bad_take_button.setEnabled(recorder.recording or recorder.replaying)
+        self.replay_last_take_button.setEnabled(recorder.recording)
     
-    def update_audio_meter(self, audio_level):
+    def update_audio_meter(self):
+        levels = self.recorder.levels()
+        audio_level = min(max(round(levels['rms_db']), METER_MIN_DB), METER_MAX_DB)
         self.audio_meter.setValue(audio_level)
+        
+        clip_count = levels['clips']
+        if clip_count != self.clip_count:
+            self.clip_count = clip_count
+            self.clip_label.setText(f"Clips: {clip_count}")
+            self.clip_label.setStyleSheet("QLabel { color: #FF5252; }" if clip_count else "")
+    
+    def update_health(self):
+        level, text, summary = self.recorder.health()
+        if (level, text) != self.health:
+            self.health = (level, text)
+            self.health_label.setText(f"\u25CF {text}")
+            self.health_label.setStyleSheet(f"QLabel {{ color: {HEALTH_COLORS[level]}; }}")
+        details = [f"{key.replace('_', ' ')}: {value}" for key, value in summary.items() if key != 'callback_histogram']
+        details.append(f"Log: {self.telemetry.log_path}")
+        self.health_label.setToolTip("\n".join(details))
+    
+    def show_take_check(self, take, problems):
+        verdict = "good" if take.verdict else "bad"
+        if problems:
+            self.acx_label.setText(f"ACX: {len(problems)} issue{'s' if len(problems) > 1 else ''}")
+            self.acx_label.setStyleSheet("QLabel { color: #FF5252; }")
+            self.acx_label.setToolTip(f"Last take ({verdict}):\n" + "\n".join(problems))
+        else:
+            self.acx_label.setText("ACX: OK")
+            self.acx_label.setStyleSheet(f"QLabel {{ color: {HEALTH_COLORS[HEALTH_OK]}; }}")
+            self.acx_label.setToolTip(f"Last take ({verdict}) meets the ACX requirements")
     
     def select_directory(self):
         temp_selected_dir = QFileDialog.getExistingDirectory(self, "Select Directory", self.selected_directory, QFileDialog.ShowDirsOnly)
@@ -329,6 +430,7 @@ class MainWindow(QMainWindow):
         
         if os.access(temp_selected_dir, os.W_OK):
             self.selected_directory = temp_selected_dir
+            self.recorder.directory = temp_selected_dir
             self.handle_any_file_leftovers()
         else:
             print(f"Write permission error for directory {temp_selected_dir}")
@@ -345,25 +447,30 @@ class MainWindow(QMainWindow):
         
         self.update_controls()
     
-    def populate_audio_input_devices(self):
-        info = self.audio.get_host_api_info_by_index(0)
-        num_devices = info.get('deviceCount')
-
-        input_devices = []
-
-        for i in range(num_devices):
-            device_info = self.audio.get_device_info_by_host_api_device_index(0, i)
-            if device_info.get('maxInputChannels') > 0:
-                input_devices.append({
-                    'index': device_info.get('index'),
-                    'name': device_info.get('name'),
-                    'details': f"Index: {i}, Name: {device_info.get('name')}",
-                })
+    def scan_audio_input_devices(self):
+        # runs on its own thread, the list is handed to the UI thread through the signal
+        try:
+            input_devices = self.recorder.input_devices()
+        except Exception as e:
+            print(f"Could not list the audio input devices: {e}")
+            input_devices = []
+        self.devices_found.emit(input_devices)
+    
+    def populate_audio_input_devices(self, input_devices):
+        seconds = time.perf_counter() - STARTED
+        print(f"Found {len(input_devices)} input devices {seconds * 1000:.0f} ms after start")
+        self.telemetry.log('startup', stage='devices', seconds=round(seconds, 3), devices=len(input_devices))
+        self.devices_loaded = True
+        self.audio_input_combo.setItemText(0, "None")
 
         if input_devices:
             for device in input_devices:
                 self.audio_input_combo.addItem(device['name'], device['index'])
+                action = self.extra_devices_menu.addAction(device['name'])
+                action.setCheckable(True)
+                action.setData(device['index'])
             self.audio_input_combo.currentIndexChanged.connect(self.select_audio_device)
+            self.extra_devices_menu.triggered.connect(self.select_extra_devices)
         else:
             self.audio_input_combo.addItem("No audio input devices found", -1)
             self.display_message("No Input Devices Found", "This application requires one or more input devices be available on the machine.")
@@ -371,195 +478,117 @@ class MainWindow(QMainWindow):
         self.update_controls()
     
     def select_audio_device(self):
-        self.selected_device_index = self.audio_input_combo.currentData()
-        if self.selected_device_index < 0:
+        device_index = self.audio_input_combo.currentData()
+        if device_index < 0:
             print('No audio input device selected')
         else:
             print(f"Selected audio input device: {self.audio_input_combo.currentText()}")
-        
-        self.start_audio_stream()
+        self.recorder.select_device(device_index)
+        self.show_profile()
         self.update_controls()
-            
-    def start_audio_stream(self):
-        if self.stream is not None:
-            self.stream.stop_stream()
-            self.stream.close()
-
-        if self.selected_device_index is not None and self.selected_device_index >= 0:
-            self.stream = self.audio.open(
-                format=self.bit_depth,
-                channels=self.channels,
-                rate=self.sample_rate,
-                input=True,
-                input_device_index=self.selected_device_index,
-                frames_per_buffer=1024,
-                stream_callback=self.audio_callback
-            )
-            self.stream.start_stream()
-
+    
+    def select_extra_devices(self):
+        device_indexes = [action.data() for action in self.extra_devices_menu.actions() if action.isChecked()]
+        names = [action.text() for action in self.extra_devices_menu.actions() if action.isChecked()]
+        self.extra_devices_btn.setText(f"Also Record From: {', '.join(names) or 'None'}")
+        # every device gets its own writer, so the whole capture is rebuilt
+        self.recorder.select_device(self.recorder.device_index, device_indexes)
+        self.update_controls()
+    
+    def select_profile(self):
+        profile = CAPTURE_PROFILES[self.profile_combo.currentIndex()]
+        try:
+            self.recorder.set_profile(profile)
+        except ValueError as e:
+            self.display_message("Unsupported Format", str(e))
+        self.show_profile()
+        self.update_controls()
+    
+    def show_profile(self):
+        # grey out the profiles the device cannot record, and show the one in use
+        for i, profile in enumerate(CAPTURE_PROFILES):
+            self.profile_combo.model().item(i).setEnabled(self.recorder.profile_supported(profile))
+        profile = self.recorder.profile
+        self.profile_combo.blockSignals(True)
+        self.profile_combo.setCurrentIndex(CAPTURE_PROFILES.index(profile))
+        self.profile_combo.blockSignals(False)
+        self.quality_label.setText(f"Quality: {profile_label(profile)}")
+    
     def replay_last_take(self):
-        self.stop_recording()
-        self.replay_take()
+        self.session_timer.stop()
+        self.recorder.replay()
         self.update_controls()
 
     def finish_good_take(self):
-        if self.replaying:
-            self.stop_replaying()
-        if self.recording:
-            self.stop_recording()
-        self.save_recording(True)
-        ui_channel.play(GOOD_TAKE_SND)
-        while ui_channel.get_busy():
-            pass
-        self.start_recording()
-        self.update_controls()
+        self.mark_take(True)
 
     def finish_bad_take(self):
-        if self.replaying:
-            self.stop_replaying()
-        if self.recording:
-            self.stop_recording()
-        self.save_recording(False)
-        ui_channel.play(BAD_TAKE_SND)
-        while ui_channel.get_busy():
-            pass
-        self.start_recording()
-        self.update_controls()
-
-    def replay_take(self):
-        self.replaying = True
-        replay_channel.stop()
-        snd = pymixer.Sound(f"{self.selected_directory}/{TEMP_AUDIOFILE_NAME}")
-        replay_channel.play(snd, 99)        
+        self.mark_take(False)
 
-    def stop_replaying(self):
-        replay_channel.stop()
-        self.replaying = False
+    def mark_take(self, wasGoodTake):
+        # the next take starts on the exact sample this one ends, the file is moved in the background
+        if self.recorder.mark_take(wasGoodTake) is not None:
+            self.start_take_timer()
+        self.update_controls()
 
-    def end_session(self):
-        self.stop_recording()
-        self.stop_replaying()
-        os.unlink(f"{self.selected_directory}/{TEMP_AUDIOFILE_NAME}") # delete scraps
-        ui_channel.play(SESS_END_SND)
-        self.session_time_label.setText(f"Take Duration: 00:00")
+    def replay_take_tail(self):
+        if self.recorder.state == TAKE_IDLE:
+            return
+        self.session_timer.stop()
+        self.recorder.replay(REPLAY_TAIL_SECONDS)
+        self.update_controls()
 
     def toggle_recording(self):
-        if self.recording or self.replaying:
+        if self.recorder.state != TAKE_IDLE:
             # end the session
-            self.start_button.setText("Start Session")
-            self.start_button.setStyleSheet("QPushButton { background-color: #0078D7; border: 1px solid #0078D7; }")
-            self.end_session()
-            print('Session Ended')
+            self.show_session(False)
+            self.recorder.end_session()
         else:
             # start the session
+            self.show_session(True)
+            if self.recorder.start_session(self.session_mode_checkbox.isChecked()) is not None:
+                self.start_take_timer()
+        
+        self.update_controls()
+    
+    def show_session(self, running):
+        if running:
             self.start_button.setText("End Session")
             self.start_button.setStyleSheet("QPushButton { background-color: #D32F2F; border: 1px solid red; }")
-            self.start_recording()
-            print('Session Started')
-        
+        else:
+            self.start_button.setText("Start Session")
+            self.start_button.setStyleSheet("QPushButton { background-color: #0078D7; border: 1px solid #0078D7; }")
+            self.session_timer.stop()
+            self.session_time_label.setText(f"Take Duration: 00:00")
+    
+    def show_remote_command(self, command, done):
+        # the recorder has already carried it out on the control server's thread, the window only catches up
+        self.show_session(self.recorder.state != TAKE_IDLE)
+        if done and self.recorder.replaying:
+            self.session_timer.stop()
+        elif done and self.recorder.recording:
+            self.start_take_timer()
         self.update_controls()
     
-    def start_recording(self):
-        if not self.selected_directory:
-            print("No directory selected for saving recordings.")
-            return
-
-        record_start_channel.play(SESS_START_SND)
-
-        file_path = f"{self.selected_directory}/{TEMP_AUDIOFILE_NAME}"
-        self.recording_file = wave.open(file_path, "wb")
-        self.recording_file.setnchannels(self.channels)
-        self.recording_file.setsampwidth(4) # 4 for 32 bit audio
-        self.recording_file.setframerate(self.sample_rate)
-        self.recording_buffer = []
-        self.recording = True
-        
-        self.set_hidden_attribute(file_path)
-        
+    def select_session_mode(self, checked):
+        if self.control is not None:
+            self.control.session_file = checked
+    
+    def start_take_timer(self):
         self.session_timer.start(100)  # Update every 1 second
         self.start_time = QTime.currentTime()
-
-    def stop_recording(self):
-        if self.recording and hasattr(self, "recording_file"):
-            self.recording_file.writeframes(b''.join(self.recording_buffer))
-            self.recording_file.close()
-        
-        self.session_timer.stop()
-        self.recording = False
-
-    def save_recording(self, wasGoodTake):
-        # move file to keep or discard based on how we stopped the recording
-        if wasGoodTake:
-            directory_path = f"{self.selected_directory}/{KEEP_DIR}"
-        else:
-            directory_path = f"{self.selected_directory}/{DISCARD_DIR}"
-            
-        if not os.path.exists(directory_path):
-            os.makedirs(directory_path)
-        
-        try:
-            current_time_seconds = int(time.time())
-            src_path = f"{self.selected_directory}/{TEMP_AUDIOFILE_NAME}"
-            dest_path = os.path.join(directory_path, f"track_{current_time_seconds}.wav")
-            shutil.move(src_path, dest_path)
-            self.unset_hidden_attribute(dest_path) # make file visible again to the user
-            print(f"Moved '{self.selected_directory}/{TEMP_AUDIOFILE_NAME}' to '{directory_path}'")
-        except FileNotFoundError:
-            print(f"Source file '{self.selected_directory}/{TEMP_AUDIOFILE_NAME}' not found.")
-        except shutil.Error as e:
-            print(f"Error while moving the file: {e}")
-        
-
-    def audio_callback(self, in_data, frame_count, time_info, status):
-        if status:
-            print("Audio input underflow!") 
-
-        audio_data = np.frombuffer(in_data, dtype=np.int32)
-        rms = np.sqrt(np.mean(np.square(audio_data.astype(np.float64)) / (2 ** 31)))
-        audio_level_dB = 20 * math.log10(rms) # Convert to dB
-
-        peak_amplitude = np.max(np.abs(audio_data)) / (2 ** 31)  # Normalize to the range [-1.0, 1.0]
-        if peak_amplitude > DISTORTION_THRESHOLD:
-            print("Audio distortion detected!")
-
-        if self.recording:
-            self.recording_buffer.append(in_data)
-            
-            # every 10 MB, flush the buffer to the temp file so we don't lose everything if we crash
-            if len(self.recording_buffer) * len(in_data) >= 10 * 1024 * 1024:
-                print('Flush audio to temp file')
-                self.recording_file.writeframes(b''.join(self.recording_buffer))
-                self.recording_buffer = []
-
-        # Update the audio meter
-        # print(audio_level_dB)
-        self.audio_level_updated.emit(audio_level_dB)
-        
-        return None, pyaudio.paContinue
-
-    def set_hidden_attribute(self, file_path):
-        if os.name == 'nt':
-            # On Windows, set the hidden attribute
-            try:
-                # FILE_ATTRIBUTE_HIDDEN = 2
-                ctypes.windll.kernel32.SetFileAttributesW(file_path, 2)
-            except Exception as e:
-                print(f"Error setting hidden attribute: {e}")
-        else:
-            print("Setting file attributes is not supported on this platform.")
-
-    def unset_hidden_attribute(self, file_path):
-        if os.name == 'nt':
-            # On Windows, remove the hidden attribute
-            try:
-                # FILE_ATTRIBUTE_NORMAL = 128
-                ctypes.windll.kernel32.SetFileAttributesW(file_path, 128)
-            except Exception as e:
-                print(f"Error unsetting hidden attribute: {e}")
-        else:
-            print("Setting file attributes is not supported on this platform.")
+        self.update_session_time()
+
+    def closeEvent(self, event):
+        # make sure the writer threads flush and close any open take before we exit
+        if self.control is not None:
+            self.control.stop()
+        self.recorder.close()
+        super().closeEvent(event)
             
 if __name__ == "__main__":
+    # the compressor's worker processes start from this file too, in frozen builds as well
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     w = MainWindow()
     app.exec()
\ No newline at end of file
@@ -0,0 +1,80 @@
+import math
+
+import numpy as np
+
+# how often the UI reads the meter, in Hz
+METER_RATE = 30
+# the level falls back at this rate after a loud block, in dB per second
+METER_RELEASE_DB_PER_SECOND = 20.0
+# how long the peak hold stays put before it starts falling
+PEAK_HOLD_SECONDS = 1.5
+# what silence reads as, in dBFS
+METER_FLOOR_DB = -100.0
+
+
+class LevelMeter:
+    """ RMS/peak meter fed from the audio callback.
+
+    Every block is scaled into a preallocated scratch buffer and reduced in place, so metering
+    allocates nothing per callback. The UI polls `rms_db`, `peak_db` and `peak_hold_db` on a
+    timer instead of being signalled for every block.
+    """
+
+    def __init__(self, sample_rate, channels, dtype=np.int32, block_frames=1024):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        if self.dtype.kind == 'f':
+            self.scale = 1.0
+        else:
+            self.scale = 1.0 / (1 << (8 * self.dtype.itemsize - 1))
+        self._scratch = np.empty(block_frames * channels, dtype=np.float64)
+
+        # latest block, linear full scale
+        self.rms = 0.0
+        self.peak = 0.0
+        # ballistics, in dBFS
+        self.rms_db = METER_FLOOR_DB
+        self.peak_db = METER_FLOOR_DB
+        self.peak_hold_db = METER_FLOOR_DB
+        self._hold_remaining = 0.0
+
+    def reset(self):
+        self.rms = self.peak = 0.0
+        self.rms_db = self.peak_db = self.peak_hold_db = METER_FLOOR_DB
+        self._hold_remaining = 0.0
+
+    def process(self, in_data):
+        samples = np.frombuffer(in_data, dtype=self.dtype)
+        count = samples.size
+        if count == 0:
+            return
+        if count > self._scratch.size:
+            # only happens if the stream hands us a bigger block than it was opened with
+            self._scratch = np.empty(count, dtype=np.float64)
+
+        scratch = self._scratch[:count]
+        np.multiply(samples, self.scale, out=scratch)
+        self.rms = math.sqrt(np.dot(scratch, scratch) / count)
+        self.peak = max(scratch.max(), -scratch.min())
+
+        seconds = count / self.channels / self.sample_rate
+        release = METER_RELEASE_DB_PER_SECOND * seconds
+        # instant attack, linear release in dB
+        self.rms_db = max(to_db(self.rms), self.rms_db - release)
+        self.peak_db = max(to_db(self.peak), self.peak_db - release)
+
+        if self.peak_db >= self.peak_hold_db:
+            self.peak_hold_db = self.peak_db
+            self._hold_remaining = PEAK_HOLD_SECONDS
+        elif self._hold_remaining > 0:
+            self._hold_remaining -= seconds
+        else:
+            self.peak_hold_db = max(self.peak_db, self.peak_hold_db - release)
+
+
+def to_db(value):
+    # dBFS of a linear level, silence reads as METER_FLOOR_DB instead of -inf
+    if value <= 0:
+        return METER_FLOOR_DB
+    return max(20 * math.log10(value), METER_FLOOR_DB)
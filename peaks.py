@@ -0,0 +1,117 @@
+""" Waveform overviews of takes: min/max peaks at a few zoom levels, in a small sidecar file.
+
+A `.peaks` file starts with the line `EAYGPEAKS1`, then one line of JSON:
+
+    {"sample_rate": 96000, "channels": 1, "frames": 5760000,
+     "levels": [{"bucket_frames": 256, "buckets": 22500, "offset": 0}, ...]}
+
+followed by the levels, each at its `offset` from the end of the JSON line: `buckets` rows of
+int16 little endian (min, max) pairs, one pair per channel, full scale 32767. The last bucket
+of a level covers whatever frames are left, so it may be shorter than `bucket_frames`.
+"""
+import json
+import os
+
+import numpy as np
+
+# frames per bucket of each level, finest first. each divides the next
+PEAK_BUCKET_FRAMES = [256, 4096, 65536]
+PEAKS_EXTENSION = '.peaks'
+PEAKS_MAGIC = b'EAYGPEAKS1\n'
+
+
+class PeakPyramid:
+    """ Take analyzer that builds the min/max peaks of every level as the take is written.
+
+    Only the finest level is worked out from the samples, each coarser one from the level
+    below it, and frames that do not fill a bucket yet are carried to the next block. Buckets
+    are placed by `frame_offset`, frames the analysis did not see count as silence. The peaks
+    are written to `path` when the take ends.
+    """
+
+    name = 'peaks'
+
+    def __init__(self, sample_rate, channels, path, bucket_frames=PEAK_BUCKET_FRAMES):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.path = path
+        self.bucket_frames = list(bucket_frames)
+        self.frames = 0
+        # finished buckets of each level, as a list of (buckets, channels, 2) int16 arrays
+        self._levels = [[] for _ in self.bucket_frames]
+        # samples not yet filling a bucket of the finest level, and buckets not yet filling one of each coarser level
+        self._sample_carry = np.empty((0, channels))
+        self._peak_carry = [np.empty((0, channels, 2), np.int16) for _ in self.bucket_frames]
+
+    def process(self, samples, frame_offset):
+        if frame_offset < self.frames:
+            raise ValueError(f"frame {frame_offset} was already analysed, up to {self.frames}")
+        if frame_offset > self.frames:
+            samples = np.concatenate((np.zeros((frame_offset - self.frames, self.channels)), samples))
+        self.frames += samples.shape[0]
+        block = np.concatenate((self._sample_carry, samples)) if self._sample_carry.shape[0] else samples
+        full = block.shape[0] - block.shape[0] % self.bucket_frames[0]
+        self._sample_carry = block[full:].copy()
+        if full:
+            shaped = block[:full].reshape(-1, self.bucket_frames[0], self.channels)
+            self._add(0, to_peaks(shaped.min(axis=1), shaped.max(axis=1)))
+
+    def finish(self):
+        # the partial buckets at the end are kept, finest level first so they reach the coarser ones
+        if self._sample_carry.shape[0]:
+            self._add(0, to_peaks(self._sample_carry.min(axis=0)[np.newaxis], self._sample_carry.max(axis=0)[np.newaxis]))
+            self._sample_carry = self._sample_carry[:0]
+        for level in range(1, len(self.bucket_frames)):
+            carry = self._peak_carry[level]
+            if carry.shape[0]:
+                self._peak_carry[level] = carry[:0]
+                self._add(level, np.stack((carry[..., 0].min(axis=0), carry[..., 1].max(axis=0)), axis=-1)[np.newaxis])
+        levels = [np.concatenate(chunks) if chunks else np.empty((0, self.channels, 2), np.int16) for chunks in self._levels]
+        write_peaks(self.path, self.sample_rate, self.channels, self.frames, self.bucket_frames, levels)
+        # the sidecar is next to the take's file, wherever that gets moved to
+        return {'file': os.path.basename(self.path), 'bucket_frames': self.bucket_frames}
+
+    def _add(self, level, peaks):
+        self._levels[level].append(peaks)
+        if level + 1 == len(self.bucket_frames):
+            return
+        factor = self.bucket_frames[level + 1] // self.bucket_frames[level]
+        carry = self._peak_carry[level + 1]
+        block = np.concatenate((carry, peaks)) if carry.shape[0] else peaks
+        full = block.shape[0] - block.shape[0] % factor
+        self._peak_carry[level + 1] = block[full:].copy()
+        if full:
+            shaped = block[:full].reshape(-1, factor, self.channels, 2)
+            self._add(level + 1, np.stack((shaped[..., 0].min(axis=1), shaped[..., 1].max(axis=1)), axis=-1))
+
+
+def to_peaks(minimum, maximum):
+    # float min and max of shape (buckets, channels) to int16 (buckets, channels, 2)
+    peaks = np.stack((minimum, maximum), axis=-1) * 32767
+    return np.clip(np.round(peaks), -32768, 32767).astype(np.int16)
+
+
+def write_peaks(path, sample_rate, channels, frames, bucket_frames, levels):
+    header = {'sample_rate': sample_rate, 'channels': channels, 'frames': frames, 'levels': []}
+    offset = 0
+    for size, peaks in zip(bucket_frames, levels):
+        header['levels'].append({'bucket_frames': size, 'buckets': peaks.shape[0], 'offset': offset})
+        offset += peaks.nbytes
+    with open(path, 'wb') as f:
+        f.write(PEAKS_MAGIC)
+        f.write(json.dumps(header).encode('utf-8') + b'\n')
+        for peaks in levels:
+            f.write(peaks.astype('<i2').tobytes())
+
+
+def read_peaks(path):
+    """ Returns the header of a .peaks file, with each level's peaks under `peaks` as (buckets, channels, 2) int16. """
+    with open(path, 'rb') as f:
+        if f.readline() != PEAKS_MAGIC:
+            raise ValueError(f"'{path}' is not a peaks file")
+        header = json.loads(f.readline())
+        data = f.read()
+    for level in header['levels']:
+        size = level['buckets'] * header['channels'] * 2
+        level['peaks'] = np.frombuffer(data, '<i2', size, level['offset']).reshape(level['buckets'], header['channels'], 2)
+    return header
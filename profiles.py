@@ -0,0 +1,38 @@
+from collections import namedtuple
+
+from wavfile import WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT
+
+SAMPLE_INT16 = 'int16'
+# captured as int32 and packed to 3 bytes per sample on disk
+SAMPLE_INT24 = 'int24'
+SAMPLE_INT32 = 'int32'
+SAMPLE_FLOAT32 = 'float32'
+
+SampleFormat = namedtuple('SampleFormat', ['stream_width', 'file_width', 'format_tag', 'dtype', 'label'])
+
+SAMPLE_FORMATS = {
+    SAMPLE_INT16: SampleFormat(2, 2, WAVE_FORMAT_PCM, '<i2', '16 Bit'),
+    SAMPLE_INT24: SampleFormat(4, 3, WAVE_FORMAT_PCM, '<i4', '24 Bit'),
+    SAMPLE_INT32: SampleFormat(4, 4, WAVE_FORMAT_PCM, '<i4', '32 Bit'),
+    SAMPLE_FLOAT32: SampleFormat(4, 4, WAVE_FORMAT_IEEE_FLOAT, '<f4', '32 Bit Float'),
+}
+
+CaptureProfile = namedtuple('CaptureProfile', ['sample_format', 'sample_rate', 'channels', 'frames_per_buffer'])
+
+CAPTURE_PROFILES = [
+    CaptureProfile(SAMPLE_INT32, 96000, 1, 1024),
+    CaptureProfile(SAMPLE_INT24, 96000, 1, 1024),
+    CaptureProfile(SAMPLE_FLOAT32, 96000, 1, 1024),
+    CaptureProfile(SAMPLE_INT24, 48000, 1, 512),
+    CaptureProfile(SAMPLE_INT24, 48000, 2, 512),
+    CaptureProfile(SAMPLE_INT24, 44100, 1, 512),
+    CaptureProfile(SAMPLE_INT16, 44100, 1, 512),
+    CaptureProfile(SAMPLE_INT16, 44100, 2, 512),
+]
+DEFAULT_PROFILE = CAPTURE_PROFILES[0]
+
+
+def profile_label(profile):
+    # e.g. "96 kHz | 24 Bit | Mono"
+    channels = {1: 'Mono', 2: 'Stereo'}.get(profile.channels, f"{profile.channels} Channels")
+    return f"{profile.sample_rate / 1000:g} kHz | {SAMPLE_FORMATS[profile.sample_format].label} | {channels}"
@@ -0,0 +1,39 @@
+import math
+import mmap
+from collections import namedtuple
+
+import numpy as np
+
+from metering import to_db
+from wavfile import repair_header, decode_samples
+
+# number of samples measured per step when scanning a recovered file
+SCAN_CHUNK_SAMPLES = 1 << 20
+
+RecoveryReport = namedtuple('RecoveryReport', ['file_path', 'frames', 'sample_rate', 'trimmed_bytes', 'peak_db', 'rms_db'])
+
+
+def recover_recording(file_path):
+    """ Make an orphaned temp recording playable again and measure what is in it.
+
+    The header is rebuilt from the actual data length (see wavfile.repair_header), then the
+    audio is scanned through a memory map in fixed size chunks, so even multi GB files are
+    never read into Python memory at once.
+    """
+    info, trimmed = repair_header(file_path)
+    frame_size = info.channels * info.sample_width
+    frames = info.data_size // frame_size
+
+    peak = 0.0
+    sum_squares = 0.0
+    total_samples = frames * info.channels
+    if total_samples:
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for start in range(0, total_samples, SCAN_CHUNK_SAMPLES):
+                count = min(SCAN_CHUNK_SAMPLES, total_samples - start)
+                samples = decode_samples(mm, info.sample_width, info.format_tag, info.data_offset + start * info.sample_width, count)
+                peak = max(peak, samples.max(), -samples.min())
+                sum_squares += np.dot(samples, samples)
+
+    rms = math.sqrt(sum_squares / total_samples) if total_samples else 0.0
+    return RecoveryReport(file_path, frames, info.sample_rate, trimmed, to_db(peak), to_db(rms))
@@ -0,0 +1,115 @@
+import threading
+import time
+
+from backends import STREAM_CONTINUE, STREAM_COMPLETE
+from wavfile import read_wav_info
+
+# frames read from disk per output callback
+REPLAY_BLOCK_FRAMES = 1024
+
+
+class StreamingPlayer:
+    """ Plays a WAV file, or a frame range of one, through an output stream of an audio backend.
+
+    Audio is read from disk a block at a time as the stream asks for it, so playback starts
+    right away no matter how long the take is, and seeking is just moving the read position.
+    """
+
+    def __init__(self, backend, block_frames=REPLAY_BLOCK_FRAMES):
+        self.backend = backend
+        self.block_frames = block_frames
+        # seconds from play() to the first block handed to the output stream
+        self.start_latency = None
+        self._stream = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    @property
+    def playing(self):
+        return self._stream is not None and self._stream.is_active()
+
+    @property
+    def position(self):
+        # seconds from the start of the played range
+        if self._file is None:
+            return 0.0
+        return (self._position - self._start) / self._sample_rate
+
+    def play(self, file_path, start_frame=0, end_frame=None, last_seconds=None, loop=True):
+        self.stop()
+
+        info = read_wav_info(file_path)
+        frame_size = info.channels * info.sample_width
+        total_frames = info.data_size // frame_size
+        end_frame = total_frames if end_frame is None else min(end_frame, total_frames)
+        start_frame = max(0, min(start_frame, end_frame))
+        if last_seconds is not None:
+            start_frame = max(start_frame, end_frame - int(last_seconds * info.sample_rate))
+        if end_frame <= start_frame:
+            print(f"Nothing to replay in '{file_path}'")
+            return False
+
+        self._file = open(file_path, 'rb')
+        self._data_offset = info.data_offset
+        self._frame_size = frame_size
+        self._sample_rate = info.sample_rate
+        self._start = start_frame
+        self._end = end_frame
+        self._position = start_frame
+        self._loop = loop
+        self._requested = time.perf_counter()
+        self.start_latency = None
+
+        self._stream = self.backend.open_output(info.channels, info.sample_width, info.format_tag, info.sample_rate,
+                                                self.block_frames, self._callback)
+        return True
+
+    def seek(self, seconds):
+        # jump to `seconds` from the start of the played range
+        with self._lock:
+            if self._file is None:
+                return
+            frame = self._start + int(seconds * self._sample_rate)
+            self._position = max(self._start, min(frame, self._end - 1))
+
+    def skip(self, seconds):
+        self.seek(self.position + seconds)
+
+    def stop(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        chunks = []
+        remaining = frame_count
+        with self._lock:
+            if self._file is None:
+                return b'\x00' * (frame_count * self._frame_size), STREAM_COMPLETE
+            while remaining > 0:
+                if self._position >= self._end:
+                    if not self._loop:
+                        break
+                    self._position = self._start
+                count = min(remaining, self._end - self._position)
+                self._file.seek(self._data_offset + self._position * self._frame_size)
+                chunk = self._file.read(count * self._frame_size)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                self._position += len(chunk) // self._frame_size
+                remaining -= len(chunk) // self._frame_size
+
+        if self.start_latency is None:
+            self.start_latency = time.perf_counter() - self._requested
+
+        data = b''.join(chunks)
+        if remaining > 0:
+            # pad the last block and let the stream finish
+            return data + b'\x00' * (remaining * self._frame_size), STREAM_COMPLETE
+        return data, STREAM_CONTINUE
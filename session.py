@@ -0,0 +1,212 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from wavfile import WavWriter, copy_frames, read_wav_info, decode_samples, encode_samples, COPY_CHUNK_SIZE, FSYNC_ON_CLOSE
+
+TAKE_INDEX_SUFFIX = '.takes.jsonl'
+# index of the takes recorded one file per take, kept in the session directory
+TAKE_LOG_NAME = 'recorder-takes.jsonl'
+
+VERDICT_GOOD = 'good'
+VERDICT_BAD = 'bad'
+
+
+def take_index_path(capture_path):
+    return os.path.splitext(capture_path)[0] + TAKE_INDEX_SUFFIX
+
+
+class TakeIndex:
+    """ Append-only JSON lines index of takes, doubling as the session manifest.
+
+    Every line is a record for one take. Later records for the same take override the fields
+    of earlier ones, so re-classifying or re-cutting a take is just another append.
+    For a continuous session capture file, takes are numbered and frame offsets are relative
+    to the start of the capture file's audio data. The manifest of a session directory
+    (TAKE_LOG_NAME) has one record per take file in the keep/discard directories, numbered
+    across every session recorded there.
+
+    The records are kept in memory and only lines appended since the last query are read, so
+    listing, filtering and totaling never re-reads the whole file or opens any audio.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._takes = {}
+        # bytes of the file already parsed, and whether it ends in a half written line
+        self._read_size = 0
+        self._partial = False
+        self._lock = threading.Lock()
+
+    def add(self, take_id, start_frame, end_frame, verdict, sample_rate=None, **fields):
+        record = {
+            'take': take_id,
+            'start_frame': start_frame,
+            'end_frame': end_frame,
+            'verdict': verdict,
+            'time': time.time(),
+        }
+        if sample_rate:
+            record['sample_rate'] = sample_rate
+            record['duration'] = (end_frame - start_frame) / sample_rate
+        record.update(fields)
+        self._append(record)
+
+    def update(self, take_id, **fields):
+        fields['take'] = take_id
+        self._append(fields)
+
+    def takes(self, verdict=None, where=None):
+        # records in the order the takes were first added, optionally filtered
+        with self._lock:
+            self._refresh()
+            takes = [dict(take) for take in self._takes.values()]
+        if verdict is not None:
+            takes = [take for take in takes if take.get('verdict') == verdict]
+        if where is not None:
+            takes = [take for take in takes if where(take)]
+        return takes
+
+    def get(self, take_id):
+        with self._lock:
+            self._refresh()
+            take = self._takes.get(take_id)
+            return dict(take) if take is not None else None
+
+    def next_take_id(self):
+        # one past the highest numbered take so far
+        with self._lock:
+            self._refresh()
+            return max((take_id for take_id in self._takes if isinstance(take_id, int)), default=0) + 1
+
+    def total_duration(self, verdict=None):
+        # seconds, for records that know their sample rate
+        return sum(take.get('duration', 0.0) for take in self.takes(verdict))
+
+    def _refresh(self):
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            size = 0
+        if size < self._read_size:
+            # rewritten or truncated behind our back, start over
+            self._takes = {}
+            self._read_size = 0
+        if size == self._read_size:
+            return
+
+        with open(self.path, 'rb') as f:
+            f.seek(self._read_size)
+            data = f.read(size - self._read_size)
+        # a half written last line is picked up once it is complete
+        complete = data.rfind(b'\n') + 1
+        self._read_size += complete
+        self._partial = complete < len(data)
+        for line in data[:complete].splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a crash can leave a half written line
+                continue
+            if isinstance(record, dict) and 'take' in record:
+                self._takes.setdefault(record['take'], {}).update(record)
+
+    def _append(self, record):
+        with self._lock:
+            self._refresh()
+            line = json.dumps(record) + '\n'
+            if self._partial:
+                # end the line a crash left unfinished so this record is not glued onto it
+                line = '\n' + line
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            self._refresh()
+
+
+def export_takes(capture_path, keep_dir, discard_dir, source_path=None, suffix=''):
+    """ Materialize every take in a session capture file as its own WAV, by range-copying the data.
+
+    With `source_path` the takes listed for `capture_path` are cut from that file instead, e.g.
+    the same session recorded by another device, and `suffix` is appended to their names.
+    Returns a list of (take record, file written) pairs.
+    """
+    index = TakeIndex(take_index_path(capture_path))
+    session_name = os.path.splitext(os.path.basename(capture_path))[0]
+    written = []
+    for take in index.takes():
+        directory_path = keep_dir if take['verdict'] == VERDICT_GOOD else discard_dir
+        if not os.path.exists(directory_path):
+            os.makedirs(directory_path)
+        dest_path = os.path.join(directory_path, f"{session_name}_take{take['take']:04d}{suffix}.wav")
+        copy_frames(source_path or capture_path, dest_path, take['start_frame'], take['end_frame'])
+        written.append((take, dest_path))
+    return written
+
+
+def assemble_takes(take_paths, dest_path, labels=None, ranges=None):
+    """ Concatenate takes, in order, into one master WAV with a cue point at the start of each.
+
+    `ranges` can give a (start_frame, end_frame) for each take to put only that part of it in
+    the master, None for the whole take.
+
+    The master gets the format of the first take. Takes in the same format have their audio
+    copied file to file without passing through Python; any other take is converted a chunk at
+    a time. Either way memory use does not depend on the length of the takes. The master is
+    switched to RF64 if it grows past 4 GiB. Returns the number of frames written.
+    """
+    infos = [read_wav_info(path) for path in take_paths]
+    if not infos:
+        raise ValueError("No takes to assemble")
+    first = infos[0]
+    for path, info in zip(take_paths, infos):
+        if info.sample_rate != first.sample_rate:
+            raise ValueError(f"'{path}' is {info.sample_rate} Hz, the other takes are {first.sample_rate} Hz")
+        if info.channels != first.channels and 1 not in (info.channels, first.channels):
+            raise ValueError(f"'{path}' has {info.channels} channels, the other takes have {first.channels}")
+    if labels is None:
+        labels = [os.path.splitext(os.path.basename(path))[0] for path in take_paths]
+    if ranges is None:
+        ranges = [None] * len(take_paths)
+
+    with WavWriter(dest_path, first.channels, first.sample_width, first.sample_rate,
+                   format_tag=first.format_tag, fsync=FSYNC_ON_CLOSE) as master:
+        for path, info, label, frame_range in zip(take_paths, infos, labels, ranges):
+            master.add_cue(master.frames_written, label)
+            frame_size = info.channels * info.sample_width
+            frames = info.data_size // frame_size
+            start_frame, end_frame = frame_range or (0, frames)
+            start_frame = max(0, min(start_frame, frames))
+            end_frame = max(start_frame, min(end_frame, frames))
+            offset, size = info.data_offset + start_frame * frame_size, (end_frame - start_frame) * frame_size
+            with open(path, 'rb') as src:
+                if (info.channels, info.sample_width, info.format_tag) == (first.channels, first.sample_width, first.format_tag):
+                    master.write_file_range(src, offset, size)
+                else:
+                    _convert_take(src, info, master, offset, size)
+    return master.frames_written
+
+
+def _convert_take(src, info, master, offset, size):
+    frame_size = info.channels * info.sample_width
+    chunk_size = COPY_CHUNK_SIZE - COPY_CHUNK_SIZE % frame_size
+    src.seek(offset)
+    remaining = size
+    while remaining > 0:
+        chunk = src.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        samples = decode_samples(chunk, info.sample_width, info.format_tag).reshape(-1, info.channels)
+        if info.channels != master.channels:
+            # mono is spread over every channel, anything else is mixed down to mono
+            if info.channels == 1:
+                samples = np.repeat(samples, master.channels, axis=1)
+            else:
+                samples = samples.mean(axis=1, keepdims=True)
+        master.write(encode_samples(samples.reshape(-1), master.sample_width, master.format_tag))
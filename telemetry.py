@@ -0,0 +1,271 @@
+import bisect
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+
+# PortAudio's paInputUnderflow and paInputOverflow stream callback status flags
+INPUT_UNDERFLOW = 0x1
+INPUT_OVERFLOW = 0x2
+
+# upper edges of the callback duration histogram buckets, as fractions of the block period.
+# one more bucket holds everything past the last edge
+CALLBACK_HISTOGRAM_EDGES = [0.05, 0.1, 0.2, 0.5, 0.75, 1.0]
+
+# how often the stream counters are checked for new xruns and dropped audio, in seconds
+HEALTH_INTERVAL = 1.0
+# how often a health record is logged while a session runs, in seconds
+HEALTH_LOG_INTERVAL = 60.0
+
+LOG_NAME = 'recorder.log'
+# the log is rotated at this size, keeping this many old files
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 5
+
+HEALTH_OK = 'ok'
+# xruns or late callbacks: the device or driver hiccuped, the take may have a click
+HEALTH_WARNING = 'warning'
+# the capture ring overflowed: audio is missing from the take
+HEALTH_BAD = 'bad'
+
+
+def app_data_dir():
+    # per user rather than per session directory, for the log and caches
+    base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.local', 'state')
+    return os.path.join(base, 'eaygsr')
+
+
+def default_log_path():
+    return os.path.join(app_data_dir(), LOG_NAME)
+
+
+class CallbackStats:
+    """ Counters kept by one stream callback.
+
+    `record` is called at the end of every callback with the perf_counter time the callback
+    started, and only bumps counters in place. Everything is read from other threads without
+    a lock; a reading can be a block out of date, never wrong.
+    """
+
+    def __init__(self, block_period):
+        self.block_period = block_period
+        self._edges = [edge * block_period for edge in CALLBACK_HISTOGRAM_EDGES]
+        self.histogram = [0] * (len(self._edges) + 1)
+        self.callbacks = 0
+        self.input_underflows = 0
+        self.input_overflows = 0
+        # callbacks that took longer than a block period
+        self.late = 0
+        self.max_duration = 0.0
+        # seconds from the ADC to the callback, as reported by the stream
+        self.latency = None
+        self.max_latency = 0.0
+
+    def record(self, started, status, time_info):
+        duration = time.perf_counter() - started
+        self.callbacks += 1
+        self.histogram[bisect.bisect_left(self._edges, duration)] += 1
+        if duration > self.block_period:
+            self.late += 1
+        if duration > self.max_duration:
+            self.max_duration = duration
+        if status:
+            if status & INPUT_UNDERFLOW:
+                self.input_underflows += 1
+            if status & INPUT_OVERFLOW:
+                self.input_overflows += 1
+        if time_info:
+            adc_time = time_info.get('input_buffer_adc_time', 0)
+            if adc_time:
+                latency = time_info.get('current_time', 0) - adc_time
+                if 0 <= latency < 1:
+                    self.latency = latency
+                    if latency > self.max_latency:
+                        self.max_latency = latency
+
+    def percentile(self, percent):
+        # upper edge of the histogram bucket the percentile falls in, as a fraction of the block period.
+        # the last bucket has no edge, the longest callback stands in for it
+        target = self.callbacks * percent / 100
+        seen = 0
+        for count, edge in zip(self.histogram, CALLBACK_HISTOGRAM_EDGES + [round(self.max_duration / self.block_period, 3)]):
+            seen += count
+            if seen >= target and count:
+                return edge
+        return 0.0
+
+
+class JsonFormatter(logging.Formatter):
+    # one JSON object per line: time, level, event and the record's fields
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname.lower(),
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+class PrintLog:
+    """ Stands in for sys.stdout: every printed line also goes to the log as a `message` event.
+
+    The --noconsole build has no stdout at all, so without this everything the recorder
+    prints would be lost.
+    """
+
+    def __init__(self, logger, stream):
+        self.logger = logger
+        self.stream = stream
+        self._local = threading.local()
+
+    def write(self, text):
+        if self.stream is not None:
+            self.stream.write(text)
+        # lines are put together per thread, so prints from different threads do not get mixed up
+        buffered = getattr(self._local, 'buffer', '') + text
+        *lines, self._local.buffer = buffered.split('\n')
+        for line in lines:
+            if line:
+                self.logger.info('message', extra={'fields': {'text': line, 'thread': threading.current_thread().name}})
+        return len(text)
+
+    def flush(self):
+        if self.stream is not None:
+            self.stream.flush()
+
+
+class Telemetry:
+    """ Health of the capture: xruns, callback times, input latency, writer backlog and drops.
+
+    The stream callbacks keep CallbackStats and the capture writers their ring counters; a
+    watcher thread compares them every HEALTH_INTERVAL and logs any new xrun or dropped audio
+    as soon as it is seen. `health()` sums it up for a UI since the session started, and each
+    take gets the counters of its own stretch of audio from `take_delta()`.
+
+    With a `log_path`, events are written as JSON lines to a rotating log file, and with
+    `log_prints` everything printed goes there too.
+    """
+
+    def __init__(self, log_path=None, log_prints=False):
+        self.log_path = log_path
+        self.callback_stats = []
+        self.capture = None
+        self.logger = logging.getLogger('eaygsr')
+        self.logger.propagate = False
+        # without a log file, warnings must not end up on stderr through logging's last resort handler
+        self.logger.addHandler(logging.NullHandler())
+        if log_path is not None:
+            self.logger.setLevel(logging.INFO)
+            try:
+                os.makedirs(os.path.dirname(log_path), exist_ok=True)
+                handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+                handler.setFormatter(JsonFormatter())
+                self.logger.addHandler(handler)
+            except OSError as e:
+                print(f"Could not open the log '{log_path}': {e}")
+            if log_prints and not isinstance(sys.stdout, PrintLog):
+                sys.stdout = PrintLog(self.logger, sys.stdout)
+        self._session_baseline = None
+        self._take_baseline = self.counters()
+        self._last = self._take_baseline
+        self._last_health_log = 0.0
+        self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self._thread.start()
+
+    def watch(self, callback_stats, capture):
+        # called whenever the streams and writers are rebuilt
+        self.callback_stats = callback_stats
+        self.capture = capture
+        self._take_baseline = self._last = self.counters()
+        if self._session_baseline is not None:
+            self._session_baseline = self._last
+
+    def log(self, event, level=logging.INFO, **fields):
+        self.logger.log(level, event, extra={'fields': fields})
+
+    def counters(self):
+        counters = {
+            'callbacks': sum(stats.callbacks for stats in self.callback_stats),
+            'input_underflows': sum(stats.input_underflows for stats in self.callback_stats),
+            'input_overflows': sum(stats.input_overflows for stats in self.callback_stats),
+            'late_callbacks': sum(stats.late for stats in self.callback_stats),
+            'dropped_blocks': 0,
+            'dropped_frames': 0,
+        }
+        if self.capture is not None:
+            stats = self.capture.stats()
+            counters['dropped_blocks'] = stats['overflows']
+            counters['dropped_frames'] = stats['dropped_frames']
+        return counters
+
+    def session_started(self, **fields):
+        self._session_baseline = self._take_baseline = self.counters()
+        self._last_health_log = time.monotonic()
+        self.log('session_started', **fields)
+
+    def session_ended(self, **fields):
+        self.log('session_ended', **self.summary(), **fields)
+        self._session_baseline = None
+
+    def take_delta(self):
+        # stream counters since the last call (or the session start), for the take that just ended.
+        # the writer counts the take's backlog and dropped blocks itself
+        counters = self.counters()
+        delta = {key: counters[key] - self._take_baseline.get(key, 0) for key in ('input_underflows', 'input_overflows', 'late_callbacks')}
+        self._take_baseline = counters
+        return delta
+
+    def summary(self):
+        # everything since the session started (or since the streams were opened, outside a session)
+        counters = self.counters()
+        baseline = self._session_baseline or {}
+        summary = {key: counters[key] - baseline.get(key, 0) for key in counters}
+        primary = self.callback_stats[0] if self.callback_stats else None
+        if primary is not None and primary.callbacks:
+            summary['callback_p99'] = primary.percentile(99)
+            summary['callback_max'] = round(primary.max_duration / primary.block_period, 3)
+            summary['callback_histogram'] = list(primary.histogram)
+            if primary.latency is not None:
+                summary['input_latency_ms'] = round(primary.latency * 1000, 2)
+                summary['max_input_latency_ms'] = round(primary.max_latency * 1000, 2)
+        if self.capture is not None:
+            stats = self.capture.stats()
+            summary['backlog_frames'] = stats['backlog_frames']
+            summary['max_backlog_frames'] = stats['max_backlog_frames']
+        return summary
+
+    def health(self):
+        """ Returns (HEALTH_OK/WARNING/BAD, short text, summary) for the session so far. """
+        summary = self.summary()
+        xruns = summary['input_underflows'] + summary['input_overflows']
+        if summary['dropped_blocks']:
+            return HEALTH_BAD, f"{summary['dropped_frames']} frames lost", summary
+        if xruns or summary['late_callbacks']:
+            return HEALTH_WARNING, f"{xruns} xruns, {summary['late_callbacks']} late", summary
+        return HEALTH_OK, "OK", summary
+
+    def _run(self):
+        while True:
+            time.sleep(HEALTH_INTERVAL)
+            try:
+                self._check()
+            except Exception as e:
+                print(f"Health check failed: {e}")
+
+    def _check(self):
+        counters = self.counters()
+        new = {key: counters[key] - self._last.get(key, 0) for key in counters}
+        self._last = counters
+        if new['input_underflows'] or new['input_overflows'] or new['late_callbacks']:
+            self.log('xrun', logging.WARNING, input_underflows=new['input_underflows'], input_overflows=new['input_overflows'],
+                     late_callbacks=new['late_callbacks'])
+        if new['dropped_blocks']:
+            print(f"Capture buffer overflowed, {new['dropped_frames']} frames dropped")
+            self.log('dropped', logging.ERROR, dropped_blocks=new['dropped_blocks'], dropped_frames=new['dropped_frames'])
+        if self._session_baseline is not None and time.monotonic() - self._last_health_log >= HEALTH_LOG_INTERVAL:
+            self._last_health_log = time.monotonic()
+            self.log('health', **self.summary())
@@ -0,0 +1,407 @@
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# size of each read/write when copying audio data between files
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# plain RIFF/WAVE, switched to RF64 in place once it grows past 4 GiB
+CONTAINER_WAV = 'wav'
+# RF64 (EBU Tech 3306) from the start
+CONTAINER_RF64 = 'rf64'
+# Sony Wave64
+CONTAINER_W64 = 'w64'
+
+# how often the size fields in the header are brought up to date while writing, in seconds.
+# after a crash the file is a valid WAV missing at most this much audio at the end
+HEADER_INTERVAL = 2.0
+
+# when to fsync: never, only on close, or every time the header is patched
+FSYNC_NEVER = 'never'
+FSYNC_ON_CLOSE = 'close'
+FSYNC_ON_PATCH = 'patch'
+
+RIFF_MAX_SIZE = 0xFFFFFFFF
+# sendfile() never moves more than this per call on Linux
+SENDFILE_MAX_SIZE = 0x7FFFF000
+
+W64_RIFF_GUID = b'riff\x2e\x91\xcf\x11\xa5\xd6\x28\xdb\x04\xc1\x00\x00'
+W64_WAVE_GUID = b'wave\xf3\xac\xd3\x11\x8c\xd1\x00\xc0\x4f\x8e\xdb\x8a'
+W64_FMT_GUID = b'fmt \xf3\xac\xd3\x11\x8c\xd1\x00\xc0\x4f\x8e\xdb\x8a'
+W64_DATA_GUID = b'data\xf3\xac\xd3\x11\x8c\xd1\x00\xc0\x4f\x8e\xdb\x8a'
+
+WavInfo = namedtuple('WavInfo', ['channels', 'sample_width', 'sample_rate', 'data_offset', 'data_size', 'format_tag', 'container'])
+
+
+class WavWriter:
+    """ Streaming WAV writer for takes of any length.
+
+    The header is written up front with room for an RF64 ds64 chunk (as a JUNK chunk), and
+    the size fields are patched in place every `header_interval` seconds, so the file on disk
+    is always a playable WAV. A CONTAINER_WAV file that grows past 4 GiB is switched over to
+    RF64 on the next patch.
+
+    Cue points added with `add_cue` are written as a cue chunk (and labels as a LIST/adtl
+    chunk) after the audio when the file is closed. W64 files get no cues.
+    """
+
+    def __init__(self, file_path, channels, sample_width, sample_rate, container=CONTAINER_WAV,
+                 format_tag=WAVE_FORMAT_PCM, header_interval=HEADER_INTERVAL, fsync=FSYNC_ON_PATCH):
+        self.file_path = file_path
+        self.channels = channels
+        self.sample_width = sample_width
+        self.sample_rate = sample_rate
+        self.frame_size = channels * sample_width
+        self.format_tag = format_tag
+        self.container = container
+        self.header_interval = header_interval
+        self.fsync = fsync
+
+        self.data_size = 0
+        # (frame, label) pairs
+        self.cues = []
+        self._rf64 = container == CONTAINER_RF64
+        self._file = open(file_path, 'wb')
+        self._write_header()
+        self._last_patch = time.monotonic()
+
+    @property
+    def frames_written(self):
+        return self.data_size // self.frame_size
+
+    def write(self, data):
+        self._file.write(data)
+        self.data_size += memoryview(data).nbytes
+        if time.monotonic() - self._last_patch >= self.header_interval:
+            self.flush()
+
+    def write_file_range(self, src, offset, size):
+        """ Append `size` bytes of the open file `src`, starting at byte `offset`, as audio data.
+
+        The bytes are copied between the files by the kernel where the platform allows it
+        (copy_file_range, then sendfile) and through a fixed size buffer otherwise.
+        """
+        self._file.flush()
+        dest_offset = self._data_offset + self.data_size
+        copied = _copy_file_range(src.fileno(), self._file.fileno(), offset, dest_offset, size)
+        self._file.seek(dest_offset + copied)
+        self.data_size += copied
+
+        src.seek(offset + copied)
+        remaining = size - copied
+        while remaining > 0:
+            chunk = src.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            self._file.write(chunk)
+            self.data_size += len(chunk)
+            remaining -= len(chunk)
+
+        if time.monotonic() - self._last_patch >= self.header_interval:
+            self.flush()
+
+    def add_cue(self, frame, label=''):
+        self.cues.append((frame, label))
+
+    def flush(self):
+        # bring the header up to date and push everything to the OS
+        self._patch_header()
+        self._file.flush()
+        if self.fsync == FSYNC_ON_PATCH:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is None:
+            return
+        # chunks are padded to an even size (8 bytes for w64)
+        pad = (-self.data_size) % (8 if self.container == CONTAINER_W64 else 2)
+        self._file.write(b'\x00' * pad)
+        trailer = b''
+        if self.cues and self.container != CONTAINER_W64:
+            trailer = _cue_chunks(self.cues)
+            self._file.write(trailer)
+        self._patch_header(pad + len(trailer))
+        self._file.flush()
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _fmt_chunk(self):
+        byte_rate = self.sample_rate * self.frame_size
+        return struct.pack('<HHIIHH', self.format_tag, self.channels, self.sample_rate, byte_rate, self.frame_size, self.sample_width * 8)
+
+    def _write_header(self):
+        fmt = self._fmt_chunk()
+        if self.container == CONTAINER_W64:
+            self._file.write(W64_RIFF_GUID + struct.pack('<Q', 0) + W64_WAVE_GUID)
+            self._file.write(W64_FMT_GUID + struct.pack('<Q', 24 + len(fmt)) + fmt)
+            self._file.write(W64_DATA_GUID + struct.pack('<Q', 24))
+        else:
+            # 'JUNK' reserves the space a ds64 chunk needs, so any file can become RF64 in place
+            self._file.write(b'RIFF' + struct.pack('<I', 0) + b'WAVE')
+            self._file.write(b'JUNK' + struct.pack('<I', 28) + b'\x00' * 28)
+            self._file.write(b'fmt ' + struct.pack('<I', len(fmt)) + fmt)
+            self._file.write(b'data' + struct.pack('<I', 0))
+        self._data_offset = self._file.tell()
+        self._patch_header()
+
+    def _patch_header(self, pad=0):
+        end = self._file.tell()
+        self._rf64 = _write_sizes(self._file, self.container, self._data_offset, self.data_size, self.frames_written, pad, self._rf64)
+        self._file.seek(end)
+        self._last_patch = time.monotonic()
+
+
+def _cue_chunks(cues):
+    # 'cue ' chunk plus a LIST/adtl chunk with a 'labl' for every labelled cue.
+    # cue positions are 32 bit, cues past that are dropped
+    cues = [(frame, label) for frame, label in cues if 0 <= frame <= RIFF_MAX_SIZE]
+    points = b''.join(struct.pack('<II4sIII', cue_id, frame, b'data', 0, 0, frame)
+                      for cue_id, (frame, _) in enumerate(cues, 1))
+    chunks = b'cue ' + struct.pack('<II', 4 + len(points), len(cues)) + points
+
+    labels = b''
+    for cue_id, (_, label) in enumerate(cues, 1):
+        if not label:
+            continue
+        text = label.encode('utf-8') + b'\x00'
+        labels += b'labl' + struct.pack('<II', 4 + len(text), cue_id) + text + b'\x00' * (len(text) & 1)
+    if labels:
+        chunks += b'LIST' + struct.pack('<I', 4 + len(labels)) + b'adtl' + labels
+    return chunks
+
+
+def _copy_file_range(src_fd, dest_fd, src_offset, dest_offset, size):
+    """ Copy bytes between two files inside the kernel. Returns how many bytes were copied,
+    which is less than `size` (possibly 0) where neither call is available or both fail.
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                count = os.copy_file_range(src_fd, dest_fd, size - copied, src_offset + copied, dest_offset + copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            # e.g. across file systems on older kernels
+            pass
+    if copied < size and hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        # only Linux can sendfile() into a regular file
+        try:
+            os.lseek(dest_fd, dest_offset + copied, os.SEEK_SET)
+            while copied < size:
+                count = os.sendfile(dest_fd, src_fd, src_offset + copied, min(size - copied, SENDFILE_MAX_SIZE))
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            pass
+    return copied
+
+
+def _write_sizes(f, container, data_offset, data_size, frames, pad=0, rf64=False):
+    # patch the size fields of a header laid out like WavWriter's, returns whether it is now RF64.
+    # `pad` is everything in the file after the audio data
+    riff_size = data_offset + data_size + pad - 8
+
+    if container == CONTAINER_W64:
+        f.seek(16)
+        f.write(struct.pack('<Q', riff_size + 8))
+        f.seek(data_offset - 8)
+        f.write(struct.pack('<Q', 24 + data_size))
+        return False
+
+    if riff_size > RIFF_MAX_SIZE:
+        rf64 = True
+    f.seek(0)
+    if rf64:
+        f.write(b'RF64' + struct.pack('<I', RIFF_MAX_SIZE) + b'WAVE')
+        f.write(b'ds64' + struct.pack('<IQQQI', 28, riff_size, data_size, frames, 0))
+        f.seek(data_offset - 4)
+        f.write(struct.pack('<I', RIFF_MAX_SIZE))
+    else:
+        f.write(b'RIFF' + struct.pack('<I', riff_size))
+        f.seek(data_offset - 4)
+        f.write(struct.pack('<I', data_size))
+    return rf64
+
+
+def read_wav_info(file_path, to_end=False):
+    """ Parse the header of a WAV, RF64 or W64 file without loading any audio.
+
+    If the data chunk size is missing or larger than the file (e.g. the writer never got to
+    patch it), the data is assumed to run to the end of the file. With `to_end` the size in
+    the header is ignored and the data always runs to the end of the file.
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        head = f.read(40)
+        if head[:16] == W64_RIFF_GUID:
+            return _read_w64_info(f, file_path, file_size, to_end)
+        if len(head) < 12:
+            raise ValueError(f"'{file_path}' is too short to be a WAV file")
+        riff, _, wave_id = struct.unpack('<4sI4s', head[:12])
+        if riff not in (b'RIFF', b'RF64') or wave_id != b'WAVE':
+            raise ValueError(f"'{file_path}' is not a WAV file")
+        f.seek(12)
+
+        fmt = None
+        ds64_data_size = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"'{file_path}' has no data chunk")
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'ds64':
+                _, ds64_data_size = struct.unpack('<QQ', f.read(16))
+                f.seek(chunk_size - 16 + (chunk_size & 1), os.SEEK_CUR)
+            elif chunk_id == b'fmt ':
+                fmt = _parse_fmt(f.read(chunk_size))
+                if chunk_size & 1:
+                    f.seek(1, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(f"'{file_path}' has no fmt chunk")
+                if riff == b'RF64' and chunk_size == RIFF_MAX_SIZE and ds64_data_size is not None:
+                    chunk_size = ds64_data_size
+                container = CONTAINER_RF64 if riff == b'RF64' else CONTAINER_WAV
+                return _make_info(fmt, f.tell(), 0 if to_end else chunk_size, file_size, container)
+            else:
+                f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+def _read_w64_info(f, file_path, file_size, to_end):
+    f.seek(40)
+    fmt = None
+    while True:
+        header = f.read(24)
+        if len(header) < 24:
+            raise ValueError(f"'{file_path}' has no data chunk")
+        guid, chunk_size = header[:16], struct.unpack('<Q', header[16:])[0]
+        body_size = chunk_size - 24
+        if guid == W64_FMT_GUID:
+            fmt = _parse_fmt(f.read(body_size))
+            f.seek((-chunk_size) % 8, os.SEEK_CUR)
+        elif guid == W64_DATA_GUID:
+            if fmt is None:
+                raise ValueError(f"'{file_path}' has no fmt chunk")
+            return _make_info(fmt, f.tell(), 0 if to_end else body_size, file_size, CONTAINER_W64)
+        else:
+            f.seek(body_size + (-chunk_size) % 8, os.SEEK_CUR)
+
+
+def _parse_fmt(data):
+    format_tag, channels, sample_rate, _, block_align, bits = struct.unpack('<HHIIHH', data[:16])
+    if format_tag == WAVE_FORMAT_EXTENSIBLE and len(data) >= 26:
+        # the real format is the first two bytes of the sub format GUID
+        format_tag = struct.unpack('<H', data[24:26])[0]
+    return format_tag, channels, sample_rate, block_align, bits
+
+
+def _make_info(fmt, data_offset, data_size, file_size, container):
+    format_tag, channels, sample_rate, block_align, bits = fmt
+    if data_size <= 0 or data_offset + data_size > file_size:
+        data_size = file_size - data_offset
+    return WavInfo(channels, bits // 8, sample_rate, data_offset, data_size, format_tag, container)
+
+
+def repair_header(file_path):
+    """ Rebuild the size fields of a WAV/RF64/W64 file from the audio actually in it.
+
+    Meant for files whose writer died before closing them: the data is assumed to run to the
+    end of the file, and a trailing partial frame is cut off. Returns the repaired WavInfo and
+    the number of bytes trimmed.
+    """
+    info = read_wav_info(file_path, to_end=True)
+    frame_size = info.channels * info.sample_width
+    trimmed = info.data_size % frame_size
+    data_size = info.data_size - trimmed
+
+    with open(file_path, 'r+b') as f:
+        if trimmed:
+            f.truncate(info.data_offset + data_size)
+
+        rf64 = info.container == CONTAINER_RF64
+        if info.container == CONTAINER_WAV and info.data_offset + data_size - 8 > RIFF_MAX_SIZE:
+            # only headers with a reserved JUNK/ds64 slot up front can become RF64 in place
+            f.seek(12)
+            if f.read(4) not in (b'JUNK', b'ds64'):
+                f.seek(4)
+                f.write(struct.pack('<I', RIFF_MAX_SIZE))
+                f.seek(info.data_offset - 4)
+                f.write(struct.pack('<I', RIFF_MAX_SIZE))
+                return info._replace(data_size=data_size), trimmed
+        rf64 = _write_sizes(f, info.container, info.data_offset, data_size, data_size // frame_size, rf64=rf64)
+
+    container = CONTAINER_RF64 if rf64 else info.container
+    return info._replace(data_size=data_size, container=container), trimmed
+
+
+def decode_samples(buffer, sample_width, format_tag, offset=0, count=-1):
+    """ Convert `count` samples of little endian PCM or float audio starting at byte `offset`
+    of `buffer` to a float64 array scaled to [-1.0, 1.0].
+    """
+    if format_tag == WAVE_FORMAT_IEEE_FLOAT:
+        dtype = '<f4' if sample_width == 4 else '<f8'
+        return np.frombuffer(buffer, dtype, count, offset).astype(np.float64)
+
+    if sample_width == 3:
+        raw = np.frombuffer(buffer, np.uint8, count * 3 if count >= 0 else -1, offset).reshape(-1, 3)
+        samples = raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8) | (raw[:, 2].astype(np.int32) << 16)
+        samples = (samples << 8) >> 8 # sign extend from 24 bits
+        return samples * (1.0 / (1 << 23))
+
+    if sample_width == 1:
+        # 8 bit WAV is unsigned
+        return (np.frombuffer(buffer, np.uint8, count, offset) - 128.0) * (1.0 / 128)
+
+    dtype = '<i2' if sample_width == 2 else '<i4'
+    return np.frombuffer(buffer, dtype, count, offset) * (1.0 / (1 << (8 * sample_width - 1)))
+
+
+def encode_samples(samples, sample_width, format_tag):
+    """ Convert float64 samples in [-1.0, 1.0] to little endian PCM or float bytes, the inverse
+    of decode_samples. Out of range samples are clipped.
+    """
+    if format_tag == WAVE_FORMAT_IEEE_FLOAT:
+        return samples.astype('<f4' if sample_width == 4 else '<f8').tobytes()
+
+    full_scale = 1 << (8 * sample_width - 1)
+    ints = np.clip(np.round(samples * full_scale), -full_scale, full_scale - 1)
+    if sample_width == 1:
+        return (ints + 128).astype(np.uint8).tobytes()
+    if sample_width == 3:
+        # low three bytes of each little endian int32
+        return ints.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    return ints.astype('<i2' if sample_width == 2 else '<i4').tobytes()
+
+
+def copy_frames(src_path, dest_path, start_frame, end_frame):
+    """ Write frames [start_frame, end_frame) of src_path to a new WAV at dest_path. """
+    info = read_wav_info(src_path)
+    frame_size = info.channels * info.sample_width
+    total_frames = info.data_size // frame_size
+    start_frame = max(0, min(start_frame, total_frames))
+    end_frame = max(start_frame, min(end_frame, total_frames))
+
+    with open(src_path, 'rb') as src, WavWriter(dest_path, info.channels, info.sample_width, info.sample_rate,
+                                                 format_tag=info.format_tag, fsync=FSYNC_NEVER) as dest:
+        dest.write_file_range(src, info.data_offset + start_frame * frame_size, (end_frame - start_frame) * frame_size)
+
+    return end_frame - start_frame